@@ -1,11 +1,18 @@
 import os
 import sys
-import json
 import time
-import re
-import threading
+import asyncio
 from datetime import datetime
 from dotenv import load_dotenv
+from conversation_store import open_store, start_flusher
+from chat_workers import start_metrics_reporter
+from intent_router import INTENT_STATUS
+from message_coalescer import MessageCoalescer
+from rate_limit import shared_bucket
+from order_status import OrderStatusCache, FINAL_STATUSES, RECORDS_PER_QUERY, record_ids_formula, status_from_fields
+from order_engine import (
+    OrderEngine, ORDER_STRUCTURED_OUTPUT, ERROR_REPLY, response_cache, order_status_reply, paid_status_reply
+)
 
 # Исправление кодировки для Windows консоли
 if sys.platform.startswith('win'):
@@ -15,8 +22,8 @@ if sys.platform.startswith('win'):
     except Exception:
         pass
 
-import requests
-from telegram import Update, ForceReply
+import http_client
+from telegram import Update
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -24,14 +31,12 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from openai import OpenAI
 
 load_dotenv()
 
 # ======================== КОНФИГУРАЦИЯ ========================
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
 AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
 AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
 AIRTABLE_TABLE_NAME = os.getenv("AIRTABLE_TABLE_NAME", "Orders")
@@ -43,439 +48,306 @@ KITCHEN_STAFF_IDS = [id.strip() for id in KITCHEN_STAFF_IDS if id.strip()]
 # Файл для сохранения диалогов
 CONVERSATIONS_FILE = "telegram_conversations.json"
 
-# ======================== МЕНЮ ========================
-
-MENU = {
-    "Бургеры": [
-        {"name": "Классический бургер", "price": 1500, "desc": "Говядина, салат, помидор, сыр"},
-        {"name": "Чизбургер", "price": 1800, "desc": "Двойной сыр, говядина, соус"},
-        {"name": "Курица бургер", "price": 1600, "desc": "Куриная котлета, салат, майонез"},
-        {"name": "Фиш бургер", "price": 1700, "desc": "Рыбная котлета, сырный соус"}
-    ],
-    "Пицца": [
-        {"name": "Маргарита", "price": 2500, "desc": "Томаты, моцарелла, базилик"},
-        {"name": "Пепперони", "price": 3000, "desc": "Колбаса пепперони, сыр"},
-        {"name": "4 сыра", "price": 3200, "desc": "Моцарелла, чеддер, пармезан, дор блю"},
-        {"name": "Мясная", "price": 3500, "desc": "Говядина, ветчина, бекон"}
-    ],
-    "Напитки": [
-        {"name": "Кола", "price": 500, "desc": "0.5л"},
-        {"name": "Фанта", "price": 500, "desc": "0.5л"},
-        {"name": "Спрайт", "price": 500, "desc": "0.5л"},
-        {"name": "Сок", "price": 600, "desc": "0.5л апельсиновый"}
-    ],
-    "Допы": [
-        {"name": "Картофель фри", "price": 800, "desc": "Средняя порция"},
-        {"name": "Наггетсы", "price": 1200, "desc": "6 шт"},
-        {"name": "Луковые кольца", "price": 900, "desc": "10 шт"},
-        {"name": "Соусы", "price": 200, "desc": "Кетчуп, майонез, сырный"}
-    ]
-}
-
-KASPI_PAYMENT_INFO = {
-    "ru": "💳 Номер Kaspi: +7 777 123 4567\n👤 Получатель: ТОО 'Доставка'",
-    "kk": "💳 Kaspi нөмірі: +7 777 123 4567\n👤 Алушы: 'Жеткізу' ЖШС",
-    "en": "💳 Kaspi number: +7 777 123 4567\n👤 Recipient: Delivery LLC"
-}
+# Ограничения параллельных запросов к каждому внешнему сервису (лимит AI — в order_engine)
+AIRTABLE_CONCURRENCY = int(os.getenv("AIRTABLE_CONCURRENCY", "5"))
+# Лимит Airtable: 5 запросов/сек на базу — общий с WhatsApp-ботом, если оба в одном процессе
+AIRTABLE_RATE_LIMIT = float(os.getenv("AIRTABLE_RATE_LIMIT", "5"))
+TELEGRAM_FILE_CONCURRENCY = int(os.getenv("TELEGRAM_FILE_CONCURRENCY", "10"))
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "64"))
+
+# Потоковый вывод ответа AI (правка одного сообщения по мере генерации)
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Статусы заказов: фоновое пакетное обновление из Airtable, /status читает из кэша
+ORDER_STATUS_REFRESH = float(os.getenv("ORDER_STATUS_REFRESH", "15"))
+ORDER_STATUS_MAX_AGE = float(os.getenv("ORDER_STATUS_MAX_AGE", "30"))
+ORDER_STATUS_PUSH = os.getenv("ORDER_STATUS_PUSH", "1") == "1"
+
+# Склейка подряд идущих сообщений: пауза тишины и предельное ожидание (сек)
+MESSAGE_QUIET_WINDOW = float(os.getenv("MESSAGE_QUIET_WINDOW", "1.5"))
+MESSAGE_MAX_WAIT = float(os.getenv("MESSAGE_MAX_WAIT", "6"))
 
 # ======================== ХРАНИЛИЩЕ ДАННЫХ ========================
 
-conversations = {}
-checked_records = set()
+conversations = None
+
+def new_conversation():
+    return {
+        "messages": [],
+        "language": None,
+        "order_placed": False,
+        "waiting_for_receipt": False,
+        "airtable_record_id": None,
+        "order_closed": False,
+        "pending_order": None,
+        "user_name": "",
+        "phone": "",
+        "receipt_file_id": None,
+        "receipt_type": None,
+        "last_interaction": time.time()
+    }
+
+# Диалог заказа (меню, промпт, AI, разбор заказа) — общий с WhatsApp-ботом
+telegram_engine = OrderEngine(new_conversation)
 
 def load_conversations():
     global conversations
-    if os.path.exists(CONVERSATIONS_FILE):
-        try:
-            with open(CONVERSATIONS_FILE, 'r', encoding='utf-8') as f:
-                conversations = json.load(f)
-        except Exception as e:
-            print(f"⚠️ Ошибка загрузки: {e}")
-            conversations = {}
+    conversations = open_store(CONVERSATIONS_FILE)
+    telegram_engine.store = conversations
     return conversations
 
-def save_conversations():
-    try:
-        with open(data/CONVERSATIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(conversations, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения: {e}")
-
 def ensure_conversation(user_id):
-    user_id = str(user_id)
-    if user_id not in conversations:
-        conversations[user_id] = {
-            "messages": [],
-            "language": None,
-            "order_placed": False,
-            "waiting_for_receipt": False,
-            "airtable_record_id": None,
-            "pending_order": None,
-            "user_name": "",
-            "phone": "",
-            "receipt_file_id": None,
-            "receipt_type": None,
-            "last_interaction": time.time()
-        }
-    else:
-        conversations[user_id]["last_interaction"] = time.time()
-    return conversations[user_id]
+    conv = telegram_engine.ensure(user_id)
+    conversations.update(str(user_id), last_interaction=time.time())
+    return conv
 
-# ======================== AI CLIENT ========================
+# ======================== КЛИЕНТЫ ========================
 
-perplexity_client = OpenAI(
-    api_key=PERPLEXITY_API_KEY, 
-    base_url="https://api.perplexity.ai"
-)
+order_statuses = OrderStatusCache()
 
-# ======================== ГЕНЕРАЦИЯ МЕНЮ ========================
+airtable_semaphore = asyncio.Semaphore(AIRTABLE_CONCURRENCY)
+airtable_bucket = shared_bucket("airtable", AIRTABLE_RATE_LIMIT)
+telegram_file_semaphore = asyncio.Semaphore(TELEGRAM_FILE_CONCURRENCY)
 
-def generate_menu_text(language="ru"):
-    if language == "kk":
-        menu_text = "\n🍽 МӘЗІР:\n\n"
-        categories_kk = {
-            "Бургеры": "Бургерлер",
-            "Пицца": "Пицца",
-            "Напитки": "Сусындар",
-            "Допы": "Қосымша"
-        }
-        for category, items in MENU.items():
-            menu_text += f"━━ {categories_kk.get(category, category)} ━━\n"
-            for item in items:
-                menu_text += f"  • {item['name']}: {item['price']}₸\n    ({item['desc']})\n"
-            menu_text += "\n"
-    elif language == "en":
-        menu_text = "\n🍽 MENU:\n\n"
-        for category, items in MENU.items():
-            menu_text += f"━━ {category} ━━\n"
-            for item in items:
-                menu_text += f"  • {item['name']}: {item['price']}₸\n    ({item['desc']})\n"
-            menu_text += "\n"
-    else:  # ru
-        menu_text = "\n🍽 МЕНЮ:\n\n"
-        for category, items in MENU.items():
-            menu_text += f"━━ {category} ━━\n"
-            for item in items:
-                menu_text += f"  • {item['name']}: {item['price']}₸\n    ({item['desc']})\n"
-            menu_text += "\n"
-    return menu_text
-
-# ======================== SYSTEM PROMPT ========================
-
-# ======================== SYSTEM PROMPT ========================
-
-def get_system_prompt(language="ru"):
-    menu_text = generate_menu_text(language)
-    payment_info = KASPI_PAYMENT_INFO.get(language, KASPI_PAYMENT_INFO["ru"])
-    
-    common_rules = """
-NO MARKDOWN. NO **bold**. NO *italic*. NO `code`.
-Just clear, plain text.
-Don't be robotic. Be human, friendly and fast.
-"""
-    
-    if language == "kk":
-        return f"""Сіз фаст-фуд жеткізу қызметінің сатушысысыз.
-{common_rules}
-МАҚСАТ: Тапсырысты қабылдау және Kaspi арқылы төлем сұрау.
-
-Сөйлесу мәнері:
-- Қысқа әрі нұсқа жауап беріңіз.
-- Клиентпен дос сияқты сөйлесіңіз.
-- "Жұлдызша" немесе "астын сызу" белгілерін ҚОЛДАНБАҢЫЗ.
-- Эмодзи: әр хабарламада 1-2 ғана.
-
-САТУ КЕЗЕҢДЕРІ:
-1. Амандасу және таңдауға көмектесу.
-2. Тапсырысты нақтылау (комбо ұсыну).
-3. Төлем деректерін беру және чекті сұрау.
-
-ТАПСЫРЫС ДАЙЫН БОЛҒАНДА (тауар, баға, адрес, телефон бар):
-Келесі JSON форматын ҚОСЫҢЫЗ (клиентке көрсетілмейді, тек жүйе үшін):
-{{
-  "order_confirmed": true,
-  "customer_name": "Аты",
-  "phone": "Телефон",
-  "order_items": ["Тауар 1", "Тауар 2"],
-  "total_price": 5000,
-  "delivery_address": "Мекенжай"
-}}
-
-МӘЗІР:
-{menu_text}
-
-{payment_info}
-"""
-    
-    elif language == "en":
-        return f"""You are a fast food delivery seller.
-{common_rules}
-GOAL: Take the order and request Kaspi payment.
-
-Style:
-- Short and clear answers.
-- Talk like a friend.
-- DO NOT use markdown (*, **).
-- Emojis: 1-2 per message max.
-
-STAGES:
-1. Greet and help choose.
-2. Confirm items (upsell combo).
-3. Give payment info and ask for receipt.
-
-WHEN ORDER IS READY (items, price, address, phone are known):
-Include this JSON (invisible to user, for system only):
-{{
-  "order_confirmed": true,
-  "customer_name": "Name",
-  "phone": "Phone",
-  "order_items": ["Item 1", "Item 2"],
-  "total_price": 5000,
-  "delivery_address": "Address"
-}}
-
-MENU:
-{menu_text}
-
-{payment_info}
-"""
-    
-    else:  # Russian
-        return f"""Ты — продавец доставки фаст-фуда.
-{common_rules}
-ЦЕЛЬ: Принять заказ и запросить оплату Kaspi.
-
-Стиль общения:
-- Пиши кратко и по делу.
-- Общайся как друг, тепло и просто.
-- ЗАПРЕЩЕНО использовать жирный шрифт (звездочки **) или курсив.
-- Эмодзи: 1-2 на сообщение, не больше.
-
-ЭТАПЫ:
-1. Приветствие и помощь с выбором.
-2. Уточнение заказа (предложи комбо).
-3. Выдача реквизитов и просьба скинуть чек.
-
-КОГДА ЗАКАЗ СОБРАН (есть блюда, сумма, адрес, телефон):
-Вставь этот JSON (клиент его не увидит, он для системы):
-{{
-  "order_confirmed": true,
-  "customer_name": "Имя",
-  "phone": "Телефон",
-  "order_items": ["Товар 1", "Товар 2"],
-  "total_price": 5000,
-  "delivery_address": "Адрес"
-}}
-
-МЕНЮ:
-{menu_text}
-
-{payment_info}
-"""
-
-def clean_markdown(text):
-    """Удаляет markdown символы из текста"""
-    if not text:
-        return ""
-    # Удаляем жирный, курсив, код
-    text = re.sub(r'\*\*|__|\*|_|`', '', text)
-    # Удаляем заголовки
-    text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
-    return text.strip()
-
-# ======================== AI ДИАЛОГ ========================
-
-def get_ai_response(user_id, user_message):
-    """Получает ответ от AI с правильным форматом сообщений"""
-    conv = ensure_conversation(user_id)
-    
-    # Определяем язык, если еще не определен
-    if not conv.get("language"):
-        conv["language"] = detect_language(user_message)
-        save_conversations()
-    
-    # Формируем запрос к AI с правильным чередованием
-    system_prompt = get_system_prompt(conv["language"])
-    
-    # Собираем историю с правильным чередованием user/assistant
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    # Добавляем историю, убеждаясь что сообщения чередуются
-    history = conv["messages"][-10:]  # Последние 10 сообщений
-    
-    # Фильтруем и обеспечиваем правильное чередование
-    last_role = None
-    for msg in history:
-        role = msg.get("role")
-        # Пропускаем сообщения с одинаковой ролью подряд
-        if role in ["user", "assistant"] and role != last_role:
-            messages.append(msg)
-            last_role = role
-    
-    # Убеждаемся что последнее сообщение в истории - от assistant
-    # Если последнее от user, удаляем его чтобы избежать двух user подряд
-    if messages and messages[-1].get("role") == "user":
-        messages.pop()
-    
-    # Добавляем новое сообщение пользователя
-    messages.append({"role": "user", "content": user_message})
+# ======================== AIRTABLE ========================
+
+def airtable_url(record_id=None):
+    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
+    return f"{url}/{record_id}" if record_id else url
+
+def airtable_headers():
+    return {
+        "Authorization": f"Bearer {AIRTABLE_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+async def create_airtable_record(order_data):
+    """Создает запись заказа в Airtable"""
+    fields = {
+        "Customer_Info": f"{order_data.get('customer_name', 'Клиент')}, {order_data.get('phone', '')}",
+        "Order_Details": "\n".join(order_data.get('order_items', [])),
+        "Total_Price": int(order_data.get('total_price', 0)),
+        "Delivery_Address": order_data.get('delivery_address', ''),
+        "Is_Paid": False,
+        "Kitchen_Status": "Waiting",
+        "Payment_Receipt": order_data.get('payment_receipt', [])
+    }
     
     try:
-        response = perplexity_client.chat.completions.create(
-            model="sonar-pro",
-            messages=messages,
-            temperature=0.6,
-            max_tokens=600
-        )
-        
-        ai_reply = response.choices[0].message.content
-        print(f"🤖 AI Raw: {ai_reply[:50]}...") 
-        
-        # 1. Поиск JSON (заказа)
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', ai_reply, re.DOTALL)
-        if not json_match:
-             json_match = re.search(r'(\{[\s\S]*"order_confirmed"[\s\S]*?\})', ai_reply)
+        async with airtable_semaphore:
+            r = await http_client.async_request(
+                "POST", airtable_url(), endpoint="airtable.create", before_attempt=airtable_bucket.acquire,
+                headers=airtable_headers(), json={"fields": fields}
+            )
+        if r.status_code in [200, 201]:
+            record_id = r.json()['id']
+            print(f"✅ Запись создана в Airtable: {record_id}")
+            return record_id
+        print(f"❌ Ошибка Airtable: {r.status_code} - {r.text}")
+        return None
+    except Exception as e:
+        print(f"❌ Ошибка при создании записи: {e}")
+        return None
 
-        if json_match:
-            try:
-                json_str = json_match.group(1)
-                order_data = json.loads(json_str)
-                
-                if order_data.get("order_confirmed"):
-                    print("✅ Заказ распознан!")
-                    conv["pending_order"] = order_data
-                    conv["waiting_for_receipt"] = True
-                    save_conversations()
-                
-                # Убираем JSON из текста
-                if json_str in ai_reply:
-                    ai_reply = ai_reply.replace(json_str, '')
-                ai_reply = re.sub(r'```(?:json)?\s*```', '', ai_reply).strip()
-                    
-            except json.JSONDecodeError:
-                pass
-        
-        # 2. Очистка от Markdown и лишнего мусора
-        ai_reply = clean_markdown(ai_reply)
-        
-        # Сохраняем сообщения
-        conv["messages"].append({"role": "user", "content": user_message})
-        conv["messages"].append({"role": "assistant", "content": ai_reply})
-        conv["messages"] = conv["messages"][-20:]
-        save_conversations()
-        
-        return ai_reply
-        
+async def get_order_status(record_id):
+    """Возвращает статус оплаты и кухни для заказа"""
+    try:
+        async with airtable_semaphore:
+            r = await http_client.async_request(
+                "GET", airtable_url(record_id), endpoint="airtable.get", before_attempt=airtable_bucket.acquire,
+                headers=airtable_headers()
+            )
+        if r.status_code != 200:
+            print(f"❌ Ошибка получения статуса: {r.status_code}")
+            return None
+        status = status_from_fields(r.json().get('fields', {}))
+        order_statuses.put(record_id, status)
+        return status
+    except Exception as e:
+        print(f"❌ Ошибка получения статуса: {e}")
+        return None
+
+async def fetch_order_records(record_ids):
+    """Записи заказов по списку id: один list-запрос на RECORDS_PER_QUERY заказов"""
+    records = []
+    for i in range(0, len(record_ids), RECORDS_PER_QUERY):
+        params = {
+            "filterByFormula": record_ids_formula(record_ids[i:i + RECORDS_PER_QUERY]),
+            "fields[]": ["Is_Paid", "Kitchen_Status"],
+        }
+        while True:
+            async with airtable_semaphore:
+                r = await http_client.async_request(
+                    "GET", airtable_url(), endpoint="airtable.status_batch", before_attempt=airtable_bucket.acquire,
+                    headers=airtable_headers(), params=params
+                )
+            if r.status_code != 200:
+                print(f"❌ Ошибка пакетного запроса статусов: {r.status_code}")
+                return None
+            data = r.json()
+            records.extend(data.get("records", []))
+            if not data.get("offset"):
+                break
+            params["offset"] = data["offset"]
+    return records
+
+# ======================== TELEGRAM FILES ========================
+
+async def get_telegram_file_url(bot, file_id):
+    """Возвращает прямую ссылку на файл Telegram"""
+    try:
+        async with telegram_file_semaphore:
+            tg_file = await bot.get_file(file_id)
+        return tg_file.file_path
     except Exception as e:
-        print(f"❌ Ошибка AI: {e}")
-        return "Извините, ошибка связи. Повторите пожалуйста."
+        print(f"❌ Ошибка получения ссылки на файл: {e}")
+        return None
 
 # ======================== TELEGRAM HANDLERS ========================
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
-    conv = ensure_conversation(user_id)
+    ensure_conversation(user_id)
     
     user_language = update.effective_user.language_code
     if user_language and user_language.startswith('kk'):
-        conv["language"] = "kk"
+        language = "kk"
     elif user_language and user_language.startswith('en'):
-        conv["language"] = "en"
+        language = "en"
     else:
-        conv["language"] = "ru"
+        language = "ru"
     
-    conv["user_name"] = update.effective_user.first_name or ""
-    save_conversations()
+    user_name = update.effective_user.first_name or ""
+    # conv — снимок до update (copy-on-write), поэтому текст строим из новых значений
+    conversations.update(user_id, language=language, user_name=user_name)
     
     welcome_messages = {
-        "ru": f"Привет, {conv['user_name']}! 😊\n\nКакой чудесный день! Я помогу оформить вкусный заказ 🍔\nЧто хотите заказать?",
-        "kk": f"Сәлем, {conv['user_name']}! 😊\n\nҚандай керемет күн! Мен дәмді тапсырысты ресімдеуге көмектесемін 🍔\nНе тапсырыс бергіңіз келеді?",
-        "en": f"Hello, {conv['user_name']}! 😊\n\nWhat a wonderful day! I'll help you order something delicious 🍔\nWhat would you like to order?"
+        "ru": f"Привет, {user_name}! 😊\n\nКакой чудесный день! Я помогу оформить вкусный заказ 🍔\nЧто хотите заказать?",
+        "kk": f"Сәлем, {user_name}! 😊\n\nҚандай керемет күн! Мен дәмді тапсырысты ресімдеуге көмектесемін 🍔\nНе тапсырыс бергіңіз келеді?",
+        "en": f"Hello, {user_name}! 😊\n\nWhat a wonderful day! I'll help you order something delicious 🍔\nWhat would you like to order?"
     }
     
-    await update.message.reply_text(welcome_messages.get(conv["language"], welcome_messages["ru"]))
+    await update.message.reply_text(welcome_messages[language])
 
-async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /status для проверки статуса заказа"""
-    user_id = str(update.effective_user.id)
-    conv = conversations.get(user_id)
+async def order_status_text(user_id):
+    """Текст статуса заказа для /status и вопросов «где мой заказ».
+    
+    Статус берется из кэша, если он свежее ORDER_STATUS_MAX_AGE, иначе
+    запрашивается из Airtable.
+    """
+    conv = conversations.get(str(user_id))
     
     if not conv:
-        await update.message.reply_text("У вас пока нет заказов 🤷‍♂️")
-        return
+        return order_status_reply("ru", "none")
     
+    language = conv.get("language") or "ru"
     record_id = conv.get("airtable_record_id")
     
     if not record_id:
-        if conv.get("waiting_for_receipt"):
-            await update.message.reply_text(
-                "⏳ Ожидаем чек оплаты\n\n"
-                "Пришлите фото или PDF чека, чтобы мы начали готовить ваш заказ 📸"
-            )
-        else:
-            await update.message.reply_text("У вас пока нет активных заказов 🤷‍♂️")
-        return
+        return order_status_reply(language, telegram_engine.receipt if conv.get("waiting_for_receipt") else "none")
     
-    # Получаем статус из Airtable
-    status = get_order_status(record_id)
+    status = order_statuses.get(record_id, ORDER_STATUS_MAX_AGE)
+    if status is None:
+        status = await get_order_status(record_id)
     
     if not status:
-        await update.message.reply_text("❌ Не удалось проверить статус заказа")
-        return
-    
-    # Формируем ответ
-    lang = conv.get("language", "ru")
+        return order_status_reply(language, "error")
     
-    if status['payment_correct']:
-        if status['kitchen_status'] == 'Cooking':
-            messages = {
-                "ru": "✅ Оплата принята!\n👨‍🍳 Ваш заказ готовится на кухне\n\nСкоро доставим! 🚀",
-                "kk": "✅ Төлем қабылданды!\n👨‍🍳 Тапсырысыңыз асханада дайындалуда\n\nЖақын арада жеткіземіз! 🚀",
-                "en": "✅ Payment accepted!\n👨‍🍳 Your order is being prepared\n\nWe'll deliver soon! 🚀"
-            }
-        elif status['kitchen_status'] == 'Ready':
-            messages = {
-                "ru": "✅ Заказ готов!\n🚗 Курьер уже в пути к вам!",
-                "kk": "✅ Тапсырыс дайын!\n🚗 Курьер сізге қарай жолда!",
-                "en": "✅ Order is ready!\n🚗 Courier is on the way!"
-            }
-        else:
-            messages = {
-                "ru": "✅ Оплата принята!\n⏳ Заказ в обработке",
-                "kk": "✅ Төлем қабылданды!\n⏳ Тапсырыс өңделуде",
-                "en": "✅ Payment accepted!\n⏳ Order is being processed"
-            }
-        
-        await update.message.reply_text(messages.get(lang, messages["ru"]))
-    else:
-        # Оплата не принята менеджером
-        messages = {
-            "ru": "⏳ Чек на проверке у менеджера\n\n"
-                  "Если есть проблемы с оплатой, менеджер свяжется с вами.\n"
-                  "Обычно проверка занимает 5-10 минут ⏱",
-            "kk": "⏳ Чек менеджерде тексерілуде\n\n"
-                  "Егер төлеммен проблема болса, менеджер сізбен байланысады.\n"
-                  "Әдетте тексеру 5-10 минут алады ⏱",
-            "en": "⏳ Receipt is being checked by manager\n\n"
-                  "If there are payment issues, manager will contact you.\n"
-                  "Usually takes 5-10 minutes ⏱"
-        }
-        
-        await update.message.reply_text(messages.get(lang, messages["ru"]))
+    return paid_status_reply(language, status['payment_correct'], status['kitchen_status'])
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /status для проверки статуса заказа"""
+    await update.message.reply_text(await order_status_text(update.effective_user.id))
+
+async def local_reply(user_id, user_message):
+    """Ответ по шаблону для служебных сообщений или None, если нужен AI"""
+    routed = telegram_engine.route(user_id, user_message)
+    if routed is None:
+        return None
+    intent, language, items = routed
+    if intent == INTENT_STATUS:
+        return await order_status_text(user_id)
+    return telegram_engine.template_reply(intent, language, items)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
-    user_id = update.effective_user.id
-    user_message = update.message.text
+    """Обработчик текстовых сообщений: копит серию сообщений чата в один ход"""
+    message_coalescer.submit(update.effective_user.id, update.message.text, update)
+
+async def process_text_turn(user_id, user_message, update, turn):
+    """Один ход диалога по склеенным сообщениям клиента.
+
+    До turn.commit() ход может быть отменен новым сообщением — тогда в
+    истории не остается ни вопроса, ни ответа и все сообщения уходят в
+    следующий ход.
+    """
+    # Служебные сообщения — сразу по шаблону, без AI
+    reply = await local_reply(user_id, user_message)
+    if reply is not None:
+        turn.commit()
+        print(f"⚡ {user_id}: ответ без AI")
+        telegram_engine.remember_turn(user_id, user_message, reply)
+        await update.message.reply_text(reply)
+        return
+    
+    # Типовой вопрос вне оформления заказа — ответ из кэша
+    cache_key = telegram_engine.cache_key(user_id, user_message)
+    cached = telegram_engine.cached_reply(user_id, user_message, cache_key)
+    if cached is not None:
+        turn.commit()
+        await update.message.reply_text(cached)
+        return
     
     # Показываем "печатает..."
     await update.message.chat.send_action("typing")
     
-    # Получаем ответ от AI
-    ai_response = get_ai_response(user_id, user_message)
+    if AI_STREAMING and not ORDER_STRUCTURED_OUTPUT:
+        await reply_streaming(update, user_id, user_message, turn, cache_key)
+        return
+    
+    # Получаем ответ от AI (ход сохраняется в истории внутри, до следующего await)
+    ai_response = await telegram_engine.respond_async(user_id, user_message, cache_key)
+    turn.commit()
     
-    await update.message.reply_text(ai_response)
+    # Пустой ответ (например, только JSON заказа) Telegram отправить не даст
+    await update.message.reply_text(ai_response or ERROR_REPLY)
+
+message_coalescer = MessageCoalescer(process_text_turn, MESSAGE_QUIET_WINDOW, MESSAGE_MAX_WAIT)
+
+async def reply_streaming(update, user_id, user_message, turn, cache_key=None):
+    """Показывает ответ по мере генерации, редактируя одно сообщение"""
+    placeholder = await update.message.reply_text("⏳")
+    shown = {"text": "", "at": 0.0}
+    
+    async def edit(text):
+        if not text or text == shown["text"]:
+            return
+        try:
+            await placeholder.edit_text(text)
+            shown["text"] = text
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить сообщение: {e}")
+    
+    async def on_text(text):
+        # Telegram ограничивает частоту правок, поэтому не чаще STREAM_EDIT_INTERVAL
+        now = time.monotonic()
+        if now - shown["at"] >= STREAM_EDIT_INTERVAL:
+            shown["at"] = now
+            await edit(text)
+    
+    try:
+        final_text = await telegram_engine.stream_async(user_id, user_message, on_text, cache_key)
+    except asyncio.CancelledError:
+        # Клиент дописал сообщение — недописанный ответ убираем, будет новый
+        try:
+            await placeholder.delete()
+        except Exception as e:
+            print(f"⚠️ Не удалось удалить сообщение: {e}")
+        raise
+    turn.commit()
+    # Пустой итог не должен оставить клиенту висящий "⏳"
+    await edit(final_text or ERROR_REPLY)
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик документов (чеков в PDF)"""
@@ -501,25 +373,29 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if conv.get("pending_order"):
         # Сохраняем file_id для отправки на кухню
-        conv["pending_order"]["receipt_file_id"] = file_id
-        conv["pending_order"]["receipt_type"] = "document"
+        pending_order = dict(conv["pending_order"], receipt_file_id=file_id, receipt_type="document")
         
         # Получаем URL файла для Airtable (опционально)
-        file_url = get_telegram_file_url(file_id)
+        file_url = await get_telegram_file_url(context.bot, file_id)
         if file_url:
-            conv["pending_order"]["payment_receipt"] = [{"url": file_url}]
+            pending_order["payment_receipt"] = [{"url": file_url}]
+        conversations.update(user_id, pending_order=pending_order)
         
         # СОЗДАЕМ запись в Airtable ТОЛЬКО СЕЙЧАС
-        record_id = create_airtable_record(conv["pending_order"])
+        record_id = await create_airtable_record(pending_order)
         
         if record_id:
-            conv["waiting_for_receipt"] = False
-            conv["order_placed"] = True
-            conv["airtable_record_id"] = record_id
-            conv["receipt_file_id"] = file_id
-            conv["receipt_type"] = "document"
-            conv["pending_order"] = None
-            save_conversations()
+            conversations.update(
+                user_id,
+                waiting_for_receipt=False,
+                order_placed=True,
+                airtable_record_id=record_id,
+                order_closed=False,
+                receipt_file_id=file_id,
+                receipt_type="document",
+                pending_order=None
+            )
+            order_statuses.track(record_id, user_id)
             
             success_messages = {
                 "ru": "✅ Чек получен и сохранен!\n\n"
@@ -576,25 +452,29 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if conv.get("pending_order"):
         # Сохраняем file_id для отправки на кухню
-        conv["pending_order"]["receipt_file_id"] = file_id
-        conv["pending_order"]["receipt_type"] = "photo"
+        pending_order = dict(conv["pending_order"], receipt_file_id=file_id, receipt_type="photo")
         
         # Получаем URL файла для Airtable (опционально)
-        file_url = get_telegram_file_url(file_id)
+        file_url = await get_telegram_file_url(context.bot, file_id)
         if file_url:
-            conv["pending_order"]["payment_receipt"] = [{"url": file_url}]
+            pending_order["payment_receipt"] = [{"url": file_url}]
+        conversations.update(user_id, pending_order=pending_order)
         
         # СОЗДАЕМ запись в Airtable ТОЛЬКО СЕЙЧАС
-        record_id = create_airtable_record(conv["pending_order"])
+        record_id = await create_airtable_record(pending_order)
         
         if record_id:
-            conv["waiting_for_receipt"] = False
-            conv["order_placed"] = True
-            conv["airtable_record_id"] = record_id
-            conv["receipt_file_id"] = file_id
-            conv["receipt_type"] = "photo"
-            conv["pending_order"] = None
-            save_conversations()
+            conversations.update(
+                user_id,
+                waiting_for_receipt=False,
+                order_placed=True,
+                airtable_record_id=record_id,
+                order_closed=False,
+                receipt_file_id=file_id,
+                receipt_type="photo",
+                pending_order=None
+            )
+            order_statuses.track(record_id, user_id)
             
             success_messages = {
                 "ru": "✅ Чек получен и сохранен!\n\n"
@@ -627,48 +507,79 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
         await update.message.reply_text(error_messages.get(conv.get("language", "ru"), error_messages["ru"]))
 
-# ======================== ФОНОВАЯ ПРОВЕРКА ========================
-# ======================== ЧЕК ОПЛАЧЕННЫХ ЗАКАЗОВ ========================
+# ======================== ФОНОВАЯ СИНХРОНИЗАЦИЯ СТАТУСОВ ========================
 
-def check_paid_orders():
-    """
-    Проверяет оплату заказов.
-    Пока заглушка: выводит в консоль. 
-    Здесь должна быть логика проверки Airtable.
-    """
-    print("🔍 Проверка оплаченных заказов...")
+async def refresh_order_statuses(bot):
+    """Обновляет кэш статусов всех отслеживаемых заказов и уведомляет клиентов"""
+    record_ids = order_statuses.tracked()
+    if not record_ids:
+        return
+    records = await fetch_order_records(record_ids)
+    if records is None:
+        return
     
-    # Пример: помечаем все pending_order как оплаченные
-    for user_id, conv in conversations.items():
-        if conv.get("pending_order"):
-            print(f"Пользователь {user_id} имеет pending_order")
+    for record_id, previous, status in order_statuses.apply(records):
+        chat_id = order_statuses.owner(record_id)
+        kitchen_status = status['kitchen_status']
+        if status['payment_correct'] and kitchen_status in FINAL_STATUSES:
+            order_statuses.untrack(record_id)
+            owner_conv = conversations.get(str(chat_id)) if chat_id is not None else None
+            if owner_conv and owner_conv.get("airtable_record_id") == record_id:
+                # Закрытый заказ не отслеживается и после перезапуска
+                conversations.update(chat_id, order_closed=True)
+        # Первое чтение после запуска — не повод для уведомления
+        if not ORDER_STATUS_PUSH or previous is None or chat_id is None:
+            continue
+        if kitchen_status in ("Cooking", "Ready") and kitchen_status != previous['kitchen_status']:
+            conv = conversations.get(str(chat_id)) or {}
+            try:
+                await bot.send_message(chat_id, paid_status_reply(conv.get("language") or "ru", status['payment_correct'], kitchen_status))
+                print(f"🔔 {chat_id}: статус заказа {record_id} -> {kitchen_status}")
+            except Exception as e:
+                print(f"⚠️ Не удалось уведомить {chat_id}: {e}")
 
-def background_checker():
-    """Проверяет оплаченные заказы каждые 15 секунд"""
+async def background_checker(app):
+    """Раз в ORDER_STATUS_REFRESH секунд обновляет статусы одним пакетным запросом"""
     while True:
         try:
-            check_paid_orders()
-            time.sleep(15)
+            await refresh_order_statuses(app.bot)
         except Exception as e:
             print(f"Ошибка чекера: {e}")
-            time.sleep(15)
+        await asyncio.sleep(ORDER_STATUS_REFRESH)
+
+def track_open_orders():
+    """После запуска — отслеживаем незакрытые заказы (запрос к хранилищу, без полного прохода)"""
+    for chat_id, record_id in conversations.open_orders():
+        order_statuses.track(record_id, chat_id)
+
+async def start_background_tasks(app):
+    asyncio.create_task(background_checker(app))
+    print("✅ Фоновая синхронизация статусов запущена")
 
 # ======================== ЗАПУСК БОТА ========================
 
-def main():
-    """Главная функция"""
+def main(extra_metrics=()):
+    """Главная функция; extra_metrics — метрики других каналов процесса (main.py)"""
     print("🚀 Telegram бот запущен")
     print(f"📊 Airtable: {AIRTABLE_BASE_ID}")
     print(f"👨‍🍳 Сотрудников: {len(KITCHEN_STAFF_IDS)}")
     print("━" * 50)
     
     load_conversations()
+    print(f"💾 Диалогов загружено: {len(conversations)}")
+    start_flusher(conversations)
+    start_metrics_reporter([http_client.http_metrics, response_cache, message_coalescer, *extra_metrics], interval=int(os.getenv("METRICS_INTERVAL", "60")))
     
-    checker_thread = threading.Thread(target=background_checker, daemon=True)
-    checker_thread.start()
-    print("✅ Фоновый чекер запущен")
+    track_open_orders()
     
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Обновления обрабатываются параллельно: один долгий ответ AI не блокирует остальных клиентов
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+        .post_init(start_background_tasks)
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("status", status_command))
@@ -678,6 +589,7 @@ def main():
     
     print("🤖 Бот готов к работе!")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
+    conversations.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,218 @@
+import time
+import threading
+from concurrent.futures import Future
+
+import http_client
+
+# ======================== AIRTABLE: ЛИМИТЫ И ПАКЕТНАЯ ЗАПИСЬ ========================
+#
+# Airtable пускает не больше 5 запросов в секунду на базу и принимает до
+# 10 записей в одном create/update. Все запросы к базе проходят через
+# общий token bucket, а записи копятся короткое окно и уходят пачками.
+# Вызывающий код сразу получает Future с id записи (или True для patch).
+#
+# Create — это POST: его повторяем, только если Airtable точно его не
+# выполнил (429/503 или соединение не установлено), как и http_client.
+# Иначе повтор создал бы второй оплаченный заказ. Пока create ждет в
+# очереди, вызывающий код может отменить Future — тогда запрос не уйдет.
+
+AIRTABLE_BATCH_SIZE = 10
+
+
+class AirtableWriter:
+    """Фоновая очередь create/patch с пакетами по 10 записей"""
+
+    def __init__(self, base_id, table_name, api_key, bucket, window=0.2, max_attempts=5):
+        self.url = f"https://api.airtable.com/v0/{base_id}/{table_name}"
+        self.api_key = api_key
+        self.bucket = bucket
+        self.window = window
+        self.max_attempts = max_attempts
+        self.items = []
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+        return self
+
+    def create(self, fields):
+        """Future -> id новой записи или None при ошибке"""
+        return self._enqueue("create", None, fields)
+
+    def update(self, record_id, fields):
+        """Future -> True/False"""
+        return self._enqueue("update", record_id, fields)
+
+    def pending(self):
+        with self.cond:
+            return len(self.items)
+
+    def _enqueue(self, kind, record_id, fields):
+        future = Future()
+        item = {
+            "kind": kind,
+            "record_id": record_id,
+            "fields": dict(fields),
+            "futures": [future],
+            "attempts": 0,
+            "not_before": 0.0,
+            "solo": False,
+            "running": False,
+        }
+        with self.cond:
+            self.items.append(item)
+            self.cond.notify()
+        self.start()
+        return future
+
+    def _take_batch(self):
+        """Ждет записи, дает окну набраться и забирает пачку одного типа"""
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+        time.sleep(self.window)
+
+        with self.cond:
+            now = time.monotonic()
+            ready = [item for item in self.items if item["not_before"] <= now]
+            if not ready:
+                delay = min(item["not_before"] for item in self.items) - now
+                self.cond.wait(timeout=max(delay, 0.05))
+                return []
+
+            first = ready[0]
+            if first["solo"]:
+                batch = [first]
+            else:
+                batch = []
+                by_record = {}
+                for item in ready:
+                    if item["kind"] != first["kind"] or item["solo"]:
+                        continue
+                    if item["kind"] == "update" and item["record_id"] in by_record:
+                        # Две правки одной записи сливаются в одну
+                        merged = by_record[item["record_id"]]
+                        merged["fields"].update(item["fields"])
+                        merged["futures"].extend(item["futures"])
+                        self.items.remove(item)
+                        continue
+                    if len(batch) >= AIRTABLE_BATCH_SIZE:
+                        continue
+                    batch.append(item)
+                    if item["kind"] == "update":
+                        by_record[item["record_id"]] = item
+            for item in batch:
+                self.items.remove(item)
+            if first["kind"] == "create":
+                batch = [item for item in batch if self._start(item)]
+            return batch
+
+    def _start(self, item):
+        """Create уходит в первый раз: False, если вызывающий код успел его отменить"""
+        if item["running"]:
+            return True
+        item["running"] = True
+        return item["futures"][0].set_running_or_notify_cancel()
+
+    def _loop(self):
+        while True:
+            try:
+                batch = self._take_batch()
+                if batch:
+                    self._send(batch)
+            except Exception as e:
+                print(f"❌ Ошибка очереди Airtable: {e}")
+                time.sleep(1)
+
+    def _send(self, batch):
+        kind = batch[0]["kind"]
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        if kind == "create":
+            payload = {"records": [{"fields": item["fields"]} for item in batch]}
+        else:
+            payload = {"records": [{"id": item["record_id"], "fields": item["fields"]} for item in batch]}
+
+        try:
+            # Токен берется на каждую попытку, включая внутренние повторы http_client на 429/503
+            if kind == "create":
+                r = http_client.post(self.url, endpoint="airtable.batch_create", json=payload, headers=headers,
+                                     before_attempt=self.bucket.acquire)
+            else:
+                r = http_client.patch(self.url, endpoint="airtable.batch_update", json=payload, headers=headers,
+                                      before_attempt=self.bucket.acquire)
+        except Exception as e:
+            print(f"❌ Ошибка пакетной записи Airtable: {e}")
+            if kind == "create" and not http_client.connect_failed(e):
+                # Запрос мог дойти и выполниться — повтор создал бы дубль
+                self._fail(batch)
+            else:
+                self._retry(batch)
+            return
+
+        if r.status_code == 200:
+            records = r.json().get("records", [])
+            for item, record in zip(batch, records):
+                result = record.get("id") if kind == "create" else True
+                for future in item["futures"]:
+                    future.set_result(result)
+            print(f"✅ Airtable: {kind} x{len(batch)} одним запросом")
+            return
+
+        if http_client.should_retry_status(r.status_code, idempotent=kind != "create"):
+            print(f"⚠️ Airtable {r.status_code}, пачка будет отправлена повторно")
+            self._retry(batch)
+        elif kind == "create" and r.status_code >= 500:
+            print(f"❌ Airtable {r.status_code} на create: результат неизвестен, повтор не делаем")
+            self._fail(batch)
+        elif len(batch) > 1:
+            # Одна плохая запись валит весь пакет — отправляем по одной
+            print(f"⚠️ Airtable {r.status_code} на пакете, отправляю записи по отдельности")
+            for item in batch:
+                item["solo"] = True
+            self._requeue(batch)
+        else:
+            print(f"❌ Ошибка Airtable: {r.status_code} - {r.text}")
+            self._fail(batch)
+
+    def _retry(self, batch):
+        retry_at = []
+        for item in batch:
+            item["attempts"] += 1
+            if item["attempts"] >= self.max_attempts:
+                self._fail([item])
+            else:
+                item["not_before"] = time.monotonic() + http_client.retry_delay(item["attempts"])
+                retry_at.append(item)
+        self._requeue(retry_at)
+
+    def _requeue(self, batch):
+        if not batch:
+            return
+        with self.cond:
+            front = []
+            for item in batch:
+                newer = None
+                if item["kind"] == "update":
+                    newer = next((pending for pending in self.items if pending["kind"] == "update"
+                                  and pending["record_id"] == item["record_id"]), None)
+                if newer is None:
+                    front.append(item)
+                    continue
+                # Повтор не должен затереть более новую правку той же записи: сливаем, новые поля важнее
+                newer["fields"] = dict(item["fields"], **newer["fields"])
+                newer["futures"] = item["futures"] + newer["futures"]
+                newer["solo"] = newer["solo"] or item["solo"]
+            self.items[0:0] = front
+            self.cond.notify()
+
+    def _fail(self, batch):
+        for item in batch:
+            result = None if item["kind"] == "create" else False
+            for future in item["futures"]:
+                future.set_result(result)
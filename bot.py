@@ -1,39 +1,43 @@
-from openai import OpenAI
-import requests
-import json
+import http_client
+from airtable_client import AirtableWriter
+from rate_limit import shared_bucket
+from kitchen_outbox import KitchenOutbox, STATE_PENDING
+from telegram_sender import TelegramSender
+import dropbox_client
+from receipt_index import ReceiptIndex
+from reminder_scheduler import ReminderScheduler
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
 import os
+import html
+import secrets
+import signal
 import threading
 import time
-import re
 from dotenv import load_dotenv
+from conversation_store import open_store, start_flusher
+from chat_workers import ChatWorkerPool, start_metrics_reporter
+from webhook_server import start_webhook_server
+from sharding import (
+    shard_for, shard_path, existing_shards, FileLock, LeaderElection, ActivitySignal, ShardRouter, WorkerProcesses
+)
+from dedup_index import RecentIdIndex
+from intent_router import INTENT_STATUS
+from order_engine import OrderEngine, response_cache, order_status_reply, paid_status_reply
 
 load_dotenv()
 
 LAUNCH_TIMESTAMP = int(time.time())
 CONVERSATIONS_FILE = "conversations.json"
-
-def load_conversations():
-    if os.path.exists(CONVERSATIONS_FILE):
-        try:
-            with open(CONVERSATIONS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"⚠️ Ошибка загрузки диалогов: {e}")
-    return {}
-
-def save_conversations(data):
-    try:
-        with open(data/CONVERSATIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения диалогов: {e}")
+PROCESSED_MESSAGES_FILE = "processed_messages.json"
+KITCHEN_OUTBOX_FILE = os.getenv("KITCHEN_OUTBOX_FILE", "kitchen_outbox.db")
+RECEIPT_INDEX_FILE = os.getenv("RECEIPT_INDEX_FILE", "receipt_index.json")
+PAYMENT_REMINDERS_FILE = os.getenv("PAYMENT_REMINDERS_FILE", "payment_reminders.json")
 
 # ======================== КОНФИГУРАЦИЯ ========================
 
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 WHATSAPP_PHONE_ID = os.getenv("WHATSAPP_PHONE_ID")
-PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
 AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
 AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
 AIRTABLE_TABLE_NAME = os.getenv("AIRTABLE_TABLE_NAME", "Orders")
@@ -44,240 +48,190 @@ DROPBOX_ACCESS_TOKEN = os.getenv("DROPBOX_ACCESS_TOKEN")
 KITCHEN_STAFF_IDS = os.getenv("KITCHEN_STAFF_IDS", "").split(",")
 KITCHEN_STAFF_IDS = [id.strip() for id in KITCHEN_STAFF_IDS if id.strip()]
 
-# ======================== МЕНЮ ФАСТ-ФУДА ========================
-
-MENU = {
-    "Бургеры": [
-        {"name": "Классический бургер", "price": 1500, "desc": "Говядина, салат, помидор, сыр"},
-        {"name": "Чизбургер", "price": 1800, "desc": "Двойной сыр, говядина, соус"},
-        {"name": "Курица бургер", "price": 1600, "desc": "Куриная котлета, салат, майонез"}
-    ],
-    "Пицца": [
-        {"name": "Маргарита", "price": 2500, "desc": "Томаты, моцарелла, базилик"},
-        {"name": "Пепперони", "price": 3000, "desc": "Колбаса пепперони, сыр"},
-        {"name": "4 сыра", "price": 3200, "desc": "Моцарелла, чеддер, пармезан, дор блю"}
-    ],
-    "Напитки": [
-        {"name": "Кола", "price": 500, "desc": "0.5л"},
-        {"name": "Фанта", "price": 500, "desc": "0.5л"},
-        {"name": "Сок", "price": 600, "desc": "0.5л апельсиновый"}
-    ],
-    "Допы": [
-        {"name": "Картофель фри", "price": 800, "desc": "Средняя порция"},
-        {"name": "Наггетсы", "price": 1200, "desc": "6 шт"},
-        {"name": "Соусы", "price": 200, "desc": "Кетчуп, майонез, сырный"}
-    ]
-}
-
-KASPI_PAYMENT_INFO = """
-💳 ОПЛАТА ЧЕРЕЗ KASPI:
-Номер: +7 777 123 4567
-Получатель: ТОО "Доставка"
-После оплаты пришлите скриншот чека
-"""
-
-# ======================== SYSTEM PROMPT ========================
-
-def generate_menu_text():
-    menu_text = ""
-    for category, items in MENU.items():
-        menu_text += f"\n{category}:\n"
-        for item in items:
-            menu_text += f"- {item['name']}: {item['price']}₸ ({item['desc']})\n"
-    return menu_text
-
-SYSTEM_PROMPT = f"""
-Ты — AI-продавец службы доставки фаст-фуда через WhatsApp.
-
-ТВОЯ ЦЕЛЬ — ПРИНЯТЬ И ОФОРМИТЬ ЗАКАЗ.
-
-ПРАВИЛА ОБЩЕНИЯ:
-- Автоматически определяй язык клиента (русский/казахский)
-- Общайся ТОЛЬКО на одном языке, не смешивай
-- Будь вежливым, но говори как обычный человек, не как робот
-- Не используй markdown форматирование (жирный, курсив и т.д.), пиши просто текст
-- Никогда не обсуждай политику или посторонние темы
-- Работаешь только с заказами еды
-
-СЦЕНАРИЙ ПРОДАЖ:
-
-1. ПРИВЕТСТВИЕ
-- Просто поздоровайся. Не предлагай сразу меню или помощь, если клиент сам не спросил.
-- Пример: "Здравствуйте!", "Привет! Чем могу помочь?"
-
-2. КОНСУЛЬТАЦИЯ
-- Помоги выбрать блюда
-- Отвечай на вопросы о меню
-- Предлагай допы и напитки (ненавязчиво)
-
-3. СБОР ЗАКАЗА
-- Уточни состав заказа
-- Посчитай общую сумму
-- Спроси адрес доставки
-- Запроси номер телефона для связи
-
-4. ОПЛАТА
-- Предоставь реквизиты Kaspi
-- Попроси прислать официальный чек в формате PDF
-- Скажи, что заказ будет передан на кухню ТОЛЬКО после получения чека
-
-5. ПОДТВЕРЖДЕНИЕ
-После получения ВСЕХ данных (заказ, адрес, телефон) выдай JSON:
-
-```json
-{{
-  "order_confirmed": true,
-  "customer_name": "имя клиента",
-  "phone": "+7...",
-  "order_items": ["Бургер x2", "Кола x1"],
-  "total_price": 3500,
-  "delivery_address": "полный адрес"
-}}
-```
-
-JSON выводи ТОЛЬКО когда:
-- Клиент подтвердил заказ
-- Указал адрес
-- Указал телефон
-- Готов оплатить
-
-НАШЕ МЕНЮ:
-{generate_menu_text()}
-
-{KASPI_PAYMENT_INFO}
-
-UP-SELL ПРИМЕРЫ:
-- "К бургеру добавить картофель фри?"
-- "Возьмете напиток?"
-- "Соусы нужны?"
-
-Не отпускай клиента без оформления заказа.
-"""
+# Кому сообщать о заказах, которые не удалось довести до кухни (по умолчанию — кухне)
+KITCHEN_ALERT_CHAT_IDS = [id.strip() for id in os.getenv("KITCHEN_ALERT_CHAT_IDS", "").split(",") if id.strip()]
+KITCHEN_ALERT_CHAT_IDS = KITCHEN_ALERT_CHAT_IDS or KITCHEN_STAFF_IDS
+
+# Сколько чатов обрабатывается одновременно (каждый чат — строго по очереди)
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", "8"))
+METRICS_INTERVAL = int(os.getenv("METRICS_INTERVAL", "60"))
+
+# Шлюз WhatsApp (можно указать локальный фейковый шлюз для тестов)
+WHATSAPP_API_URL = os.getenv("WHATSAPP_API_URL", "https://gate.whapi.cloud").rstrip("/")
+
+# Режим приема сообщений: poll (опрос списка) или webhook (+ редкий опрос как страховка)
+WHATSAPP_MODE = os.getenv("WHATSAPP_MODE", "poll").lower()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # обязателен в режиме webhook
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "3"))
+WEBHOOK_FALLBACK_POLL_INTERVAL = float(os.getenv("WEBHOOK_FALLBACK_POLL_INTERVAL", "60"))
+POLL_PAGE_SIZE = int(os.getenv("POLL_PAGE_SIZE", "100"))
+POLL_MAX_PAGES = int(os.getenv("POLL_MAX_PAGES", "10"))
+
+# Окно дедупликации входящих сообщений
+DEDUP_CAPACITY = int(os.getenv("DEDUP_CAPACITY", "50000"))
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "172800"))  # 48 часов
+
+# Лимит Airtable: 5 запросов/сек на базу; записи копятся окно и уходят пачками по 10
+AIRTABLE_RATE_LIMIT = float(os.getenv("AIRTABLE_RATE_LIMIT", "5"))
+AIRTABLE_BATCH_WINDOW = float(os.getenv("AIRTABLE_BATCH_WINDOW", "0.2"))
+AIRTABLE_WRITE_TIMEOUT = float(os.getenv("AIRTABLE_WRITE_TIMEOUT", "120"))
+
+# Инкрементальная проверка оплаченных заказов с адаптивным интервалом
+ORDERS_POLL_MIN = float(os.getenv("ORDERS_POLL_MIN", "2"))
+ORDERS_POLL_ACTIVE_MAX = float(os.getenv("ORDERS_POLL_ACTIVE_MAX", "10"))
+ORDERS_POLL_MAX = float(os.getenv("ORDERS_POLL_MAX", "60"))
+ORDERS_ACTIVE_WINDOW = float(os.getenv("ORDERS_ACTIVE_WINDOW", "1800"))
+ORDERS_SYNC_OVERLAP = float(os.getenv("ORDERS_SYNC_OVERLAP", "60"))
+ORDERS_FULL_SYNC_EVERY = float(os.getenv("ORDERS_FULL_SYNC_EVERY", "600"))
+
+# Outbox кухни: сколько раз пытаться и сколько хранить выполненные записи
+KITCHEN_MAX_ATTEMPTS = int(os.getenv("KITCHEN_MAX_ATTEMPTS", "10"))
+KITCHEN_OUTBOX_RETENTION = float(os.getenv("KITCHEN_OUTBOX_RETENTION", str(7 * 86400)))
+
+# Рассылка на кухню: параллельно, в пределах лимитов Telegram (всего и на чат, сообщений/сек)
+KITCHEN_FANOUT_WORKERS = int(os.getenv("KITCHEN_FANOUT_WORKERS", "8"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+
+# Чеки переносятся в Dropbox потоком, кусками этого размера (байт)
+DROPBOX_CHUNK_SIZE = int(os.getenv("DROPBOX_CHUNK_SIZE", str(4 * 1024 * 1024)))
+
+# Напоминания об оплате: через сколько минут после подтверждения заказа
+PAYMENT_REMINDER_MINUTES = [float(m) for m in os.getenv("PAYMENT_REMINDER_MINUTES", "15,45").split(",") if m.strip()]
+
+# Шардирование: SHARD_COUNT > 1 — диспетчер и N процессов-воркеров (чат -> воркер по crc32)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if os.getenv("SHARD_INDEX") else None
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8100"))
+SHARD_CHECK_INTERVAL = float(os.getenv("SHARD_CHECK_INTERVAL", "5"))
+SHARD_READY_TIMEOUT = float(os.getenv("SHARD_READY_TIMEOUT", "60"))
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", "bot.leader.lock")
+ORDERS_ACTIVITY_FILE = LEADER_LOCK_FILE + ".activity"
+IS_DISPATCHER = SHARD_COUNT > 1 and SHARD_INDEX is None
+
+if SHARD_INDEX is not None:
+    # Воркер владеет только своим срезом состояния
+    CONVERSATIONS_FILE = shard_path(CONVERSATIONS_FILE, SHARD_INDEX)
+    PROCESSED_MESSAGES_FILE = shard_path(PROCESSED_MESSAGES_FILE, SHARD_INDEX)
+    PAYMENT_REMINDERS_FILE = shard_path(PAYMENT_REMINDERS_FILE, SHARD_INDEX)
+if SHARD_COUNT > 1:
+    # Лимиты внешних API общие на все процессы — делим поровну
+    AIRTABLE_RATE_LIMIT /= SHARD_COUNT
+    TELEGRAM_GLOBAL_RATE /= SHARD_COUNT
+
+if IS_DISPATCHER:
+    # Диспетчер только пересылает сообщения: диалоги, индексы и outbox открывают воркеры
+    conversations = processed_messages = receipt_index = payment_reminders = kitchen_outbox = None
+else:
+    conversations = open_store(CONVERSATIONS_FILE)
+    processed_messages = RecentIdIndex(PROCESSED_MESSAGES_FILE, capacity=DEDUP_CAPACITY, ttl=DEDUP_TTL).load()
+    receipt_index = ReceiptIndex(
+        RECEIPT_INDEX_FILE, file_lock=FileLock(RECEIPT_INDEX_FILE + ".lock") if SHARD_COUNT > 1 else None
+    ).load()
+    payment_reminders = ReminderScheduler(PAYMENT_REMINDERS_FILE).load()
+    kitchen_outbox = KitchenOutbox(
+        KITCHEN_OUTBOX_FILE, max_attempts=KITCHEN_MAX_ATTEMPTS, retention=KITCHEN_OUTBOX_RETENTION
+    )
+chat_pool = ChatWorkerPool(max_workers=CHAT_WORKERS, name="whatsapp")
+# Один bucket Airtable на процесс: в main.py его делит Telegram-бот
+airtable_bucket = shared_bucket("airtable", AIRTABLE_RATE_LIMIT)
+telegram_sender = TelegramSender(
+    TELEGRAM_BOT_TOKEN, max_workers=KITCHEN_FANOUT_WORKERS,
+    global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE
+)
+airtable_writer = AirtableWriter(
+    AIRTABLE_BASE_ID, AIRTABLE_TABLE_NAME, AIRTABLE_API_KEY, airtable_bucket, window=AIRTABLE_BATCH_WINDOW
+)
 
-client = OpenAI(api_key=PERPLEXITY_API_KEY, base_url="https://api.perplexity.ai")
+# ======================== CONVERSATION MANAGEMENT ========================
 
-conversations = load_conversations()
-processed_message_ids = set()
-processed_lock = threading.Lock()
-payment_reminders = {}
-checked_records = set()
+def new_conversation():
+    return {
+        "messages": [],
+        "language": None,
+        "order_placed": False,
+        "waiting_for_receipt": False,
+        "airtable_record_id": None,
+        "pending_order": None
+    }
 
-# ======================== CONVERSATION MANAGEMENT ========================
+# Диалог заказа (меню, промпт, AI, разбор заказа) — общий с Telegram-ботом.
+# Принятый заказ ждет чек: запускаем напоминания об оплате. Чеки принимаются
+# только в PDF (process_receipt_message) — об этом просит промпт канала
+whatsapp_engine = OrderEngine(
+    new_conversation, conversations,
+    on_order=lambda user_phone, order_data: start_payment_reminder(user_phone),
+    receipt="receipt_pdf"
+)
 
 def ensure_conversation(user_phone):
-    if user_phone not in conversations:
-        conversations[user_phone] = {
-            "messages": [],
-            "order_placed": False,
-            "waiting_for_receipt": False,
-            "airtable_record_id": None,
-            "pending_order": None
-        }
-    return conversations[user_phone]
-
-def remember_user_message_only(user_phone, user_message):
-    conv = ensure_conversation(user_phone)
-    conv["messages"].append({"role": "user", "content": user_message})
-    conv["messages"] = conv["messages"][-20:]
-    save_conversations(conversations)
-    return conv
+    return whatsapp_engine.ensure(user_phone)
 
 def mark_message_processed(msg_id):
-    with processed_lock:
-        if msg_id in processed_message_ids:
-            return False
-        processed_message_ids.add(msg_id)
-        if len(processed_message_ids) > 2000:
-            processed_message_ids.clear()
-    return True
+    return processed_messages.add_if_new(msg_id)
 
 # ======================== DROPBOX ========================
 
-def upload_to_dropbox(image_url, filename):
-    """Загружает изображение в Dropbox и возвращает публичную ссылку"""
+def upload_receipt(image_url, filename):
+    """Переносит чек в Dropbox; возвращает (публичная ссылка, content_hash).
+    
+    Файл сначала скачивается потоком во временный файл с подсчетом
+    content_hash: уже загруженный чек берется из индекса без вызовов Dropbox.
+    """
     try:
-        # Скачиваем изображение
-        img_response = requests.get(image_url, timeout=15)
-        if img_response.status_code != 200:
-            print(f"❌ Не удалось скачать изображение: {img_response.status_code}")
-            return None
-        
-        image_data = img_response.content
-        
-        # Загружаем в Dropbox
-        dropbox_path = f"/receipts/{filename}"
-        upload_url = "https://content.dropboxapi.com/2/files/upload"
-        
-        headers = {
-            "Authorization": f"Bearer {DROPBOX_ACCESS_TOKEN}",
-            "Content-Type": "application/octet-stream",
-            "Dropbox-API-Arg": json.dumps({
-                "path": dropbox_path,
-                "mode": "add",
-                "autorename": True,
-                "mute": False
-            })
-        }
-        
-        upload_response = requests.post(upload_url, headers=headers, data=image_data, timeout=30)
+        with http_client.get(image_url, endpoint="receipt.download", timeout=15, stream=True) as img_response:
+            if img_response.status_code != 200:
+                print(f"❌ Не удалось скачать изображение: {img_response.status_code}")
+                return None, None
+            spool, content_hash, size = dropbox_client.spool_download(img_response)
         
-        if upload_response.status_code != 200:
-            print(f"❌ Ошибка загрузки в Dropbox: {upload_response.status_code}")
-            return None
-        
-        # Создаем публичную ссылку
-        share_url = "https://api.dropboxapi.com/2/sharing/create_shared_link_with_settings"
-        share_headers = {
-            "Authorization": f"Bearer {DROPBOX_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        share_data = {
-            "path": dropbox_path,
-            "settings": {
-                "requested_visibility": "public"
-            }
-        }
-        
-        share_response = requests.post(share_url, headers=share_headers, json=share_data, timeout=10)
-        
-        if share_response.status_code == 200:
-            share_data = share_response.json()
-            shared_link = share_data.get("url", "")
-            # Конвертируем в прямую ссылку
-            direct_link = shared_link.replace("www.dropbox.com", "dl.dropboxusercontent.com").replace("?dl=0", "")
-            print(f"✅ Файл загружен в Dropbox: {direct_link}")
-            return direct_link
-        elif share_response.status_code == 409:
-            # Ссылка уже существует, получаем её
-            list_url = "https://api.dropboxapi.com/2/sharing/list_shared_links"
-            list_data = {"path": dropbox_path}
-            list_response = requests.post(list_url, headers=share_headers, json=list_data, timeout=10)
+        with spool:
+            known = receipt_index.get(content_hash)
+            if known:
+                print(f"♻️ Чек уже загружен ({known['path']}), повторная загрузка не нужна")
+                return known["link"], content_hash
             
-            if list_response.status_code == 200:
-                links = list_response.json().get("links", [])
-                if links:
-                    shared_link = links[0].get("url", "")
-                    direct_link = shared_link.replace("www.dropbox.com", "dl.dropboxusercontent.com").replace("?dl=0", "")
-                    print(f"✅ Используется существующая ссылка: {direct_link}")
-                    return direct_link
+            # В памяти не больше DROPBOX_CHUNK_SIZE на кусок
+            chunks = dropbox_client.file_chunks(spool, DROPBOX_CHUNK_SIZE)
+            metadata = dropbox_client.upload_chunks(DROPBOX_ACCESS_TOKEN, chunks, f"/receipts/{filename}")
+        
+        # При autorename файл может лечь под другим именем
+        dropbox_path = metadata.get("path_display") or f"/receipts/{filename}"
+        if metadata.get("content_hash") not in (None, content_hash):
+            print(f"⚠️ content_hash Dropbox не совпал с локальным для {dropbox_path}")
+        link = dropbox_client.shared_link(DROPBOX_ACCESS_TOKEN, dropbox_path)
+        if link:
+            receipt_index.add(content_hash, dropbox_path, link, size)
+            print(f"✅ Файл загружен в Dropbox ({size} байт): {link}")
+            return link, content_hash
         
         print(f"❌ Не удалось создать публичную ссылку")
-        return None
+        return None, None
         
     except Exception as e:
         print(f"❌ Ошибка при работе с Dropbox: {e}")
-        return None
+        return None, None
+
+def flag_receipt_reuse(content_hash, record_id, user_phone):
+    """Один и тот же чек на разных заказах — предупреждаем кухню"""
+    others = receipt_index.claim(content_hash, record_id)
+    if not others:
+        return
+    print(f"🚩 Чек заказа {record_id} ({user_phone}) уже был приложен к: {', '.join(others)}")
+    telegram_sender.broadcast(
+        KITCHEN_STAFF_IDS,
+        f"🚩 <b>Проверьте оплату!</b>\nЧек к заказу {record_id} (клиент {user_phone}) "
+        f"уже использовался для заказов: {', '.join(others)}"
+    )
 
 # ======================== AIRTABLE ========================
 
 def create_airtable_record(order_data):
-    """Создает запись в Airtable"""
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
-    headers = {
-        "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
+    """Создает запись в Airtable (через пакетную очередь)"""
+    note_order_activity()
     fields = {
         "Customer_Info": f"{order_data.get('customer_name', 'Клиент')}, {order_data['phone']}",
         "Order_Details": "\n".join(order_data.get('order_items', [])),
@@ -288,60 +242,23 @@ def create_airtable_record(order_data):
         "Payment_Receipt": order_data.get('payment_receipt', [])
     }
     
-    data = {"fields": fields}
-    
+    future = airtable_writer.create(fields)
     try:
-        r = requests.post(url, headers=headers, json=data, timeout=10)
-        if r.status_code in [200, 201]:
-            response_data = r.json()
-            record_id = response_data['id']
+        try:
+            record_id = future.result(timeout=AIRTABLE_WRITE_TIMEOUT)
+        except FutureTimeoutError:
+            if future.cancel():
+                print("❌ Запись в Airtable не создана: очередь не успела ее отправить")
+                return None
+            # Запрос уже ушел — ждем ответа, иначе запись появится в Airtable без нас
+            record_id = future.result()
+        if record_id:
             print(f"✅ Запись создана в Airtable: {record_id}")
-            return record_id
-        else:
-            print(f"❌ Ошибка Airtable: {r.status_code} - {r.text}")
-            return None
+        return record_id
     except Exception as e:
         print(f"❌ Ошибка при создании записи: {e}")
         return None
 
-def upload_receipt_to_airtable(record_id, image_url):
-    """Загружает чек через Dropbox и сохраняет ссылку в Airtable"""
-    
-    # Генерируем уникальное имя файла
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"receipt_{record_id}_{timestamp}.jpg"
-    
-    # Загружаем в Dropbox
-    dropbox_url = upload_to_dropbox(image_url, filename)
-    
-    if not dropbox_url:
-        return False
-    
-    # Сохраняем ссылку в Airtable
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
-    headers = {
-        "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    fields = {
-        "Payment_Receipt": [{"url": dropbox_url}]
-    }
-    
-    data = {"fields": fields}
-    
-    try:
-        r = requests.patch(url, headers=headers, json=data, timeout=10)
-        if r.status_code == 200:
-            print(f"✅ Ссылка на чек сохранена в Airtable")
-            return True
-        else:
-            print(f"❌ Ошибка сохранения ссылки в Airtable: {r.status_code}")
-            return False
-    except Exception as e:
-        print(f"❌ Ошибка при сохранении ссылки: {e}")
-        return False
-
 def get_airtable_record(record_id):
     """Получает запись из Airtable"""
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
@@ -350,7 +267,8 @@ def get_airtable_record(record_id):
     }
     
     try:
-        r = requests.get(url, headers=headers, timeout=10)
+        r = http_client.get(url, endpoint="airtable.get", headers=headers, timeout=10,
+                            before_attempt=airtable_bucket.acquire)
         if r.status_code == 200:
             return r.json()
         return None
@@ -358,71 +276,148 @@ def get_airtable_record(record_id):
         print(f"❌ Ошибка получения записи: {e}")
         return None
 
-def check_paid_orders():
-    """Проверяет оплаченные заказы и отправляет их на кухню"""
+# Состояние инкрементальной синхронизации заказов
+orders_sync = {
+    "high_water": None,       # время начала последнего успешного запроса (unix)
+    "last_full_sync": 0.0,
+    "last_activity": 0.0,     # когда последний раз создавался заказ
+}
+orders_activity = threading.Event()
+
+# В шардированном режиме фоновые задачи ведет лидер, а о новых заказах
+# из других процессов он узнает по общему файлу-сигналу
+leader_election = LeaderElection(LEADER_LOCK_FILE) if SHARD_INDEX is not None else None
+shared_orders_activity = ActivitySignal(ORDERS_ACTIVITY_FILE) if SHARD_INDEX is not None else None
+
+def note_order_activity():
+    """Новый заказ — ближайшее время проверяем оплату часто"""
+    orders_sync["last_activity"] = time.time()
+    orders_activity.set()
+    if shared_orders_activity is not None:
+        shared_orders_activity.touch()
+
+def fetch_paid_orders(since=None):
+    """Оплаченные заказы в статусе Waiting; since — только измененные после него.
+    
+    Проходит по всем страницам (offset), а не только по первым 100 записям.
+    """
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
     headers = {
         "Authorization": f"Bearer {AIRTABLE_API_KEY}"
     }
     
-    # Фильтр: Is_Paid = true И Kitchen_Status = Waiting
-    params = {
-        "filterByFormula": "AND({Is_Paid}=TRUE(), {Kitchen_Status}='Waiting')"
-    }
+    # Фильтр: Is_Paid = true И Kitchen_Status = Waiting (+ изменены после high-water mark)
+    formula = "AND({Is_Paid}=TRUE(), {Kitchen_Status}='Waiting')"
+    if since is not None:
+        since_iso = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(since))
+        formula = (
+            "AND({Is_Paid}=TRUE(), {Kitchen_Status}='Waiting', "
+            f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{since_iso}')))"
+        )
+    
+    records = []
+    params = {"filterByFormula": formula, "pageSize": 100}
+    while True:
+        r = http_client.get(url, endpoint="airtable.list", headers=headers, params=params, timeout=10,
+                            before_attempt=airtable_bucket.acquire)
+        if r.status_code != 200:
+            print(f"❌ Ошибка получения заказов: {r.status_code}")
+            return None
+        data = r.json()
+        records.extend(data.get('records', []))
+        if not data.get('offset'):
+            return records
+        params["offset"] = data['offset']
+
+def check_paid_orders():
+    """Проверяет оплаченные заказы и отправляет их на кухню.
+    
+    Обычно запрашивает только записи, измененные после прошлой проверки
+    (с запасом ORDERS_SYNC_OVERLAP на расхождение часов); раз в
+    ORDERS_FULL_SYNC_EVERY секунд делает полную сверку.
+    Возвращает число новых заказов (повторно прочитанные в окне
+    перекрытия не считаются).
+    """
+    started = time.time()
+    since = orders_sync["high_water"]
+    full_sync = since is None or started - orders_sync["last_full_sync"] >= ORDERS_FULL_SYNC_EVERY
     
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=10)
-        if r.status_code == 200:
-            data = r.json()
-            records = data.get('records', [])
+        records = fetch_paid_orders(None if full_sync else since - ORDERS_SYNC_OVERLAP)
+        if records is None:
+            return 0
+        
+        new_orders = 0
+        for record in records:
+            record_id = record['id']
+            fields = record['fields']
             
-            for record in records:
-                record_id = record['id']
-                
-                # Пропускаем уже обработанные
-                if record_id in checked_records:
-                    continue
-                
-                fields = record['fields']
-                
-                # Формируем данные заказа
-                order_data = {
-                    'record_id': record_id,
-                    'order_id': fields.get('ID', 'N/A'),
-                    'customer_info': fields.get('Customer_Info', ''),
-                    'order_items': fields.get('Order_Details', '').split('\n'),
-                    'total_price': fields.get('Total_Price', 0),
-                    'delivery_address': fields.get('Delivery_Address', ''),
-                    'payment_receipt': fields.get('Payment_Receipt', [])
-                }
-                
-                # Отправляем на кухню
-                if send_to_kitchen(order_data):
-                    # Обновляем статус на "Cooking"
-                    update_kitchen_status(record_id, "Cooking")
-                    checked_records.add(record_id)
-                    print(f"✅ Заказ #{order_data['order_id']} отправлен на кухню")
+            # Формируем данные заказа
+            order_data = {
+                'record_id': record_id,
+                'order_id': fields.get('ID', 'N/A'),
+                'customer_info': fields.get('Customer_Info', ''),
+                'order_items': fields.get('Order_Details', '').split('\n'),
+                'total_price': fields.get('Total_Price', 0),
+                'delivery_address': fields.get('Delivery_Address', ''),
+                'payment_receipt': fields.get('Payment_Receipt', [])
+            }
+            
+            # В outbox; повторно найденный заказ (тот же record_id) игнорируется
+            if kitchen_outbox.enqueue(record_id, order_data):
+                new_orders += 1
+        
+        # Курсор сдвигается, только когда все записи уже в outbox
+        orders_sync["high_water"] = started
+        if full_sync:
+            orders_sync["last_full_sync"] = started
+        
+        return new_orders
                 
     except Exception as e:
         print(f"❌ Ошибка проверки заказов: {e}")
+        return 0
+
+def dispatch_kitchen_outbox():
+    """Доводит заказы из outbox: кухня -> статус Cooking, с повторами"""
+    for record_id, state, order_data in kitchen_outbox.due():
+        if state == STATE_PENDING:
+            if not send_to_kitchen(order_data):
+                retry_kitchen_delivery(record_id, order_data, "send_to_kitchen failed")
+                continue
+            kitchen_outbox.mark_sent(record_id)
+            print(f"✅ Заказ #{order_data['order_id']} отправлен на кухню")
+        
+        # Обновляем статус на "Cooking"; при ошибке повторим только его
+        if update_kitchen_status(record_id, "Cooking"):
+            kitchen_outbox.mark_done(record_id)
+        else:
+            retry_kitchen_delivery(record_id, order_data, "update_kitchen_status failed")
+    
+    kitchen_outbox.purge()
+
+def retry_kitchen_delivery(record_id, order_data, error):
+    """Планирует повтор; если попытки кончились — оплаченный заказ завис, зовем человека"""
+    if kitchen_outbox.schedule_retry(record_id, error):
+        alert_operators(
+            f"🚨 Оплаченный заказ #{html.escape(str(order_data.get('order_id', 'N/A')))} (Airtable {record_id}) "
+            f"не доведен до кухни: {error}.\n"
+            f"Адрес: {html.escape(order_data.get('delivery_address') or '')}\n"
+            f"Проверьте заказ вручную."
+        )
+
+def alert_operators(text):
+    print(text)
+    for chat_id in KITCHEN_ALERT_CHAT_IDS:
+        try:
+            send_telegram_message(chat_id, text)
+        except Exception as e:
+            print(f"❌ Не удалось отправить оповещение {chat_id}: {e}")
 
 def update_kitchen_status(record_id, status):
-    """Обновляет статус заказа на кухне"""
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
-    headers = {
-        "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    data = {
-        "fields": {
-            "Kitchen_Status": status
-        }
-    }
-    
+    """Обновляет статус заказа на кухне (через пакетную очередь)"""
     try:
-        r = requests.patch(url, headers=headers, json=data, timeout=10)
-        return r.status_code == 200
+        return airtable_writer.update(record_id, {"Kitchen_Status": status}).result(timeout=AIRTABLE_WRITE_TIMEOUT)
     except Exception as e:
         print(f"❌ Ошибка обновления статуса: {e}")
         return False
@@ -467,89 +462,60 @@ def send_to_kitchen(order_data):
 ━━━━━━━━━━━━━━━━━━━
 """
     
-    success = False
+    # Если есть чек - отправляем и его
+    receipt_url = None
+    receipts = order_data.get('payment_receipt', [])
+    if receipts and isinstance(receipts[0], dict):
+        receipt_url = receipts[0].get('url')
     
-    # Отправляем всем сотрудникам кухни
-    for staff_id in KITCHEN_STAFF_IDS:
-        if send_telegram_message(staff_id, message):
-            success = True
-            
-            # Если есть чек - отправляем и его
-            receipts = order_data.get('payment_receipt', [])
-            if receipts and len(receipts) > 0:
-                receipt_url = receipts[0].get('url') if isinstance(receipts[0], dict) else None
-                if receipt_url:
-                    send_telegram_photo(staff_id, receipt_url, "📸 Чек оплаты")
+    # Отправляем всем сотрудникам кухни параллельно
+    results = telegram_sender.broadcast(KITCHEN_STAFF_IDS, message, receipt_url, "📸 Чек оплаты")
+    delivered = [staff_id for staff_id, result in results.items() if result["message"]]
+    failed = [staff_id for staff_id in results if staff_id not in delivered]
+    if failed:
+        print(f"⚠️ Заказ #{order_data.get('order_id', 'N/A')}: не доставлено {len(failed)} из {len(results)} ({', '.join(failed)})")
     
-    return success
+    return bool(delivered)
 
 def send_telegram_message(chat_id, text):
-    """Отправляет текстовое сообщение в Telegram"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    data = {
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": "HTML"
-    }
-    
-    try:
-        r = requests.post(url, json=data, timeout=10)
-        if r.status_code == 200:
-            return True
-        else:
-            print(f"❌ Ошибка отправки в Telegram ({chat_id}): {r.status_code}")
-            return False
-    except Exception as e:
-        print(f"❌ Ошибка Telegram: {e}")
-        return False
+    """Отправляет текстовое сообщение в Telegram (с учетом лимитов)"""
+    return telegram_sender.send_message(chat_id, text)
 
 def send_telegram_photo(chat_id, photo_url, caption):
-    """Отправляет фото в Telegram"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
-    data = {
-        "chat_id": chat_id,
-        "photo": photo_url,
-        "caption": caption
-    }
-    
-    try:
-        r = requests.post(url, json=data, timeout=10)
-        return r.status_code == 200
-    except Exception as e:
-        print(f"❌ Ошибка отправки фото: {e}")
-        return False
+    """Отправляет фото в Telegram; повторные отправки того же URL идут по file_id"""
+    return telegram_sender.send_photo(chat_id, photo_url, caption)
 
 # ======================== WHATSAPP ========================
 
 def send_message(to, text):
-    url = "https://gate.whapi.cloud/messages/text"
+    url = f"{WHATSAPP_API_URL}/messages/text"
     headers = {"accept": "application/json", "content-type": "application/json"}
     params = {"token": WHATSAPP_TOKEN}
     data = {"to": to, "body": text}
     try:
-        r = requests.post(url, params=params, headers=headers, json=data, timeout=10)
+        r = http_client.post(url, endpoint="whapi.send", params=params, headers=headers, json=data, timeout=10)
         return r.status_code in [200, 201]
     except:
         return False
 
 def send_typing(to):
-    url = "https://gate.whapi.cloud/messages/typing"
+    url = f"{WHATSAPP_API_URL}/messages/typing"
     headers = {"accept": "application/json", "content-type": "application/json"}
     params = {"token": WHATSAPP_TOKEN}
     data = {"to": to, "duration": 2}
     try:
-        requests.post(url, params=params, headers=headers, json=data, timeout=5)
+        http_client.post(url, endpoint="whapi.typing", retries=0, params=params, headers=headers, json=data, timeout=5)
     except:
         pass
 
 def download_whatsapp_media(media_id):
     """Скачивает медиафайл из WhatsApp"""
-    url = f"https://gate.whapi.cloud/messages/{media_id}/media"
+    url = f"{WHATSAPP_API_URL}/messages/{media_id}/media"
     params = {"token": WHATSAPP_TOKEN}
     headers = {"accept": "application/json"}
     
     try:
-        r = requests.get(url, params=params, headers=headers, timeout=15)
+        r = http_client.get(url, endpoint="whapi.media", params=params, headers=headers, timeout=15)
         if r.status_code == 200:
             data = r.json()
             return data.get("media_url")
@@ -558,56 +524,9 @@ def download_whatsapp_media(media_id):
         print(f"❌ Ошибка скачивания медиа: {e}")
         return None
 
-# ======================== AI ========================
-
-def get_ai_response(user_phone, user_message):
-    conv = remember_user_message_only(user_phone, user_message)
-    
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + conv["messages"]
-    
-    response = client.chat.completions.create(
-        model="sonar-pro",
-        messages=messages,
-        temperature=0.7,
-        max_tokens=600,
-        extra_body={"disable_search": True}
-    )
-    
-    ai_reply = response.choices[0].message.content
-    
-    # Проверяем наличие JSON с подтверждением заказа
-    json_match = re.search(r'```json\s*(\{.*?\})\s*```', ai_reply, re.DOTALL)
-    if json_match:
-        try:
-            order_data = json.loads(json_match.group(1))
-            if order_data.get("order_confirmed"):
-                # Сохраняем заказ в память, но НЕ создаем запись в Airtable пока нет чека
-                conv["pending_order"] = order_data
-                conv["waiting_for_receipt"] = True
-                save_conversations(conversations)
-                
-                # Запускаем таймер напоминания
-                start_payment_reminder(user_phone)
-            
-            # Удаляем JSON из ответа пользователю
-            ai_reply = re.sub(r'```json\s*\{.*?\}\s*```', '', ai_reply, flags=re.DOTALL).strip()
-        except json.JSONDecodeError:
-            pass
-    
-    conv["messages"].append({"role": "assistant", "content": ai_reply})
-    conv["messages"] = conv["messages"][-20:]
-    
-    return ai_reply
-
 # ======================== PAYMENT REMINDER ========================
 
-def start_payment_reminder(user_phone):
-    """Запускает таймер напоминания об оплате"""
-    def remind():
-        time.sleep(900)  # 15 минут
-        conv = conversations.get(user_phone)
-        if conv and conv.get("waiting_for_receipt"):
-            reminder_text = """
+PAYMENT_REMINDER_TEXT = """
 ⏰ Напоминание об оплате
 
 Мы еще не получили скриншот чека оплаты.
@@ -615,137 +534,413 @@ def start_payment_reminder(user_phone):
 
 Если возникли вопросы - напишите нам!
 """
-            send_message(user_phone, reminder_text)
-            print(f"⏰ Отправлено напоминание для {user_phone}")
+
+def start_payment_reminder(user_phone):
+    """Планирует напоминания об оплате (повторное подтверждение заказа их перезапускает)"""
+    payment_reminders.schedule(user_phone, [minutes * 60 for minutes in PAYMENT_REMINDER_MINUTES])
+
+def cancel_payment_reminder(user_phone):
+    payment_reminders.cancel(user_phone)
+
+def send_payment_reminder(user_phone, step):
+    conv = conversations.get(user_phone)
+    if conv and conv.get("waiting_for_receipt"):
+        send_message(user_phone, PAYMENT_REMINDER_TEXT)
+        print(f"⏰ Отправлено напоминание #{step + 1} для {user_phone}")
+
+def on_payment_reminder(user_phone, step, payload):
+    # Отправка — в очереди чата, чтобы не держать поток планировщика
+    chat_pool.submit(user_phone, send_payment_reminder, user_phone, step)
+
+# ======================== ОБРАБОТКА ДИАЛОГА ========================
+
+def order_status_text(user_phone, language):
+    conv = ensure_conversation(user_phone)
+    record_id = conv.get("airtable_record_id")
+    if not record_id:
+        return order_status_reply(language, whatsapp_engine.receipt if conv.get("waiting_for_receipt") else "none")
+    record = get_airtable_record(record_id)
+    if not record:
+        return order_status_reply(language, "error")
+    fields = record.get("fields", {})
+    return paid_status_reply(language, fields.get("Is_Paid"), fields.get("Kitchen_Status"))
+
+def local_reply(user_phone, text):
+    """Ответ по шаблону для служебных сообщений или None, если нужен AI"""
+    routed = whatsapp_engine.route(user_phone, text)
+    if routed is None:
+        return None
+    intent, language, items = routed
+    if intent == INTENT_STATUS:
+        return order_status_text(user_phone, language)
+    return whatsapp_engine.template_reply(intent, language, items)
+
+def process_text_turn(user_phone, full_text):
+    """Один ход диалога: шаблонный или AI-ответ на накопившиеся сообщения клиента"""
+    reply = local_reply(user_phone, full_text)
+    if reply is not None:
+        print(f"⚡ {user_phone}: ответ без AI")
+        whatsapp_engine.remember_turn(user_phone, full_text, reply)
+        send_message(user_phone, reply)
+        return
+    
+    # Типовой вопрос вне оформления заказа — ответ из кэша
+    cache_key = whatsapp_engine.cache_key(user_phone, full_text)
+    reply = whatsapp_engine.cached_reply(user_phone, full_text, cache_key)
+    if reply is None:
+        send_typing(user_phone)
+        reply = whatsapp_engine.respond(user_phone, full_text, cache_key)
+    send_message(user_phone, reply)
+
+def process_receipt_message(user_phone, msg):
+    """Чек (PDF) от клиента: Dropbox -> запись в Airtable -> ответ клиенту"""
+    conv = ensure_conversation(user_phone)
+    if not conv.get("waiting_for_receipt"):
+        return
+    
+    media_id = msg.get("id")
+    media_url = download_whatsapp_media(media_id)
+    
+    if media_url and conv.get("pending_order"):
+        # Загружаем в Dropbox
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"receipt_{user_phone}_{timestamp}.pdf"
+        dropbox_url, content_hash = upload_receipt(media_url, filename)
+        
+        if dropbox_url:
+            # Добавляем чек к заказу
+            pending_order = dict(conv["pending_order"], payment_receipt=[{"url": dropbox_url}])
+            conversations.update(user_phone, pending_order=pending_order)
+            
+            # Теперь создаем запись в Airtable
+            record_id = create_airtable_record(pending_order)
+            
+            if record_id:
+                conversations.update(
+                    user_phone,
+                    waiting_for_receipt=False,
+                    order_placed=True,
+                    airtable_record_id=record_id,
+                    pending_order=None  # Очищаем
+                )
+                cancel_payment_reminder(user_phone)
+                flag_receipt_reuse(content_hash, record_id, user_phone)
+                
+                send_message(user_phone, 
+                    "✅ Чек получен! Заказ оформлен и передан на кухню.\n"
+                    "Ожидайте доставку!")
+            else:
+                send_message(user_phone, "❌ Ошибка при оформлении заказа. Попробуйте позже.")
+        else:
+            send_message(user_phone, 
+                "❌ Ошибка загрузки чека. Попробуйте еще раз.")
+
+# ======================== ВХОДЯЩИЕ СООБЩЕНИЯ ========================
+
+def handle_incoming_messages(messages):
+    """Общая точка входа для опроса и вебхука: дедупликация, группировка, очередь"""
+    # Словарь для группировки текстовых сообщений: {user_phone: [text1, text2]}
+    pending_texts = {}
     
-    reminder_thread = threading.Thread(target=remind, daemon=True)
-    reminder_thread.start()
+    for msg in sorted(messages, key=lambda m: m.get("timestamp", 0)):
+        if msg.get("from_me"):
+            continue
+        
+        msg_id = msg.get("id")
+        if not mark_message_processed(msg_id):
+            continue
+        
+        user_phone = msg.get("chat_id")
+        if not user_phone or user_phone.endswith("@g.us"):
+            continue
+        
+        conv = ensure_conversation(user_phone)
+        
+        # Обработка документов (PDF чеков) — тоже через очередь чата,
+        # чтобы порядок "чек -> следующий вопрос" сохранялся
+        if msg.get("type") == "document" and conv.get("waiting_for_receipt"):
+            chat_pool.submit(user_phone, process_receipt_message, user_phone, msg)
+        elif msg.get("type") in ["document", "image"]:
+            print(f"⚠️ Игнорирую документ от {user_phone}: не ждем чек (waiting_for_receipt={conv.get('waiting_for_receipt')})")
+        
+        # Обработка текстовых сообщений - собираем в список
+        elif msg.get("type") == "text":
+            text = msg.get("text", {}).get("body", "")
+            if user_phone not in pending_texts:
+                pending_texts[user_phone] = []
+            pending_texts[user_phone].append(text)
+    
+    # Отдаем сгруппированные сообщения в пул: чаты обрабатываются параллельно
+    for user_phone, texts in pending_texts.items():
+        # Объединяем сообщения через перенос строки
+        full_text = "\n".join(texts)
+        chat_pool.submit(user_phone, process_text_turn, user_phone, full_text)
+
+def webhook_messages(payload):
+    """Список сообщений из тела вебхука; чужой формат — пустой список"""
+    messages = payload.get("messages") if isinstance(payload, dict) else None
+    if not isinstance(messages, list):
+        return []
+    return [msg for msg in messages if isinstance(msg, dict)]
+
+def handle_webhook(payload):
+    """Вебхук шлюза: сообщения сразу уходят в очередь обработки"""
+    messages = webhook_messages(payload)
+    if messages:
+        handle_incoming_messages(messages)
+
+def require_webhook_secret():
+    if WHATSAPP_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise SystemExit("❌ WHATSAPP_MODE=webhook требует WEBHOOK_SECRET: без него вебхук открыт всем")
 
 # ======================== POLLING ========================
 
-def poll_messages():
-    url = "https://gate.whapi.cloud/messages/list"
+# Курсор опроса: забираем только сообщения новее последнего увиденного.
+# Страницы идут от старых к новым, поэтому при упоре в POLL_MAX_PAGES
+# курсор доходит только до последнего полученного сообщения, а остальное
+# заберет следующий опрос
+poll_cursor = {"time_from": LAUNCH_TIMESTAMP}
+
+def poll_messages(on_messages=handle_incoming_messages):
+    url = f"{WHATSAPP_API_URL}/messages/list"
     headers = {"accept": "application/json"}
-    params = {
-        "token": WHATSAPP_TOKEN,
-        "count": 20,
-        "time_from": LAUNCH_TIMESTAMP
-    }
     
     try:
-        r = requests.get(url, params=params, headers=headers, timeout=10)
-        if r.status_code != 200:
-            return
-        
-        data = r.json()
+        messages = []
+        for page in range(POLL_MAX_PAGES):
+            params = {
+                "token": WHATSAPP_TOKEN,
+                "count": POLL_PAGE_SIZE,
+                "offset": page * POLL_PAGE_SIZE,
+                "time_from": poll_cursor["time_from"],
+                "sort": "asc"
+            }
+            r = http_client.get(url, endpoint="whapi.list", params=params, headers=headers, timeout=10)
+            if r.status_code != 200:
+                break
+            batch = r.json().get("messages", [])
+            messages.extend(batch)
+            if len(batch) < POLL_PAGE_SIZE:
+                break
         
-        # Словарь для группировки текстовых сообщений: {user_phone: [text1, text2]}
-        pending_texts = {}
+        if not messages:
+            return
         
-        for msg in reversed(data.get("messages", [])):
-            if msg.get("from_me"):
-                continue
-            
-            msg_id = msg.get("id")
-            if not mark_message_processed(msg_id):
-                continue
-            
-            user_phone = msg.get("chat_id")
-            if user_phone.endswith("@g.us"):
-                continue
-            
-            conv = ensure_conversation(user_phone)
-            
-            # Обработка документов (PDF чеков)
-            if msg.get("type") == "document" and conv.get("waiting_for_receipt"):
-                media_id = msg.get("id")
-                media_url = download_whatsapp_media(media_id)
-                
-                if media_url and conv.get("pending_order"):
-                    # Загружаем в Dropbox
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"receipt_{user_phone}_{timestamp}.pdf"
-                    dropbox_url = upload_to_dropbox(media_url, filename)
-                    
-                    if dropbox_url:
-                        # Добавляем чек к заказу
-                        conv["pending_order"]["payment_receipt"] = [{"url": dropbox_url}]
-                        
-                        # Теперь создаем запись в Airtable
-                        record_id = create_airtable_record(conv["pending_order"])
-                        
-                        if record_id:
-                            conv["waiting_for_receipt"] = False
-                            conv["order_placed"] = True
-                            conv["airtable_record_id"] = record_id
-                            conv["pending_order"] = None # Очищаем
-                            save_conversations(conversations)
-                            
-                            send_message(user_phone, 
-                                "✅ Чек получен! Заказ оформлен и передан на кухню.\n"
-                                "Ожидайте доставку!")
-                        else:
-                            send_message(user_phone, "❌ Ошибка при оформлении заказа. Попробуйте позже.")
-                    else:
-                        send_message(user_phone, 
-                            "❌ Ошибка загрузки чека. Попробуйте еще раз.")
-            elif msg.get("type") in ["document", "image"]:
-                print(f"⚠️ Игнорирую документ от {user_phone}: не ждем чек (waiting_for_receipt={conv.get('waiting_for_receipt')})")
-            
-            # Обработка текстовых сообщений - собираем в список
-            elif msg.get("type") == "text":
-                text = msg.get("text", {}).get("body", "")
-                if user_phone not in pending_texts:
-                    pending_texts[user_phone] = []
-                pending_texts[user_phone].append(text)
+        messages.sort(key=lambda msg: msg.get("timestamp", 0))
+        if on_messages(messages) is False:
+            # Не доставлено (шард недоступен) — курсор на месте, пачка придет при следующем опросе
+            print(f"⚠️ {len(messages)} сообщ. не доставлены, повтор при следующем опросе")
+            return
         
-        # Обрабатываем сгруппированные сообщения
-        for user_phone, texts in pending_texts.items():
-            # Объединяем сообщения через перенос строки
-            full_text = "\n".join(texts)
-            
-            send_typing(user_phone)
-            reply = get_ai_response(user_phone, full_text)
-            send_message(user_phone, reply)
+        # Сдвигаем курсор до последнего полученного; сообщения той же секунды отсеет дедупликация по id
+        newest = messages[-1].get("timestamp", 0)
+        if newest > poll_cursor["time_from"]:
+            poll_cursor["time_from"] = newest
                 
     except Exception as e:
         print(f"Ошибка при получении сообщений: {e}")
 
 # ======================== BACKGROUND TASKS ========================
 
+def next_orders_interval(interval, found):
+    """Часто в час пик, редко ночью: интервал растет, пока ничего не происходит"""
+    if found:
+        return ORDERS_POLL_MIN
+    active = time.time() - orders_sync["last_activity"] < ORDERS_ACTIVE_WINDOW
+    ceiling = ORDERS_POLL_ACTIVE_MAX if active else ORDERS_POLL_MAX
+    return min(ceiling, max(ORDERS_POLL_MIN, interval * 1.5))
+
+def wait_for_order_activity(interval):
+    """True, если новый заказ появился раньше, чем прошло interval секунд"""
+    if shared_orders_activity is None:
+        if orders_activity.wait(interval):
+            orders_activity.clear()
+            return True
+        return False
+    if shared_orders_activity.wait(interval):
+        orders_sync["last_activity"] = time.time()
+        return True
+    return False
+
 def background_checker():
-    """Фоновая проверка оплаченных заказов каждые 10 секунд"""
+    """Фоновая проверка оплаченных заказов с адаптивным интервалом"""
+    interval = ORDERS_POLL_MIN
     while True:
+        # Из нескольких воркеров заказы на кухню отправляет только лидер
+        if leader_election is not None and not leader_election.is_leader():
+            time.sleep(SHARD_CHECK_INTERVAL)
+            continue
         try:
-            check_paid_orders()
-            time.sleep(10)  # Проверка каждые 10 секунд
+            found = check_paid_orders()
+            interval = next_orders_interval(interval, found)
         except Exception as e:
             print(f"Ошибка в фоновом чекере: {e}")
-            time.sleep(10)
+        # Outbox доводится и тогда, когда Airtable недоступен для выборки заказов
+        try:
+            dispatch_kitchen_outbox()
+        except Exception as e:
+            print(f"Ошибка отправки на кухню: {e}")
+        # Неудачная отправка на кухню повторяется в срок, а не после расслабленного интервала
+        wait = interval
+        retry_in = kitchen_outbox.next_due_in()
+        if retry_in is not None:
+            wait = min(wait, max(ORDERS_POLL_MIN, retry_in))
+        # Новый заказ будит чекер раньше срока
+        if wait_for_order_activity(wait):
+            interval = ORDERS_POLL_MIN
+
+# ======================== ШАРДИРОВАНИЕ ========================
+
+def split_legacy_state():
+    """Раскладывает диалоги и напоминания однопроцессного режима по шардам.
+
+    Срабатывает для шарда, у которого еще нет своих файлов; исходные
+    файлы не меняются и остаются резервной копией. Файлы, созданные для
+    другого SHARD_COUNT, не переразбиваются — запуск останавливается.
+    """
+    for path in (CONVERSATIONS_FILE, PROCESSED_MESSAGES_FILE, PAYMENT_REMINDERS_FILE):
+        found = existing_shards(path)
+        if found and found != set(range(SHARD_COUNT)):
+            raise SystemExit(
+                f"❌ Файлы {path} есть для шардов {sorted(found)}, а SHARD_COUNT={SHARD_COUNT}: "
+                f"чаты остались бы в старых шардах. Верните прежний SHARD_COUNT или перенесите состояние вручную"
+            )
+    
+    legacy_conversations = open_store(CONVERSATIONS_FILE)
+    legacy_reminders = ReminderScheduler(PAYMENT_REMINDERS_FILE).load()
+    for shard in range(SHARD_COUNT):
+        store = open_store(shard_path(CONVERSATIONS_FILE, shard))
+        if len(store) == 0:
+            moved = 0
+            for chat_id, conv in legacy_conversations.items():
+                if shard_for(chat_id, SHARD_COUNT) == shard:
+                    store.ensure(chat_id, conv)
+                    moved += 1
+            if moved:
+                print(f"🧩 Шард {shard}: перенесено диалогов {moved}")
+        store.close()
+        
+        reminders_path = shard_path(PAYMENT_REMINDERS_FILE, shard)
+        if len(legacy_reminders) and not os.path.exists(reminders_path):
+            reminders = ReminderScheduler(reminders_path)
+            for key, entry in legacy_reminders.entries.items():
+                if shard_for(key, SHARD_COUNT) == shard:
+                    reminders.entries[key] = dict(entry)
+            reminders.save()
+    legacy_conversations.close()
+
+def run_dispatcher():
+    """Диспетчер: принимает сообщения WhatsApp и пересылает воркерам по chat_id"""
+    print(f"🧩 Шардированный режим: {SHARD_COUNT} воркеров, порты {SHARD_BASE_PORT}-{SHARD_BASE_PORT + SHARD_COUNT - 1}")
+    global WEBHOOK_SECRET
+    require_webhook_secret()
+    if not WEBHOOK_SECRET:
+        # Локальные вебхуки воркеров тоже подписываются: секрет на время запуска, воркеры наследуют его
+        WEBHOOK_SECRET = os.environ["WEBHOOK_SECRET"] = secrets.token_hex(32)
+    split_legacy_state()
+    # kill / systemd / docker stop шлют SIGTERM: останавливаемся так же, как по Ctrl+C,
+    # иначе процессы-воркеры остались бы сиротами
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    workers = WorkerProcesses(__file__, SHARD_COUNT).start()
+    try:
+        router = ShardRouter(SHARD_COUNT, SHARD_BASE_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+        # Пока воркеры не слушают, пересылка все равно не пройдет — не тратим на нее опросы
+        router.wait_ready(SHARD_READY_TIMEOUT)
+        start_metrics_reporter([http_client.http_metrics], interval=METRICS_INTERVAL)
+        
+        poll_interval = POLL_INTERVAL
+        if WHATSAPP_MODE == "webhook":
+            start_webhook_server(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                                 lambda payload: router.route(webhook_messages(payload)))
+            poll_interval = WEBHOOK_FALLBACK_POLL_INTERVAL
+        
+        last_poll = last_check = 0.0
+        while True:
+            try:
+                now = time.monotonic()
+                if now - last_poll >= poll_interval:
+                    poll_messages(router.route)
+                    last_poll = now
+                if now - last_check >= SHARD_CHECK_INTERVAL:
+                    workers.check()
+                    last_check = now
+                time.sleep(min(poll_interval, SHARD_CHECK_INTERVAL))
+            except Exception as e:
+                print(f"Критическая ошибка: {e}")
+                time.sleep(5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        workers.stop()
+    print("\n👋 Система остановлена")
 
 # ======================== START ========================
 
-if __name__ == "__main__":
+def start_whatsapp(report_metrics=True):
+    """Загрузка состояния и фоновые задачи; возвращает интервал опроса (None — только вебхук)"""
+    require_webhook_secret()
     print("🚀 AI-Доставка запущена")
     print(f"📅 Timestamp: {LAUNCH_TIMESTAMP}")
     print(f"📊 Airtable Base: {AIRTABLE_BASE_ID}")
     print(f"👨‍🍳 Сотрудников кухни: {len(KITCHEN_STAFF_IDS)}")
     print(f"💬 Telegram Bot активен")
     print(f"📦 Dropbox интеграция активна")
+    if SHARD_INDEX is not None:
+        print(f"🧩 Шард {SHARD_INDEX} из {SHARD_COUNT}")
+    print(f"💾 Диалогов загружено: {len(conversations)}")
     print("━" * 50)
     
+    # fsync журнала диалогов раз в секунду
+    start_flusher(conversations)
+    start_flusher(processed_messages, interval=5)
+    payment_reminders.start(on_payment_reminder)
+    if report_metrics:
+        start_metrics_reporter([chat_pool, http_client.http_metrics, response_cache], interval=METRICS_INTERVAL)
+    
     # Запускаем фоновый чекер заказов
     checker_thread = threading.Thread(target=background_checker, daemon=True)
     checker_thread.start()
     print("✅ Фоновый чекер заказов запущен")
     
+    poll_interval = POLL_INTERVAL
+    if SHARD_INDEX is not None:
+        # Сообщения воркеру пересылает только диспетчер; SIGTERM от него — штатная остановка
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        start_webhook_server("127.0.0.1", SHARD_BASE_PORT + SHARD_INDEX, WEBHOOK_PATH, WEBHOOK_SECRET, handle_webhook)
+        poll_interval = None
+    elif WHATSAPP_MODE == "webhook":
+        start_webhook_server(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, handle_webhook)
+        # Опрос остается страховкой на случай пропущенных вебхуков
+        poll_interval = WEBHOOK_FALLBACK_POLL_INTERVAL
+    return poll_interval
+
+def poll_forever(poll_interval):
+    """Цикл опроса WhatsApp; KeyboardInterrupt пробрасывается наружу"""
     while True:
         try:
-            poll_messages()
-            time.sleep(3)
-        except KeyboardInterrupt:
-            print("\n👋 Система остановлена")
-            break
+            if poll_interval is not None:
+                poll_messages()
+            time.sleep(poll_interval or SHARD_CHECK_INTERVAL)
         except Exception as e:
             print(f"Критическая ошибка: {e}")
             time.sleep(5)
+
+def stop_whatsapp():
+    conversations.close()
+    processed_messages.save()
+
+def run_bot():
+    """Один процесс или воркер шарда: обработка диалогов и фоновые задачи"""
+    poll_interval = start_whatsapp()
+    try:
+        poll_forever(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    stop_whatsapp()
+    print("\n👋 Система остановлена")
+
+if __name__ == "__main__":
+    if SHARD_COUNT > 1 and SHARD_INDEX is None:
+        run_dispatcher()
+    else:
+        run_bot()
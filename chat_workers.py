@@ -0,0 +1,106 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# ======================== ПУЛ ОБРАБОТЧИКОВ ЧАТОВ ========================
+#
+# Разные чаты обрабатываются параллельно (не больше max_workers потоков),
+# а задачи одного чата — строго по очереди: в каждый момент у чата не
+# больше одной задачи в работе.
+
+
+class ChatWorkerPool:
+    """Пул потоков с гарантией порядка внутри одного chat_id"""
+
+    def __init__(self, max_workers=8, name="chat", wait_window=1000):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.max_workers = max_workers
+        self.name = name
+        self.lock = threading.Lock()
+        self.queues = {}       # chat_id -> deque[(fn, args, enqueued_at)]
+        self.active = set()    # чаты, у которых есть задача в работе
+        self.queued = 0
+        self.processed = 0
+        self.failed = 0
+        self.waits = deque(maxlen=wait_window)
+
+    def submit(self, chat_id, fn, *args):
+        with self.lock:
+            self.queues.setdefault(chat_id, deque()).append((fn, args, time.monotonic()))
+            self.queued += 1
+            if chat_id in self.active:
+                return
+            self.active.add(chat_id)
+        self.executor.submit(self._run_next, chat_id)
+
+    def _run_next(self, chat_id):
+        with self.lock:
+            fn, args, enqueued_at = self.queues[chat_id].popleft()
+            self.queued -= 1
+            self.waits.append(time.monotonic() - enqueued_at)
+
+        ok = True
+        try:
+            fn(*args)
+        except Exception as e:
+            ok = False
+            print(f"❌ Ошибка обработки чата {chat_id}: {e}")
+
+        with self.lock:
+            self.processed += 1
+            if not ok:
+                self.failed += 1
+            if self.queues[chat_id]:
+                # Следующая задача чата встает в общую очередь, чтобы
+                # один болтливый клиент не занимал поток бесконечно
+                resubmit = True
+            else:
+                del self.queues[chat_id]
+                self.active.discard(chat_id)
+                resubmit = False
+        if resubmit:
+            self.executor.submit(self._run_next, chat_id)
+
+    def metrics(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            queue_depth = self.queued
+            active_chats = len(self.active)
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * p))]
+        return {
+            "queue_depth": queue_depth,
+            "active_chats": active_chats,
+            "processed": self.processed,
+            "failed": self.failed,
+            "wait_p50": percentile(0.5),
+            "wait_p95": percentile(0.95),
+            "wait_max": waits[-1] if waits else 0.0,
+        }
+
+    def format_metrics(self):
+        m = self.metrics()
+        return (
+            f"📈 [{self.name}] очередь: {m['queue_depth']}, чатов в работе: {m['active_chats']}, "
+            f"обработано: {m['processed']} (ошибок {m['failed']}), "
+            f"ожидание p50/p95/max: {m['wait_p50']:.2f}/{m['wait_p95']:.2f}/{m['wait_max']:.2f}с"
+        )
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def start_metrics_reporter(pools, interval=60):
+    """Раз в interval секунд печатает метрики пулов"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            for pool in pools:
+                print(pool.format_metrics())
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
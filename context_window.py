@@ -0,0 +1,120 @@
+import re
+
+# ======================== ОКНО ИСТОРИИ ДЛЯ AI ========================
+#
+# История обрезается не по числу сообщений, а по бюджету токенов.
+# Токены считаются приближенно, без внешнего токенизатора: BPE-словари
+# хуже сжимают кириллицу, чем латиницу, поэтому у них разный вес.
+# Сообщения, вытесняемые из сохраненной истории, сворачиваются в короткую
+# текстовую сводку, которая хранится в самом диалоге (history_summary).
+# Сообщения, которые еще хранятся, но не влезли в бюджет запроса, попадают
+# в сводку запроса при сборке промпта — в AI не теряется ни одно сообщение.
+
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_LINE_CHARS = 160
+
+CYRILLIC_RE = re.compile(r'[Ѐ-ӿ]')
+
+# Заголовок сводки и подписи реплик на языке диалога
+SUMMARY_LABELS = {
+    "ru": {"header": "РАНЕЕ В ДИАЛОГЕ (кратко):", "user": "Клиент", "assistant": "Продавец"},
+    "kk": {"header": "ДИАЛОГТА БҰРЫН (қысқаша):", "user": "Клиент", "assistant": "Сатушы"},
+    "en": {"header": "EARLIER IN THE CONVERSATION (summary):", "user": "Customer", "assistant": "Seller"},
+}
+
+
+def summary_labels(language):
+    return SUMMARY_LABELS.get(language or "ru", SUMMARY_LABELS["ru"])
+
+
+def estimate_tokens(text):
+    """Приближенное число токенов: ~2.5 символа кириллицы или ~4 прочих на токен"""
+    if not text:
+        return 0
+    cyrillic = len(CYRILLIC_RE.findall(text))
+    other = len(text) - cyrillic
+    return int(cyrillic / 2.5 + other / 4) + 1
+
+
+def message_tokens(message):
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def select_history(history, budget):
+    """Самые свежие сообщения, которые помещаются в бюджет.
+
+    Последнее сообщение берется всегда, даже если оно одно больше бюджета.
+    Возвращает (сообщения, потраченные токены).
+    """
+    selected = []
+    used = 0
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if selected and used + cost > budget:
+            break
+        selected.append(message)
+        used += cost
+    selected.reverse()
+    return selected, used
+
+
+def with_summary(system_prompt, summary, language="ru"):
+    """Сводка идет после основного промпта, чтобы его начало оставалось неизменным"""
+    if not summary:
+        return system_prompt
+    return f"{system_prompt}\n\n{summary_labels(language)['header']}\n{summary}"
+
+
+def summarize_messages(messages, language="ru"):
+    labels = summary_labels(language)
+    lines = []
+    for message in messages:
+        who = labels["user"] if message.get("role") == "user" else labels["assistant"]
+        text = " ".join((message.get("content") or "").split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS].rstrip() + "…"
+        if text:
+            lines.append(f"- {who}: {text}")
+    return lines
+
+
+def fold_overflow(conv, keep, summary_budget):
+    """Новая сводка, если после добавления сообщения история превысит keep.
+
+    Вытесняемые сообщения дописываются в конец сводки, самые старые строки
+    сводки отбрасываются, пока она не влезет в summary_budget токенов.
+    Возвращает None, если сворачивать нечего.
+    """
+    messages = conv.get("messages", [])
+    overflow = len(messages) + 1 - keep
+    if overflow <= 0:
+        return None
+
+    lines = (conv.get("history_summary") or "").splitlines()
+    lines += summarize_messages(messages[:overflow], conv.get("language"))
+    return "\n".join(trim_summary(lines, summary_budget))
+
+
+def trim_summary(lines, summary_budget):
+    """Отбрасывает самые старые строки сводки, пока она не влезет в бюджет"""
+    lines = list(lines)
+    while lines and estimate_tokens("\n".join(lines)) > summary_budget:
+        lines.pop(0)
+    return lines
+
+
+def build_messages(system_prompt, history, budget, summary=None, summary_budget=None, language="ru"):
+    """Системный промпт (+сводка) и свежая история в пределах бюджета.
+
+    Сводка запроса — сохраненная history_summary плюс все сообщения истории,
+    не вошедшие в бюджет (с summary_budget — не больше стольких токенов).
+    Возвращает (messages, оценка токенов промпта).
+    """
+    selected, used = select_history(history, budget)
+    lines = (summary or "").splitlines()
+    lines += summarize_messages(history[:len(history) - len(selected)], language)
+    if summary_budget is not None:
+        lines = trim_summary(lines, summary_budget)
+    system_content = with_summary(system_prompt, "\n".join(lines), language)
+    messages = [{"role": "system", "content": system_content}] + selected
+    return messages, used + estimate_tokens(system_content) + MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,546 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# ======================== ХРАНИЛИЩЕ ДИАЛОГОВ ========================
+#
+# Снимок (snapshot) лежит в том же JSON-файле, что и раньше
+# (conversations.json / telegram_conversations.json), а рядом с ним —
+# журнал "<файл>.journal": по одной JSON-строке на каждое изменение
+# диалога. Запись сообщения стоит O(размер сообщения), а не O(все диалоги).
+# Журнал периодически сворачивается в новый снимок.
+#
+# Альтернатива — SQLite (WAL) с индексами по состоянию заказа: в памяти
+# держится только LRU-кэш активных диалогов.
+#
+# Модель согласованности: словарь диалога после публикации не меняется
+# (copy-on-write) — каждое изменение собирает новую копию и подменяет
+# ссылку. Читатель из любого потока видит целостный снимок диалога, а
+# сохранение на диск сериализует поверхностную копию общего словаря без
+# блокировки писателей. Изменения одного чата упорядочены его локом из
+# набора StripedLocks; через store.chat_lock(chat_id) вызывающий код делает
+# атомарными свои составные операции (прочитать -> решить -> записать).
+# Общий короткий лок держится только на подмену ссылки и запись в журнал.
+
+JOURNAL_SUFFIX = ".journal"
+ROTATED_SUFFIX = ".old"
+
+
+class StripedLocks:
+    """Фиксированный набор RLock: чат -> lock[hash(chat_id) % stripes]"""
+
+    def __init__(self, stripes=64):
+        self.locks = [threading.RLock() for _ in range(max(1, stripes))]
+
+    def __call__(self, chat_id):
+        return self.locks[hash(str(chat_id)) % len(self.locks)]
+
+
+def next_conversation(conv, record):
+    """Новая копия диалога после изменения record; исходный conv не трогается"""
+    op = record.get("op")
+    if op == "create":
+        return dict(record["conv"])
+    if op == "delete":
+        return None
+    conv = dict(conv) if conv is not None else {"messages": []}
+    if op == "set":
+        conv.update(record["fields"])
+    elif op == "append":
+        messages = conv.get("messages", []) + [record["msg"]]
+        keep = record.get("keep")
+        if keep and len(messages) > keep:
+            messages = messages[-keep:]
+        conv["messages"] = messages
+    return conv
+
+
+class JsonFileStore:
+    """Старое поведение: весь словарь переписывается на каждое изменение"""
+
+    def __init__(self, path, stripes=64):
+        self.path = path
+        self.data = {}
+        self.lock = threading.RLock()
+        self.chat_locks = StripedLocks(stripes)
+        self.seq = 0
+        self.save_lock = threading.Lock()
+        self.saved_seq = -1
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Ошибка загрузки диалогов: {e}")
+                self.data = {}
+        return self
+
+    def chat_lock(self, chat_id):
+        """Лок чата для составных операций вызывающего кода"""
+        return self.chat_locks(chat_id)
+
+    def get(self, chat_id):
+        return self.data.get(str(chat_id))
+
+    def items(self):
+        with self.lock:
+            return list(self.data.items())
+
+    def __len__(self):
+        return len(self.data)
+
+    def ensure(self, chat_id, defaults):
+        chat_id = str(chat_id)
+        conv = self.data.get(chat_id)
+        if conv is not None:
+            return conv
+        with self.chat_lock(chat_id):
+            if chat_id not in self.data:
+                self._commit({"op": "create", "chat": chat_id, "conv": json.loads(json.dumps(defaults))})
+            return self.data[chat_id]
+
+    def update(self, chat_id, **fields):
+        self._commit({"op": "set", "chat": str(chat_id), "fields": fields})
+
+    def append_message(self, chat_id, message, keep=None):
+        self._commit({"op": "append", "chat": str(chat_id), "msg": message, "keep": keep})
+
+    def open_orders(self):
+        """[(chat_id, airtable_record_id)] — оформленные заказы, еще не закрытые (order_closed)"""
+        with self.lock:
+            return [(chat_id, conv["airtable_record_id"]) for chat_id, conv in self.data.items()
+                    if conv.get("airtable_record_id") and not conv.get("order_closed")]
+
+    def _commit(self, record):
+        chat_id = record["chat"]
+        with self.chat_lock(chat_id):
+            # Копия собирается вне общего лока: его держим только на подмену и журнал
+            conv = next_conversation(self.data.get(chat_id), record)
+            with self.lock:
+                self.seq += 1
+                record["seq"] = self.seq
+                self._install(chat_id, conv, record)
+                self._log(record)
+        self._after_commit()
+
+    def _install(self, chat_id, conv, record):
+        if conv is None:
+            self.data.pop(chat_id, None)
+        else:
+            self.data[chat_id] = conv
+
+    def _apply(self, record):
+        chat_id = record.get("chat")
+        self._install(chat_id, next_conversation(self.data.get(chat_id), record), record)
+
+    def _log(self, record):
+        pass
+
+    def _after_commit(self):
+        self.save()
+
+    def _write_snapshot(self, snapshot, indent=None):
+        """Атомарная запись снимка: tmp-файл + fsync + os.replace"""
+        tmp_path = self.path + ".tmp"
+        separators = None if indent else (',', ':')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, indent=indent, separators=separators)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        # Словари диалогов неизменяемы, поэтому поверхностной копии достаточно
+        with self.lock:
+            snapshot = dict(self.data)
+            seq = self.seq
+        with self.save_lock:
+            if seq <= self.saved_seq:
+                return  # другой поток уже записал снимок не старше этого
+            try:
+                self._write_snapshot(snapshot, indent=2)
+                self.saved_seq = seq
+            except Exception as e:
+                print(f"⚠️ Ошибка сохранения диалогов: {e}")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.save()
+
+
+class JournalStore(JsonFileStore):
+    """Снимок + append-only журнал изменений с периодическим сжатием.
+
+    Сжатие не останавливает писателей: под локом берется поверхностная
+    копия словаря и журнал переименовывается в "<журнал>.old", снимок
+    пишется уже без лока. Каждая запись журнала имеет номер seq, а диалог
+    помнит номер последнего примененного изменения (journal_seq), поэтому
+    повторный проигрыш ".old" после сбоя посреди сжатия ничего не дублирует.
+    """
+
+    def __init__(self, path, compact_every=2000, fsync_interval=1.0, stripes=64):
+        super().__init__(path, stripes)
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.rotated_path = self.journal_path + ROTATED_SUFFIX
+        self.compact_every = compact_every
+        self.fsync_interval = fsync_interval
+        self.journal = None
+        self.journal_records = 0
+        self.last_fsync = 0.0
+        self.dirty = False
+        self.compact_lock = threading.Lock()
+        self.compact_pending = False
+
+    def load(self):
+        """Снимок + проигрыш журнала; на диске при этом ничего не меняется"""
+        super().load()
+        self.seq = max((conv.get("journal_seq", 0) for conv in self.data.values()), default=0)
+        replayed = 0
+        # ".old" остается, если прошлое сжатие не успело записать снимок
+        for path in (self.rotated_path, self.journal_path):
+            if os.path.exists(path):
+                replayed += self._replay(path)
+        if replayed:
+            print(f"📒 Восстановлено из журнала: {replayed} изменений")
+        # Журнал свернет первый flush() — не при импорте модуля бота
+        self.compact_pending = replayed > 0 or os.path.exists(self.rotated_path)
+        return self
+
+    def _replay(self, path):
+        replayed = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная при падении последняя строка
+                    print("⚠️ Пропущена поврежденная запись журнала")
+                    break
+                seq = record.get("seq")
+                conv = self.data.get(record.get("chat"))
+                if seq is not None and conv is not None and seq <= conv.get("journal_seq", 0):
+                    continue  # уже есть в снимке
+                self._apply(record)
+                self.seq = max(self.seq, seq or 0)
+                replayed += 1
+        return replayed
+
+    def _install(self, chat_id, conv, record):
+        if conv is not None and record.get("seq") is not None:
+            conv["journal_seq"] = record["seq"]
+        super()._install(chat_id, conv, record)
+
+    def _log(self, record):
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+        self.journal.flush()
+        self.journal_records += 1
+        self.dirty = True
+
+        now = time.monotonic()
+        if now - self.last_fsync >= self.fsync_interval:
+            self._fsync(now)
+
+    def _after_commit(self):
+        if self.journal_records >= self.compact_every:
+            self.compact(blocking=False)
+
+    def _fsync(self, now=None):
+        if self.journal is not None and self.dirty:
+            os.fsync(self.journal.fileno())
+            self.dirty = False
+        self.last_fsync = now if now is not None else time.monotonic()
+
+    def flush(self):
+        """Сбрасывает журнал на диск (вызывается фоновым таймером)"""
+        if self.compact_pending:
+            self.compact_pending = False
+            self.compact()
+        with self.lock:
+            try:
+                self._fsync()
+            except Exception as e:
+                print(f"⚠️ Ошибка fsync журнала: {e}")
+
+    def _rotate_journal(self):
+        """Текущий журнал -> ".old" (дописывается, если ".old" остался от сбоя)"""
+        if self.journal is not None:
+            self._fsync()
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.rotated_path):
+                with open(self.journal_path, 'r', encoding='utf-8') as src, \
+                        open(self.rotated_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.rotated_path)
+        self.journal = open(self.journal_path, 'w', encoding='utf-8')
+        self.journal_records = 0
+        self.dirty = False
+
+    def compact(self, blocking=True):
+        """Пишет новый снимок атомарно и обнуляет журнал"""
+        if not self.compact_lock.acquire(blocking=blocking):
+            return  # сжатие уже идет в другом потоке
+        try:
+            with self.lock:
+                snapshot = dict(self.data)
+                try:
+                    self._rotate_journal()
+                except Exception as e:
+                    print(f"⚠️ Ошибка сжатия журнала: {e}")
+                    return
+            try:
+                self._write_snapshot(snapshot)
+            except Exception as e:
+                # ".old" сохранен: следующее сжатие или загрузка его подхватят
+                print(f"⚠️ Ошибка сжатия журнала: {e}")
+                return
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+        finally:
+            self.compact_lock.release()
+
+    def close(self):
+        self.compact()
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+
+class SqliteStore:
+    """Диалоги в SQLite (WAL) с индексами по состоянию заказа"""
+
+    def __init__(self, path, cache_size=1000, stripes=64):
+        self.path = path
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.chat_locks = StripedLocks(stripes)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                chat_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                waiting_for_receipt INTEGER NOT NULL DEFAULT 0,
+                order_placed INTEGER NOT NULL DEFAULT 0,
+                has_pending_order INTEGER NOT NULL DEFAULT 0,
+                airtable_record_id TEXT,
+                last_interaction REAL,
+                order_open INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_conv_waiting ON conversations(waiting_for_receipt);
+            CREATE INDEX IF NOT EXISTS idx_conv_placed ON conversations(order_placed);
+            CREATE INDEX IF NOT EXISTS idx_conv_pending ON conversations(has_pending_order);
+            CREATE INDEX IF NOT EXISTS idx_conv_record ON conversations(airtable_record_id);
+            CREATE INDEX IF NOT EXISTS idx_conv_last ON conversations(last_interaction);
+            CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, id);
+        """)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(conversations)")}
+        if "order_open" not in columns:
+            # База старой версии: статус заказа неизвестен — считаем открытыми все
+            # оформленные, первое обновление статусов закроет завершенные
+            self.db.execute("ALTER TABLE conversations ADD COLUMN order_open INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("UPDATE conversations SET order_open = 1 WHERE airtable_record_id IS NOT NULL")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_conv_open ON conversations(order_open)")
+
+    def load(self, import_from=None):
+        """Один раз переносит старый JSON-файл в пустую базу (файл только читается)"""
+        if import_from and os.path.exists(import_from) and not len(self):
+            legacy = JournalStore(import_from).load()
+            with self.lock, self._transaction():
+                for chat_id, conv in legacy.items():
+                    self._write(chat_id, conv, replace_messages=True)
+            print(f"💾 Перенесено в SQLite диалогов: {len(legacy)}")
+        return self
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN/COMMIT; при ошибке ROLLBACK, чтобы общее соединение не застряло в транзакции"""
+        self.db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def chat_lock(self, chat_id):
+        """Лок чата для составных операций вызывающего кода"""
+        return self.chat_locks(chat_id)
+
+    def _columns(self, conv):
+        return (
+            int(bool(conv.get("waiting_for_receipt"))),
+            int(bool(conv.get("order_placed"))),
+            int(bool(conv.get("pending_order"))),
+            conv.get("airtable_record_id"),
+            conv.get("last_interaction"),
+            int(bool(conv.get("airtable_record_id")) and not conv.get("order_closed")),
+        )
+
+    def _write(self, chat_id, conv, replace_messages=False):
+        data = {k: v for k, v in conv.items() if k != "messages"}
+        self.db.execute(
+            "INSERT OR REPLACE INTO conversations "
+            "(chat_id, data, waiting_for_receipt, order_placed, has_pending_order, airtable_record_id, "
+            "last_interaction, order_open) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, json.dumps(data, ensure_ascii=False)) + self._columns(conv)
+        )
+        if replace_messages:
+            self.db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            self.db.executemany(
+                "INSERT INTO messages (chat_id, message) VALUES (?, ?)",
+                [(chat_id, json.dumps(m, ensure_ascii=False)) for m in conv.get("messages", [])]
+            )
+
+    def _remember(self, chat_id, conv):
+        self.cache[chat_id] = conv
+        self.cache.move_to_end(chat_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return conv
+
+    def _read(self, chat_id):
+        row = self.db.execute("SELECT data FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        conv = json.loads(row[0])
+        conv["messages"] = [
+            json.loads(m) for (m,) in self.db.execute(
+                "SELECT message FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,)
+            )
+        ]
+        return conv
+
+    def get(self, chat_id):
+        chat_id = str(chat_id)
+        with self.lock:
+            conv = self.cache.get(chat_id)
+            if conv is not None:
+                self.cache.move_to_end(chat_id)
+                return conv
+            conv = self._read(chat_id)
+            if conv is None:
+                return None
+            return self._remember(chat_id, conv)
+
+    def items(self):
+        """Полный проход по базе — только для обслуживания, не для горячего пути"""
+        with self.lock:
+            rows = self.db.execute("SELECT chat_id FROM conversations").fetchall()
+        return [(chat_id, self.get(chat_id)) for (chat_id,) in rows]
+
+    def ensure(self, chat_id, defaults):
+        chat_id = str(chat_id)
+        with self.chat_lock(chat_id):
+            conv = self.get(chat_id)
+            if conv is None:
+                conv = json.loads(json.dumps(defaults))
+                with self.lock:
+                    with self._transaction():
+                        self._write(chat_id, conv, replace_messages=True)
+                    self._remember(chat_id, conv)
+            return conv
+
+    def update(self, chat_id, **fields):
+        chat_id = str(chat_id)
+        with self.chat_lock(chat_id):
+            conv = next_conversation(self.get(chat_id), {"op": "set", "fields": fields})
+            with self.lock:
+                self._write(chat_id, conv)
+                self._remember(chat_id, conv)
+
+    def append_message(self, chat_id, message, keep=None):
+        chat_id = str(chat_id)
+        with self.chat_lock(chat_id):
+            conv = self.ensure(chat_id, {"messages": []})
+            trimmed = keep and len(conv.get("messages", [])) + 1 > keep
+            conv = next_conversation(conv, {"op": "append", "msg": message, "keep": keep})
+            with self.lock:
+                with self._transaction():
+                    self.db.execute(
+                        "INSERT INTO messages (chat_id, message) VALUES (?, ?)",
+                        (chat_id, json.dumps(message, ensure_ascii=False))
+                    )
+                    if trimmed:
+                        self.db.execute(
+                            "DELETE FROM messages WHERE chat_id = ? AND id NOT IN "
+                            "(SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?)",
+                            (chat_id, chat_id, keep)
+                        )
+                self._remember(chat_id, conv)
+
+    def open_orders(self):
+        """[(chat_id, airtable_record_id)] — запрос по индексу, без загрузки диалогов и сообщений"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT chat_id, airtable_record_id FROM conversations WHERE order_open = 1"
+            ).fetchall()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def start_flusher(store, interval=1.0):
+    """Фоновый поток: fsync журнала не реже чем раз в interval секунд"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            store.flush()
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+
+def open_store(path, backend=None):
+    """Создает хранилище по имени бэкенда (CONVERSATION_STORE: journal | json | sqlite)"""
+    backend = (backend or os.getenv("CONVERSATION_STORE", "journal")).lower()
+    stripes = int(os.getenv("CHAT_LOCK_STRIPES", "64"))
+    if backend == "sqlite":
+        store = SqliteStore(
+            os.path.splitext(path)[0] + ".db",
+            cache_size=int(os.getenv("SQLITE_CACHE_SIZE", "1000")),
+            stripes=stripes,
+        )
+        return store.load(import_from=path)
+    if backend == "json":
+        store = JsonFileStore(path, stripes=stripes)
+    else:
+        store = JournalStore(
+            path,
+            compact_every=int(os.getenv("JOURNAL_COMPACT_EVERY", "2000")),
+            fsync_interval=float(os.getenv("JOURNAL_FSYNC_INTERVAL", "1.0")),
+            stripes=stripes,
+        )
+    return store.load()
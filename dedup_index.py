@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# ======================== ДЕДУПЛИКАЦИЯ СООБЩЕНИЙ ========================
+#
+# Окно недавно обработанных id: O(1) на проверку, размер не больше
+# capacity, записи старше ttl вытесняются первыми. Окно сохраняется на
+# диск фоновым потоком (start_flusher) и при остановке, поэтому после
+# перезапуска старые сообщения не обрабатываются повторно, а прием
+# сообщений не ждет записи файла.
+#
+# Порядок в OrderedDict совпадает с порядком времени: повторно встреченный
+# id уходит в конец вместе с новым временем, поэтому вытеснение с начала
+# всегда убирает самые старые записи.
+
+
+class RecentIdIndex:
+    """LRU + TTL окно обработанных id; save()/flush() вызываются из фонового потока"""
+
+    def __init__(self, path=None, capacity=50000, ttl=86400):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.ids = OrderedDict()   # id -> время последней встречи
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.dirty = False
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    # Сортировка: файлы старых версий могли быть сохранены не по времени
+                    for msg_id, seen_at in sorted(json.load(f), key=lambda entry: entry[1]):
+                        self.ids[msg_id] = seen_at
+            except Exception as e:
+                print(f"⚠️ Ошибка загрузки индекса сообщений: {e}")
+            self._evict(time.time())
+        return self
+
+    def _evict(self, now):
+        while self.ids:
+            _, seen_at = next(iter(self.ids.items()))
+            if len(self.ids) > self.capacity or now - seen_at > self.ttl:
+                self.ids.popitem(last=False)
+            else:
+                break
+
+    def add_if_new(self, msg_id):
+        """True, если id встретился впервые (и запоминает его)"""
+        now = time.time()
+        with self.lock:
+            is_new = msg_id not in self.ids
+            self.ids[msg_id] = now
+            self.ids.move_to_end(msg_id)
+            self._evict(now)
+            self.dirty = True
+        return is_new
+
+    def __contains__(self, msg_id):
+        with self.lock:
+            return msg_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self):
+        """Атомарно сохраняет окно, если оно менялось"""
+        if not self.path:
+            return
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                snapshot = list(self.ids.items())
+                self.dirty = False
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f, separators=(',', ':'))
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"⚠️ Ошибка сохранения индекса сообщений: {e}")
+                self.dirty = True
+
+    def flush(self):
+        self.save()
@@ -0,0 +1,134 @@
+import json
+import hashlib
+import tempfile
+
+import http_client
+
+# ======================== DROPBOX: ПОТОКОВАЯ ЗАГРУЗКА ========================
+#
+# Файл не собирается в памяти целиком: скачивание потоком сбрасывается во
+# временный файл на диске, попутно считается content_hash по алгоритму
+# Dropbox (sha256 от склейки sha256 каждого блока по 4 МБ) — так повторный
+# чек узнается еще до загрузки. Затем файл уходит в Dropbox кусками
+# фиксированного размера: маленький (один кусок) обычным files/upload,
+# большой — через upload session (start -> append_v2 -> finish).
+# В памяти одновременно находится не больше двух кусков.
+
+CONTENT_URL = "https://content.dropboxapi.com/2/files"
+API_URL = "https://api.dropboxapi.com/2"
+READ_SIZE = 64 * 1024
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class ContentHasher:
+    """Dropbox content_hash, считается потоково"""
+
+    def __init__(self):
+        self.overall = hashlib.sha256()
+        self.block = hashlib.sha256()
+        self.block_pos = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), HASH_BLOCK_SIZE - self.block_pos)
+            self.block.update(view[:take])
+            self.block_pos += take
+            view = view[take:]
+            if self.block_pos == HASH_BLOCK_SIZE:
+                self.overall.update(self.block.digest())
+                self.block = hashlib.sha256()
+                self.block_pos = 0
+
+    def hexdigest(self):
+        overall = self.overall.copy()
+        if self.block_pos:
+            overall.update(self.block.digest())
+        return overall.hexdigest()
+
+
+def spool_download(response):
+    """Скачивает поток во временный файл; возвращает (файл, content_hash, размер)"""
+    hasher = ContentHasher()
+    spool = tempfile.TemporaryFile()
+    size = 0
+    try:
+        for data in response.iter_content(chunk_size=READ_SIZE):
+            hasher.update(data)
+            spool.write(data)
+            size += len(data)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool, hasher.hexdigest(), size
+
+
+def file_chunks(f, chunk_size):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _content_call(token, method, arg, data, endpoint):
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/octet-stream",
+        "Dropbox-API-Arg": json.dumps(arg)
+    }
+    r = http_client.post(f"{CONTENT_URL}/{method}", endpoint=endpoint, headers=headers, data=data, timeout=60)
+    if r.status_code != 200:
+        raise RuntimeError(f"Dropbox {method}: {r.status_code} - {r.text[:200]}")
+    return r.json()
+
+
+def upload_chunks(token, chunks, path):
+    """Загружает поток кусков в path; возвращает метаданные файла Dropbox.
+
+    Реальный путь может отличаться от path (autorename) — он в path_display.
+    """
+    commit = {"path": path, "mode": "add", "autorename": True, "mute": False}
+    chunks = iter(chunks)
+    first = next(chunks, b"")
+    second = next(chunks, None)
+
+    if second is None:
+        return _content_call(token, "upload", commit, first, "dropbox.upload")
+
+    session = _content_call(token, "upload_session/start", {"close": False}, first, "dropbox.session_start")
+    cursor = {"session_id": session["session_id"], "offset": len(first)}
+    chunk = second
+    while chunk is not None:
+        _content_call(token, "upload_session/append_v2", {"cursor": cursor, "close": False}, chunk, "dropbox.session_append")
+        cursor["offset"] += len(chunk)
+        chunk = next(chunks, None)
+    return _content_call(token, "upload_session/finish", {"cursor": cursor, "commit": commit}, b"", "dropbox.session_finish")
+
+
+def direct_link(shared_link):
+    """Ссылка на просмотр -> прямая ссылка на файл"""
+    return shared_link.replace("www.dropbox.com", "dl.dropboxusercontent.com").replace("?dl=0", "")
+
+
+def shared_link(token, path):
+    """Публичная прямая ссылка на файл (создает новую или берет существующую)"""
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    share_data = {"path": path, "settings": {"requested_visibility": "public"}}
+    r = http_client.post(f"{API_URL}/sharing/create_shared_link_with_settings", endpoint="dropbox.share",
+                         idempotent=True, headers=headers, json=share_data, timeout=10)
+    if r.status_code == 200:
+        return direct_link(r.json().get("url", ""))
+    if r.status_code == 409:
+        # Ссылка уже существует, получаем её
+        r = http_client.post(f"{API_URL}/sharing/list_shared_links", endpoint="dropbox.list_links",
+                             idempotent=True, headers=headers, json={"path": path}, timeout=10)
+        if r.status_code == 200:
+            links = r.json().get("links", [])
+            if links:
+                return direct_link(links[0].get("url", ""))
+    return None
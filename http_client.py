@@ -0,0 +1,278 @@
+import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# ======================== ОБЩИЙ HTTP-ТРАНСПОРТ ========================
+#
+# Один пул keep-alive соединений на хост, таймауты по эндпоинтам,
+# повторы с экспоненциальной задержкой и джиттером на 429/5xx с учетом
+# Retry-After, гистограммы задержек по эндпоинтам.
+#
+# Неидемпотентные запросы (POST) повторяются только когда сервер их
+# точно не выполнил: 429, 503 и ошибка установки соединения.
+
+DEFAULT_TIMEOUT = float(os.getenv("HTTP_DEFAULT_TIMEOUT", "10"))
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "10"))
+RETRY_AFTER_MAX = float(os.getenv("HTTP_RETRY_AFTER_MAX", "60"))
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+SAFE_RETRY_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def parse_endpoint_timeouts(raw):
+    """HTTP_TIMEOUTS="dropbox.upload=60,whapi.typing=3" -> {эндпоинт: секунды}"""
+    timeouts = {}
+    for part in (raw or "").split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            try:
+                timeouts[name.strip()] = float(value)
+            except ValueError:
+                print(f"⚠️ Неверный таймаут в HTTP_TIMEOUTS: {part}")
+    return timeouts
+
+
+ENDPOINT_TIMEOUTS = parse_endpoint_timeouts(os.getenv("HTTP_TIMEOUTS"))
+
+# ======================== МЕТРИКИ ========================
+
+
+class LatencyHistograms:
+    """Гистограммы задержек и счетчики ответов по эндпоинтам"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def observe(self, endpoint, seconds, status):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = {"counts": [0] * (len(self.buckets) + 1), "total": 0, "sum": 0.0, "errors": 0, "retries": 0}
+                self.endpoints[endpoint] = stats
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    index = i
+                    break
+            stats["counts"][index] += 1
+            stats["total"] += 1
+            stats["sum"] += seconds
+            if status is None or status >= 400:
+                stats["errors"] += 1
+
+    def retried(self, endpoint):
+        with self.lock:
+            if endpoint in self.endpoints:
+                self.endpoints[endpoint]["retries"] += 1
+
+    def quantile(self, stats, q):
+        target = stats["total"] * q
+        seen = 0
+        for i, count in enumerate(stats["counts"]):
+            seen += count
+            if seen >= target and count:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(stats, counts=list(stats["counts"])) for name, stats in self.endpoints.items()}
+
+    def format_metrics(self):
+        lines = []
+        for name, stats in sorted(self.snapshot().items()):
+            avg = stats["sum"] / stats["total"] if stats["total"] else 0.0
+            lines.append(
+                f"🌐 {name}: {stats['total']} запр., ошибок {stats['errors']}, повторов {stats['retries']}, "
+                f"ср. {avg:.2f}с, p50≤{self.quantile(stats, 0.5)}с, p95≤{self.quantile(stats, 0.95)}с"
+            )
+        return "\n".join(lines) if lines else "🌐 HTTP: запросов не было"
+
+
+http_metrics = LatencyHistograms()
+
+# ======================== ПОВТОРЫ ========================
+
+
+def retry_delay(attempt, retry_after=None):
+    """Задержка перед повтором: Retry-After или full jitter backoff"""
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return max(0.0, min(delay, RETRY_AFTER_MAX))
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def should_retry_status(status, idempotent):
+    if idempotent:
+        return status in RETRY_STATUSES
+    return status in SAFE_RETRY_STATUSES
+
+
+def connect_failed(error):
+    """True, если запрос точно не ушел на сервер (соединение не установлено)"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# ======================== СИНХРОННЫЙ КЛИЕНТ ========================
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def session_for(url):
+    """Отдельная сессия (пул keep-alive соединений) на каждый хост"""
+    host = urlsplit(url).netloc
+    with sessions_lock:
+        session = sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            sessions[host] = session
+        return session
+
+
+def request(method, url, endpoint=None, timeout=None, retries=None, idempotent=None, before_attempt=None,
+            **kwargs):
+    """requests.request с пулом, повторами и метриками.
+
+    Возвращает последний ответ (даже неуспешный) — проверка статуса
+    остается на вызывающем коде. Сетевая ошибка после всех повторов
+    пробрасывается. before_attempt() вызывается перед каждой попыткой,
+    включая повторы (например, bucket.acquire для лимита запросов).
+    """
+    method = method.upper()
+    endpoint = endpoint or f"{method} {urlsplit(url).netloc}"
+    timeout = ENDPOINT_TIMEOUTS.get(endpoint, timeout or DEFAULT_TIMEOUT)
+    retries = MAX_RETRIES if retries is None else retries
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    session = session_for(url)
+
+    attempt = 0
+    while True:
+        if before_attempt is not None:
+            before_attempt()
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            http_metrics.observe(endpoint, time.monotonic() - started, None)
+            # Без идемпотентности повторяем только если соединение не установилось
+            if attempt >= retries or not (idempotent or connect_failed(e)):
+                raise
+            http_metrics.retried(endpoint)
+            time.sleep(retry_delay(attempt))
+            attempt += 1
+            continue
+
+        http_metrics.observe(endpoint, time.monotonic() - started, response.status_code)
+        if attempt >= retries or not should_retry_status(response.status_code, idempotent):
+            return response
+
+        http_metrics.retried(endpoint)
+        delay = retry_delay(attempt, response.headers.get("Retry-After"))
+        print(f"🔁 {endpoint}: {response.status_code}, повтор через {delay:.1f}с")
+        response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request("PATCH", url, **kwargs)
+
+# ======================== АСИНХРОННЫЙ КЛИЕНТ ========================
+
+async_client = None
+
+
+def get_async_client():
+    """Общий httpx.AsyncClient: пулы keep-alive соединений по хостам"""
+    global async_client
+    if async_client is None:
+        import httpx
+        async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=POOL_SIZE, max_connections=POOL_SIZE * 4),
+            timeout=DEFAULT_TIMEOUT,
+        )
+    return async_client
+
+
+async def async_request(method, url, endpoint=None, timeout=None, retries=None, idempotent=None,
+                        before_attempt=None, **kwargs):
+    """Асинхронный аналог request() на httpx с теми же правилами повторов.
+
+    before_attempt — блокирующая функция (bucket.acquire), ее ждем в потоке,
+    чтобы не останавливать цикл событий.
+    """
+    import asyncio
+    import httpx
+
+    method = method.upper()
+    endpoint = endpoint or f"{method} {urlsplit(url).netloc}"
+    timeout = ENDPOINT_TIMEOUTS.get(endpoint, timeout or DEFAULT_TIMEOUT)
+    retries = MAX_RETRIES if retries is None else retries
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    client = get_async_client()
+
+    attempt = 0
+    while True:
+        if before_attempt is not None:
+            await asyncio.to_thread(before_attempt)
+        started = time.monotonic()
+        try:
+            response = await client.request(method, url, timeout=timeout, **kwargs)
+        except httpx.TransportError as e:
+            http_metrics.observe(endpoint, time.monotonic() - started, None)
+            not_sent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+            if attempt >= retries or not (idempotent or not_sent):
+                raise
+            http_metrics.retried(endpoint)
+            await asyncio.sleep(retry_delay(attempt))
+            attempt += 1
+            continue
+
+        http_metrics.observe(endpoint, time.monotonic() - started, response.status_code)
+        if attempt >= retries or not should_retry_status(response.status_code, idempotent):
+            return response
+
+        http_metrics.retried(endpoint)
+        delay = retry_delay(attempt, response.headers.get("Retry-After"))
+        print(f"🔁 {endpoint}: {response.status_code}, повтор через {delay:.1f}с")
+        await asyncio.sleep(delay)
+        attempt += 1
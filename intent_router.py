@@ -0,0 +1,205 @@
+import re
+
+# ======================== ЛОКАЛЬНЫЙ РОУТЕР НАМЕРЕНИЙ ========================
+#
+# Приветствия, просьбы показать меню, вопросы о цене и статусе заказа
+# распознаются локально по ключевым фразам (RU/KK/EN) и отвечаются по
+# шаблонам за миллисекунды — без запроса к модели. Фразы лежат в trie по
+# словам. Локальный ответ дается, только если в сообщении нет ничего,
+# кроме распознанных фраз, слов-связок и названий блюд: "привет" уйдет в
+# шаблон, а "привет, хочу два бургера" — в модель.
+
+INTENT_GREETING = "greeting"
+INTENT_MENU = "menu"
+INTENT_PRICE = "price"
+INTENT_STATUS = "status"
+
+# Чем выше в списке, тем важнее: "привет, покажи меню" — это запрос меню
+INTENT_PRIORITY = [INTENT_STATUS, INTENT_PRICE, INTENT_MENU, INTENT_GREETING]
+
+# Слово с "*" на конце совпадает по префиксу (падежи, окончания)
+PHRASES = {
+    INTENT_GREETING: {
+        "ru": ["привет*", "здравствуй*", "здраст*", "добрый день", "добрый вечер", "доброе утро",
+               "доброй ночи", "хай", "салам", "салют"],
+        "kk": ["сәлем*", "салем*", "сәлеметсіз бе", "салеметсиз бе", "сәлеметсіздер ме",
+               "қайырлы күн", "қайырлы таң", "қайырлы кеш", "армысыз", "армысыздар"],
+        "en": ["hi", "hello", "hey", "good morning", "good afternoon", "good evening"],
+    },
+    INTENT_MENU: {
+        "ru": ["меню", "покажи* меню", "скинь* меню", "пришли* меню", "что есть", "что у вас есть",
+               "ассортимент*"],
+        "kk": ["мәзір*", "мазир*", "мәзірді көрсет*", "не бар", "сізде не бар"],
+        "en": ["menu", "show menu", "show me the menu", "what do you have"],
+    },
+    INTENT_PRICE: {
+        "ru": ["сколько стои*", "цен*", "стоимост*", "почем*", "прайс*"],
+        "kk": ["қанша тұрады", "қанша", "бағасы*", "баға*"],
+        "en": ["how much", "how much is", "price*", "cost*"],
+    },
+    INTENT_STATUS: {
+        "ru": ["статус*", "статус заказа", "где мой заказ", "где заказ", "когда привез*",
+               "заказ готов"],
+        "kk": ["тапсырыс қайда", "тапсырысым қайда", "тапсырыс дайын ба", "мәртебе*"],
+        "en": ["status", "order status", "where is my order", "is my order ready"],
+    },
+}
+
+# Слова, которые не меняют смысл короткого служебного сообщения
+FILLER_WORDS = {
+    "а", "и", "у", "вас", "мне", "можно", "пожалуйста", "плиз", "ну", "ещё", "еще", "там", "мой",
+    "мои", "на", "за", "какая", "какие", "какой", "какое", "же", "ли", "подскажите",
+    "подскажи", "скажите", "скажи", "один", "одна", "одну", "шт",
+    "бе", "ма", "ме", "па", "пе", "сізде", "маған", "өтінемін", "бір", "қандай", "және",
+    "please", "the", "a", "an", "me", "your", "you", "is", "are", "of", "for", "one", "pls",
+    "there", "do", "what", "s", "all", "everyone", "and", "or", "всем", "или", "баршаңызға",
+}
+
+WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def normalize_text(text):
+    """Нижний регистр, ё->е, без пунктуации и лишних пробелов"""
+    text = (text or "").casefold().replace("ё", "е")
+    return " ".join(WORD_RE.findall(text))
+
+
+def tokenize(text):
+    return normalize_text(text).split()
+
+
+class PhraseTrie:
+    """Trie по словам: фраза -> (намерение, язык)"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, phrase, value):
+        node = self.root
+        for raw in phrase.split():
+            words = tokenize(raw)
+            for word in words[:-1]:
+                node = node.setdefault(word, {})
+            key = ("*", words[-1]) if raw.endswith("*") else words[-1]
+            node = node.setdefault(key, {})
+        node[None] = value
+
+    def _step(self, node, word):
+        """Дочерние узлы для слова: точное совпадение и совпадения по префиксу"""
+        nodes = []
+        if word in node:
+            nodes.append(node[word])
+        for key, child in node.items():
+            if isinstance(key, tuple) and word.startswith(key[1]):
+                nodes.append(child)
+        return nodes
+
+    def longest_match(self, words, start):
+        """(длина, значение) самой длинной фразы, начинающейся с words[start]"""
+        best = (0, None)
+        frontier = [self.root]
+        for i in range(start, len(words)):
+            frontier = [child for node in frontier for child in self._step(node, words[i])]
+            if not frontier:
+                break
+            for node in frontier:
+                if None in node:
+                    best = (i - start + 1, node[None])
+        return best
+
+
+def build_phrase_trie(phrases=PHRASES):
+    trie = PhraseTrie()
+    for intent, by_language in phrases.items():
+        for language, items in by_language.items():
+            for phrase in items:
+                trie.add(phrase, (intent, language))
+    return trie
+
+
+class IntentRouter:
+    """Классификатор коротких служебных сообщений"""
+
+    def __init__(self, menu_source):
+        self.menu_source = menu_source
+        self.trie = build_phrase_trie()
+
+    def _menu_items(self):
+        """Trie названий блюд для текущей версии меню"""
+        def build():
+            trie = PhraseTrie()
+            for items in self.menu_source.get().values():
+                for item in items:
+                    trie.add(item["name"], (item["name"], item["price"]))
+            return trie
+        return self.menu_source.render("intent_router.items", build)
+
+    def classify(self, text):
+        """(намерение, язык, найденные блюда) или None — тогда нужен AI"""
+        words = tokenize(text)
+        if not words or len(words) > 12:
+            return None
+
+        items_trie = self._menu_items()
+        intents = {}
+        items = []
+        i = 0
+        while i < len(words):
+            length, value = self.trie.longest_match(words, i)
+            item_length, item = items_trie.longest_match(words, i)
+            if item_length > length:
+                if item not in items:
+                    items.append(item)
+                i += item_length
+            elif length:
+                intent, language = value
+                intents.setdefault(intent, language)
+                i += length
+            elif words[i] in FILLER_WORDS or words[i].isdigit():
+                i += 1
+            else:
+                return None
+
+        intent = next((name for name in INTENT_PRIORITY if name in intents), None)
+        if intent is None:
+            return None
+        # Блюда без вопроса о цене — это уже заказ, его разбирает модель
+        if items and intent != INTENT_PRICE:
+            return None
+        if intent == INTENT_PRICE and not items:
+            return None
+        return intent, intents[intent], items
+
+
+# ======================== ШАБЛОНЫ ОТВЕТОВ ========================
+
+GREETING_REPLY = {
+    "ru": "Здравствуйте! 😊 Я помогу оформить заказ 🍔\nНапишите, что хотите заказать, или «меню», чтобы посмотреть блюда.",
+    "kk": "Сәлеметсіз бе! 😊 Тапсырыс беруге көмектесемін 🍔\nНе тапсырыс бергіңіз келетінін жазыңыз немесе тағамдарды көру үшін «мәзір» деп жазыңыз.",
+    "en": "Hello! 😊 I'll help you place an order 🍔\nTell me what you'd like, or type \"menu\" to see our dishes.",
+}
+
+MENU_FOOTER = {
+    "ru": "\nЧто будете заказывать? 😊",
+    "kk": "\nНе тапсырыс бересіз? 😊",
+    "en": "\nWhat would you like to order? 😊",
+}
+
+PRICE_FOOTER = {
+    "ru": "Оформить заказ?",
+    "kk": "Тапсырыс береміз бе?",
+    "en": "Shall I place the order?",
+}
+
+
+def greeting_reply(language):
+    return GREETING_REPLY.get(language, GREETING_REPLY["ru"])
+
+
+def menu_reply(language, menu_text):
+    return menu_text.strip() + "\n" + MENU_FOOTER.get(language, MENU_FOOTER["ru"])
+
+
+def price_reply(language, items):
+    lines = [f"• {name} — {price}₸" for name, price in items]
+    return "\n".join(lines) + "\n\n" + PRICE_FOOTER.get(language, PRICE_FOOTER["ru"])
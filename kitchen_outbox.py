@@ -0,0 +1,142 @@
+import json
+import time
+import random
+import sqlite3
+import threading
+
+# ======================== ОЧЕРЕДЬ ОТПРАВКИ НА КУХНЮ ========================
+#
+# Постоянный outbox: ключ идемпотентности — id записи Airtable.
+# Заказ проходит состояния
+#   pending -> sent (повара получили заказ) -> done (статус Cooking в Airtable)
+# Если после отправки поварам не удалось обновить статус, повторяется
+# только обновление статуса — повторно на кухню заказ не уходит.
+# Доставленные (done) записи удаляются через retention секунд. Записи
+# failed не удаляются никогда: в Airtable такой заказ так и остался
+# оплаченным в статусе Waiting, и без записи-надгробия следующая полная
+# синхронизация поставила бы его в очередь и отправила на кухню повторно.
+
+STATE_PENDING = "pending"
+STATE_SENT = "sent"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+class KitchenOutbox:
+    """SQLite-outbox для доставки заказов на кухню"""
+
+    def __init__(self, path, max_attempts=10, retry_base=5.0, retry_max=300.0, retention=7 * 86400):
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.retention = retention
+        self.last_purge = 0.0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS kitchen_outbox (
+                record_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                order_data TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_outbox_due ON kitchen_outbox(state, next_attempt_at);
+            CREATE INDEX IF NOT EXISTS idx_outbox_updated ON kitchen_outbox(updated_at);
+        """)
+
+    def enqueue(self, record_id, order_data):
+        """Добавляет заказ; повторный вызов с тем же record_id ничего не делает"""
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO kitchen_outbox "
+                "(record_id, state, order_data, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (record_id, STATE_PENDING, json.dumps(order_data, ensure_ascii=False), now, now, now)
+            )
+            return cursor.rowcount == 1
+
+    def due(self, limit=50):
+        """[(record_id, state, order_data)] — что пора отправить или довести до конца"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT record_id, state, order_data FROM kitchen_outbox "
+                "WHERE state IN (?, ?) AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (STATE_PENDING, STATE_SENT, time.time(), limit)
+            ).fetchall()
+        return [(record_id, state, json.loads(data)) for record_id, state, data in rows]
+
+    def next_due_in(self):
+        """Секунд до ближайшей попытки по незавершенным записям (None — их нет)"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MIN(next_attempt_at) FROM kitchen_outbox WHERE state IN (?, ?)",
+                (STATE_PENDING, STATE_SENT)
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def state(self, record_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT state FROM kitchen_outbox WHERE record_id = ?", (record_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, record_id, state, extra_sql="", params=()):
+        with self.lock:
+            self.db.execute(
+                f"UPDATE kitchen_outbox SET state = ?, updated_at = ?{extra_sql} WHERE record_id = ?",
+                (state, time.time()) + tuple(params) + (record_id,)
+            )
+
+    def mark_sent(self, record_id):
+        # Обновление статуса — следующий шаг, пробуем сразу
+        self._set_state(record_id, STATE_SENT, ", attempts = 0, next_attempt_at = ?, last_error = NULL", (time.time(),))
+
+    def mark_done(self, record_id):
+        self._set_state(record_id, STATE_DONE, ", last_error = NULL")
+
+    def schedule_retry(self, record_id, error):
+        """Экспоненциальная задержка; после max_attempts — failed (тогда возвращает True)"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT attempts, state FROM kitchen_outbox WHERE record_id = ?", (record_id,)
+            ).fetchone()
+        if row is None:
+            return False
+        attempts, state = row[0] + 1, row[1]
+        if attempts >= self.max_attempts:
+            print(f"❌ Заказ {record_id}: исчерпаны попытки ({state}): {error}")
+            self._set_state(record_id, STATE_FAILED, ", attempts = ?, last_error = ?", (attempts, error))
+            return True
+        delay = min(self.retry_max, self.retry_base * (2 ** (attempts - 1))) * random.uniform(0.8, 1.2)
+        self._set_state(
+            record_id, state, ", attempts = ?, next_attempt_at = ?, last_error = ?",
+            (attempts, time.time() + delay, error)
+        )
+        return False
+
+    def purge(self):
+        """Удаляет доставленные записи старше retention (не чаще раза в час); failed остаются"""
+        now = time.time()
+        if now - self.last_purge < 3600:
+            return 0
+        self.last_purge = now
+        with self.lock:
+            cursor = self.db.execute(
+                "DELETE FROM kitchen_outbox WHERE state = ? AND updated_at < ?",
+                (STATE_DONE, now - self.retention)
+            )
+        return cursor.rowcount
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM kitchen_outbox GROUP BY state").fetchall())
@@ -0,0 +1,31 @@
+import sys
+import threading
+
+import bot
+import a
+
+# ======================== ОБА КАНАЛА В ОДНОМ ПРОЦЕССЕ ========================
+#
+# WhatsApp (bot.py) и Telegram (a.py) поверх общего order_engine: одно меню,
+# один кэш ответов, общий лимит запросов к AI, общий лимит запросов к
+# Airtable (rate_limit.shared_bucket) и общий пул HTTP-соединений.
+# Telegram работает в главном потоке (run_polling ловит сигналы), опрос
+# WhatsApp — в отдельном потоке. Диалоги каналов хранятся в своих файлах.
+
+
+def main():
+    if bot.SHARD_COUNT > 1:
+        # Шарды — отдельные процессы WhatsApp; Telegram допускает одного получателя апдейтов
+        print("⚠️ При SHARD_COUNT>1 запускайте bot.py и a.py отдельно")
+        sys.exit(1)
+
+    poll_interval = bot.start_whatsapp(report_metrics=False)
+    threading.Thread(target=bot.poll_forever, args=(poll_interval,), daemon=True).start()
+    try:
+        a.main(extra_metrics=[bot.chat_pool])
+    finally:
+        bot.stop_whatsapp()
+        print("\n👋 Система остановлена")
+
+if __name__ == "__main__":
+    main()
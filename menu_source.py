@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# ======================== МЕНЮ И КЭШ ПРОМПТОВ ========================
+#
+# Меню берется из JSON-файла (MENU_FILE), если он задан, иначе из словаря
+# в коде. Файл перечитывается при изменении mtime — без перезапуска бота.
+# Все тексты, собранные из меню (системный промпт, текст меню), кэшируются
+# по ключу (ключ, версия меню) и сбрасываются автоматически, когда меню
+# меняется. Промпт при этом остается побайтно одинаковым между запросами.
+
+
+def menu_hash(menu):
+    raw = json.dumps(menu, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]
+
+
+class MenuSource:
+    """Меню с горячей перезагрузкой и версионированным кэшем текстов"""
+
+    def __init__(self, default_menu, path=None, check_interval=5.0):
+        self.default_menu = default_menu
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.menu = default_menu
+        self.version = menu_hash(default_menu)
+        self.mtime = None
+        self.last_check = 0.0
+        self.rendered = {}
+        self.listeners = []
+        self.reload()
+
+    def reload(self):
+        """Перечитывает файл меню; при ошибке остается прежнее меню"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, 'r', encoding='utf-8') as f:
+                menu = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Ошибка загрузки меню из {self.path}: {e}")
+            return False
+
+        version = menu_hash(menu)
+        with self.lock:
+            self.mtime = mtime
+            if version == self.version:
+                return False
+            self.menu = menu
+            self.version = version
+            self.rendered = {}
+            listeners = list(self.listeners)
+        print(f"🍔 Меню обновлено, версия {version}")
+        for listener in listeners:
+            listener(version)
+        return True
+
+    def _maybe_reload(self):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self.mtime:
+            self.reload()
+
+    def get(self):
+        self._maybe_reload()
+        return self.menu
+
+    def current_version(self):
+        self._maybe_reload()
+        return self.version
+
+    def on_change(self, listener):
+        """Подписка на смену версии меню (например, для сброса кэшей)"""
+        self.listeners.append(listener)
+
+    def render(self, key, builder):
+        """Возвращает builder() из кэша для текущей версии меню"""
+        version = self.current_version()
+        cache_key = (key, version)
+        text = self.rendered.get(cache_key)
+        if text is None:
+            text = builder()
+            with self.lock:
+                if self.version == version:
+                    self.rendered[cache_key] = text
+        return text
@@ -0,0 +1,104 @@
+import time
+import asyncio
+
+# ======================== СКЛЕЙКА СООБЩЕНИЙ (DEBOUNCE) ========================
+#
+# Клиенты часто пишут одну мысль несколькими короткими сообщениями подряд.
+# Сообщения чата копятся, пока клиент не замолчит на quiet секунд (но не
+# дольше max_wait с первого сообщения), и уходят в AI одним ходом.
+# Если новое сообщение приходит, пока ответ на предыдущие еще генерируется,
+# генерация отменяется, а ее сообщения склеиваются с новым. После
+# turn.commit() (ответ уже сохранен в истории) ход не отменяется — новое
+# сообщение станет следующим ходом и дождется завершения текущего.
+
+
+class Turn:
+    """Один ход диалога: склеенные сообщения и задача, которая на них отвечает"""
+
+    def __init__(self, texts, first_at):
+        self.texts = texts
+        self.first_at = first_at
+        self.task = None
+        self.committed = False
+        self.cancelled = False
+
+    def commit(self):
+        """Дальше отменять нельзя: ответ сохранен и отправляется"""
+        self.committed = True
+
+    def cancel(self):
+        self.cancelled = True
+        self.task.cancel()
+
+
+class MessageCoalescer:
+    """Debounce сообщений по чатам для asyncio-бота"""
+
+    def __init__(self, handler, quiet=1.0, max_wait=5.0):
+        self.handler = handler      # async handler(chat_id, text, update, turn)
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self.chats = {}             # chat_id -> {"texts", "first_at", "update", "timer", "turn"}
+        self.messages = 0
+        self.turns = 0
+        self.superseded = 0
+
+    def submit(self, chat_id, text, update):
+        """Добавляет сообщение; ход запустится после паузы"""
+        self.messages += 1
+        loop = asyncio.get_running_loop()
+        state = self.chats.setdefault(chat_id, {
+            "texts": [], "first_at": None, "update": None, "timer": None, "turn": None
+        })
+
+        turn = state["turn"]
+        if turn is not None and not (turn.committed or turn.cancelled or turn.task.done()):
+            # Ответ на прошлые сообщения устарел — генерируем заново по всем вместе.
+            # Отмененный ход остается в state: следующий дождется его очистки
+            turn.cancel()
+            self.superseded += 1
+            state["texts"] = turn.texts + state["texts"]
+            state["first_at"] = turn.first_at
+
+        now = time.monotonic()
+        state["texts"].append(text)
+        state["update"] = update
+        if state["first_at"] is None:
+            state["first_at"] = now
+
+        if state["timer"] is not None:
+            state["timer"].cancel()
+        delay = max(0.0, min(self.quiet, state["first_at"] + self.max_wait - now))
+        state["timer"] = loop.call_later(delay, self._flush, chat_id)
+
+    def _flush(self, chat_id):
+        state = self.chats.get(chat_id)
+        if not state or not state["texts"]:
+            return
+        previous = state["turn"]
+        turn = Turn(state["texts"], state["first_at"])
+        state.update(texts=[], first_at=None, timer=None, turn=turn)
+        self.turns += 1
+        turn.task = asyncio.ensure_future(
+            self._run(chat_id, "\n".join(turn.texts), state["update"], turn, previous)
+        )
+
+    async def _run(self, chat_id, text, update, turn, previous):
+        try:
+            # Ответы одного чата не обгоняют друг друга
+            if previous is not None and previous.task is not None and not previous.task.done():
+                await asyncio.wait([previous.task])
+            await self.handler(chat_id, text, update, turn)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"❌ Ошибка обработки сообщений {chat_id}: {e}")
+        finally:
+            state = self.chats.get(chat_id)
+            if state and state["turn"] is turn and not state["texts"]:
+                del self.chats[chat_id]
+
+    def format_metrics(self):
+        merged = self.messages - self.turns
+        return (f"💬 Склейка сообщений: {self.messages} сообщ. -> {self.turns} ходов AI"
+                f" (склеено {merged}, отменено генераций {self.superseded}), активных чатов {len(self.chats)}")
@@ -0,0 +1,641 @@
+import os
+import re
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+from menu_source import MenuSource
+from context_window import build_messages, estimate_tokens, fold_overflow
+from intent_router import (
+    IntentRouter, INTENT_GREETING, INTENT_MENU, INTENT_PRICE,
+    greeting_reply, menu_reply, price_reply
+)
+from response_cache import ResponseCache
+from order_extractor import (
+    REPLY_SCHEMA, STRUCTURED_INSTRUCTION, extract_order, parse_structured_reply, validate_order
+)
+
+# ======================== ДВИЖОК ДИАЛОГА ЗАКАЗА ========================
+#
+# Общая для WhatsApp (bot.py) и Telegram (a.py) часть: меню, системный
+# промпт, язык клиента, история в бюджете токенов, шаблонные ответы, кэш
+# ответов, запрос к AI и разбор заказа. Каналы — тонкие адаптеры: прием
+# сообщений, отправка ответов, чеки, статусы и Airtable.
+#
+# Меню, кэши, клиенты AI и лимит параллельных запросов создаются один раз
+# на процесс. Когда оба канала запущены вместе (main.py), все это у них
+# общее, как и пул HTTP-соединений из http_client.
+
+load_dotenv()
+
+PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
+LLM_MODEL = os.getenv("LLM_MODEL", "sonar-pro")
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.6"))
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "600"))
+
+# Один лимит на все каналы процесса
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+
+# История для AI: бюджет токенов вместо фиксированного числа сообщений
+HISTORY_KEEP = int(os.getenv("HISTORY_KEEP", "40"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "300"))
+
+# Приветствия, меню и цены отвечаются по шаблонам без AI
+LOCAL_INTENTS = os.getenv("LOCAL_INTENTS", "1") == "1"
+
+# Кэш ответов AI на типовые вопросы (similarity > 0 — искать и похожие вопросы)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))
+
+# Заказ из ответа AI: structured output (JSON по схеме) вместо поиска JSON в тексте
+ORDER_STRUCTURED_OUTPUT = os.getenv("ORDER_STRUCTURED_OUTPUT", "0") == "1"
+
+ERROR_REPLY = "Извините, ошибка связи. Повторите пожалуйста."
+
+# ======================== МЕНЮ ========================
+
+MENU = {
+    "Бургеры": [
+        {"name": "Классический бургер", "price": 1500, "desc": "Говядина, салат, помидор, сыр"},
+        {"name": "Чизбургер", "price": 1800, "desc": "Двойной сыр, говядина, соус"},
+        {"name": "Курица бургер", "price": 1600, "desc": "Куриная котлета, салат, майонез"},
+        {"name": "Фиш бургер", "price": 1700, "desc": "Рыбная котлета, сырный соус"}
+    ],
+    "Пицца": [
+        {"name": "Маргарита", "price": 2500, "desc": "Томаты, моцарелла, базилик"},
+        {"name": "Пепперони", "price": 3000, "desc": "Колбаса пепперони, сыр"},
+        {"name": "4 сыра", "price": 3200, "desc": "Моцарелла, чеддер, пармезан, дор блю"},
+        {"name": "Мясная", "price": 3500, "desc": "Говядина, ветчина, бекон"}
+    ],
+    "Напитки": [
+        {"name": "Кола", "price": 500, "desc": "0.5л"},
+        {"name": "Фанта", "price": 500, "desc": "0.5л"},
+        {"name": "Спрайт", "price": 500, "desc": "0.5л"},
+        {"name": "Сок", "price": 600, "desc": "0.5л апельсиновый"}
+    ],
+    "Допы": [
+        {"name": "Картофель фри", "price": 800, "desc": "Средняя порция"},
+        {"name": "Наггетсы", "price": 1200, "desc": "6 шт"},
+        {"name": "Луковые кольца", "price": 900, "desc": "10 шт"},
+        {"name": "Соусы", "price": 200, "desc": "Кетчуп, майонез, сырный"}
+    ]
+}
+
+# Меню можно вынести в JSON-файл и менять без перезапуска
+MENU_FILE = os.getenv("MENU_FILE")
+menu_source = MenuSource(MENU, MENU_FILE)
+intent_router = IntentRouter(menu_source)
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+menu_source.on_change(response_cache.clear)
+
+KASPI_PAYMENT_INFO = {
+    "ru": "💳 Номер Kaspi: +7 777 123 4567\n👤 Получатель: ТОО 'Доставка'",
+    "kk": "💳 Kaspi нөмірі: +7 777 123 4567\n👤 Алушы: 'Жеткізу' ЖШС",
+    "en": "💳 Kaspi number: +7 777 123 4567\n👤 Recipient: Delivery LLC"
+}
+
+
+PRICE_CORRECTION_NOTE = {
+    "ru": "💰 Сумма по меню: {total:,}₸",
+    "kk": "💰 Мәзір бойынша сома: {total:,}₸",
+    "en": "💰 Total by menu: {total:,}₸"
+}
+
+# ======================== СТАТУС ЗАКАЗА ========================
+
+# Общие тексты для /status, «где мой заказ» и уведомлений обоих каналов.
+# receipt — Telegram (фото или PDF), receipt_pdf — WhatsApp (только PDF)
+ORDER_STATUS_TEXTS = {
+    "ru": {
+        "none": "У вас пока нет активных заказов 🤷‍♂️",
+        "receipt": "⏳ Ожидаем чек оплаты\n\nПришлите фото или PDF чека, чтобы мы начали готовить ваш заказ 📸",
+        "receipt_pdf": "⏳ Ожидаем чек оплаты\n\nПришлите PDF чека, чтобы мы начали готовить ваш заказ 📸",
+        "error": "❌ Не удалось проверить статус заказа",
+        "unpaid": "⏳ Чек на проверке у менеджера\n\n"
+                  "Если есть проблемы с оплатой, менеджер свяжется с вами.\n"
+                  "Обычно проверка занимает 5-10 минут ⏱",
+        "Cooking": "✅ Оплата принята!\n👨‍🍳 Ваш заказ готовится на кухне\n\nСкоро доставим! 🚀",
+        "Ready": "✅ Заказ готов!\n🚗 Курьер уже в пути к вам!",
+        "other": "✅ Оплата принята!\n⏳ Заказ в обработке",
+    },
+    "kk": {
+        "none": "Сізде әзірге белсенді тапсырыс жоқ 🤷‍♂️",
+        "receipt": "⏳ Төлем чегін күтеміз\n\nТапсырысты дайындай бастауымыз үшін чектің фотосын немесе PDF файлын жіберіңіз 📸",
+        "receipt_pdf": "⏳ Төлем чегін күтеміз\n\nТапсырысты дайындай бастауымыз үшін PDF чекті жіберіңіз 📸",
+        "error": "❌ Тапсырыс мәртебесін тексеру мүмкін болмады",
+        "unpaid": "⏳ Чек менеджерде тексерілуде\n\n"
+                  "Егер төлеммен проблема болса, менеджер сізбен байланысады.\n"
+                  "Әдетте тексеру 5-10 минут алады ⏱",
+        "Cooking": "✅ Төлем қабылданды!\n👨‍🍳 Тапсырысыңыз асханада дайындалуда\n\nЖақын арада жеткіземіз! 🚀",
+        "Ready": "✅ Тапсырыс дайын!\n🚗 Курьер сізге қарай жолда!",
+        "other": "✅ Төлем қабылданды!\n⏳ Тапсырыс өңделуде",
+    },
+    "en": {
+        "none": "You don't have any active orders yet 🤷‍♂️",
+        "receipt": "⏳ Waiting for the payment receipt\n\nSend a photo or PDF of the receipt so we can start preparing your order 📸",
+        "receipt_pdf": "⏳ Waiting for the payment receipt\n\nSend the receipt as a PDF so we can start preparing your order 📸",
+        "error": "❌ Couldn't check the order status",
+        "unpaid": "⏳ Receipt is being checked by manager\n\n"
+                  "If there are payment issues, manager will contact you.\n"
+                  "Usually takes 5-10 minutes ⏱",
+        "Cooking": "✅ Payment accepted!\n👨‍🍳 Your order is being prepared\n\nWe'll deliver soon! 🚀",
+        "Ready": "✅ Order is ready!\n🚗 Courier is on the way!",
+        "other": "✅ Payment accepted!\n⏳ Order is being processed",
+    },
+}
+
+
+def order_status_reply(language, key):
+    """Текст статуса на языке клиента: none, receipt, receipt_pdf, error, unpaid"""
+    texts = ORDER_STATUS_TEXTS.get(language, ORDER_STATUS_TEXTS["ru"])
+    return texts.get(key, texts["other"])
+
+
+def paid_status_reply(language, paid, kitchen_status):
+    """Текст для клиента по статусу оплаты и кухни"""
+    if not paid:
+        return order_status_reply(language, "unpaid")
+    return order_status_reply(language, kitchen_status if kitchen_status in ("Cooking", "Ready") else "other")
+
+# ======================== ГЕНЕРАЦИЯ МЕНЮ ========================
+
+def generate_menu_text(language="ru"):
+    menu = menu_source.get()
+    if language == "kk":
+        menu_text = "\n🍽 МӘЗІР:\n\n"
+        categories_kk = {
+            "Бургеры": "Бургерлер",
+            "Пицца": "Пицца",
+            "Напитки": "Сусындар",
+            "Допы": "Қосымша"
+        }
+        for category, items in menu.items():
+            menu_text += f"━━ {categories_kk.get(category, category)} ━━\n"
+            for item in items:
+                menu_text += f"  • {item['name']}: {item['price']}₸\n    ({item['desc']})\n"
+            menu_text += "\n"
+    elif language == "en":
+        menu_text = "\n🍽 MENU:\n\n"
+        for category, items in menu.items():
+            menu_text += f"━━ {category} ━━\n"
+            for item in items:
+                menu_text += f"  • {item['name']}: {item['price']}₸\n    ({item['desc']})\n"
+            menu_text += "\n"
+    else:  # ru
+        menu_text = "\n🍽 МЕНЮ:\n\n"
+        for category, items in menu.items():
+            menu_text += f"━━ {category} ━━\n"
+            for item in items:
+                menu_text += f"  • {item['name']}: {item['price']}₸\n    ({item['desc']})\n"
+            menu_text += "\n"
+    return menu_text
+
+# ======================== SYSTEM PROMPT ========================
+
+# Как канал принимает чек: receipt — Telegram (фото или PDF),
+# receipt_pdf — WhatsApp (обработчик чеков принимает только PDF)
+RECEIPT_INSTRUCTIONS = {
+    "receipt": {
+        "ru": "3. Выдача реквизитов и просьба скинуть чек.",
+        "kk": "3. Төлем деректерін беру және чекті сұрау.",
+        "en": "3. Give payment info and ask for receipt.",
+    },
+    "receipt_pdf": {
+        "ru": "3. Выдача реквизитов и просьба прислать официальный чек Kaspi в формате PDF (фото и скриншоты не принимаем). Заказ уходит на кухню ТОЛЬКО после чека.",
+        "kk": "3. Төлем деректерін беру және ресми Kaspi чегін PDF форматында сұрау (фото мен скриншот қабылданбайды). Тапсырыс асханаға ТЕК чектен кейін беріледі.",
+        "en": "3. Give payment info and ask for the official Kaspi receipt as a PDF (photos and screenshots are not accepted). The order goes to the kitchen ONLY after the receipt.",
+    },
+}
+
+def get_system_prompt(language="ru", receipt="receipt"):
+    """Промпт собирается один раз на (язык, способ приема чека, версия меню)"""
+    return menu_source.render(
+        ("system_prompt", language, receipt), lambda: build_system_prompt(language, receipt)
+    )
+
+def build_system_prompt(language="ru", receipt="receipt"):
+    menu_text = generate_menu_text(language)
+    payment_info = KASPI_PAYMENT_INFO.get(language, KASPI_PAYMENT_INFO["ru"])
+    instructions = RECEIPT_INSTRUCTIONS[receipt]
+    receipt_stage = instructions.get(language, instructions["ru"])
+    
+    common_rules = """
+NO MARKDOWN. NO **bold**. NO *italic*. NO `code`.
+Just clear, plain text.
+Don't be robotic. Be human, friendly and fast.
+"""
+    
+    if language == "kk":
+        return f"""Сіз фаст-фуд жеткізу қызметінің сатушысысыз.
+{common_rules}
+МАҚСАТ: Тапсырысты қабылдау және Kaspi арқылы төлем сұрау.
+
+Сөйлесу мәнері:
+- Қысқа әрі нұсқа жауап беріңіз.
+- Клиентпен дос сияқты сөйлесіңіз.
+- "Жұлдызша" немесе "астын сызу" белгілерін ҚОЛДАНБАҢЫЗ.
+- Эмодзи: әр хабарламада 1-2 ғана.
+
+САТУ КЕЗЕҢДЕРІ:
+1. Амандасу және таңдауға көмектесу.
+2. Тапсырысты нақтылау (комбо ұсыну).
+{receipt_stage}
+
+ТАПСЫРЫС ДАЙЫН БОЛҒАНДА (тауар, баға, адрес, телефон бар):
+Келесі JSON форматын ҚОСЫҢЫЗ (клиентке көрсетілмейді, тек жүйе үшін):
+{{
+  "order_confirmed": true,
+  "customer_name": "Аты",
+  "phone": "Телефон",
+  "order_items": ["Тауар 1", "Тауар 2"],
+  "total_price": 5000,
+  "delivery_address": "Мекенжай"
+}}
+
+МӘЗІР:
+{menu_text}
+
+{payment_info}
+"""
+    
+    elif language == "en":
+        return f"""You are a fast food delivery seller.
+{common_rules}
+GOAL: Take the order and request Kaspi payment.
+
+Style:
+- Short and clear answers.
+- Talk like a friend.
+- DO NOT use markdown (*, **).
+- Emojis: 1-2 per message max.
+
+STAGES:
+1. Greet and help choose.
+2. Confirm items (upsell combo).
+{receipt_stage}
+
+WHEN ORDER IS READY (items, price, address, phone are known):
+Include this JSON (invisible to user, for system only):
+{{
+  "order_confirmed": true,
+  "customer_name": "Name",
+  "phone": "Phone",
+  "order_items": ["Item 1", "Item 2"],
+  "total_price": 5000,
+  "delivery_address": "Address"
+}}
+
+MENU:
+{menu_text}
+
+{payment_info}
+"""
+    
+    else:  # Russian
+        return f"""Ты — продавец доставки фаст-фуда.
+{common_rules}
+ЦЕЛЬ: Принять заказ и запросить оплату Kaspi.
+
+Стиль общения:
+- Пиши кратко и по делу.
+- Общайся как друг, тепло и просто.
+- ЗАПРЕЩЕНО использовать жирный шрифт (звездочки **) или курсив.
+- Эмодзи: 1-2 на сообщение, не больше.
+
+ЭТАПЫ:
+1. Приветствие и помощь с выбором.
+2. Уточнение заказа (предложи комбо).
+{receipt_stage}
+
+КОГДА ЗАКАЗ СОБРАН (есть блюда, сумма, адрес, телефон):
+Вставь этот JSON (клиент его не увидит, он для системы):
+{{
+  "order_confirmed": true,
+  "customer_name": "Имя",
+  "phone": "Телефон",
+  "order_items": ["Товар 1", "Товар 2"],
+  "total_price": 5000,
+  "delivery_address": "Адрес"
+}}
+
+МЕНЮ:
+{menu_text}
+
+{payment_info}
+"""
+
+def detect_language(text):
+    """Грубо определяет язык по алфавиту: kk / ru / en"""
+    text = (text or "").lower()
+    if re.search(r'[әғқңөұүһі]', text):
+        return "kk"
+    if re.search(r'[а-яё]', text):
+        return "ru"
+    if re.search(r'[a-z]', text):
+        return "en"
+    return "ru"
+
+def clean_markdown(text):
+    """Удаляет markdown символы из текста"""
+    if not text:
+        return ""
+    # Удаляем жирный, курсив, код
+    text = re.sub(r'\*\*|__|\*|_|`', '', text)
+    # Удаляем заголовки
+    text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
+    return text.strip()
+
+def visible_stream_text(raw):
+    """Часть потока, которую уже можно показать клиенту.
+
+    Все, начиная с возможного JSON заказа ("```" или "{"), придерживается
+    до конца генерации — клиент не должен увидеть служебный блок.
+    """
+    cut = len(raw)
+    for marker in ("```", "{"):
+        pos = raw.find(marker)
+        if pos != -1:
+            cut = min(cut, pos)
+    visible = raw[:cut]
+    # Незаконченная "`" или "``" в конце может оказаться началом "```"
+    visible = visible.rstrip("`")
+    return clean_markdown(visible)
+
+# ======================== AI КЛИЕНТЫ И ЛИМИТ ========================
+
+class LlmLimiter:
+    """Общий лимит одновременных запросов к AI для потоков и asyncio.
+
+    Места считает один threading.BoundedSemaphore. Корутины встают в очередь
+    asyncio.Semaphore (FIFO), а общее место ждут в собственном пуле из limit
+    потоков: пул по умолчанию не занят, опроса нет, очередь не нарушается.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+        # В пуле ждут не больше limit корутин одного цикла — больше потоков не нужно
+        self.executor = ThreadPoolExecutor(max_workers=limit, thread_name_prefix="llm-limiter")
+        self.async_semaphore = None     # создается в цикле событий при первом запросе
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.semaphore.release()
+
+    def _release_when_acquired(self, future):
+        """Корутину отменили, а поток все равно получит место — вернуть его"""
+        if not future.cancelled() and future.exception() is None:
+            self.semaphore.release()
+
+    async def __aenter__(self):
+        if self.async_semaphore is None:
+            self.async_semaphore = asyncio.Semaphore(self.limit)
+        await self.async_semaphore.acquire()
+        acquired = asyncio.get_running_loop().run_in_executor(self.executor, self.semaphore.acquire)
+        try:
+            await asyncio.shield(acquired)
+        except BaseException:
+            acquired.add_done_callback(self._release_when_acquired)
+            self.async_semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+        self.async_semaphore.release()
+
+
+llm_limiter = LlmLimiter(LLM_CONCURRENCY)
+llm_client = OpenAI(api_key=PERPLEXITY_API_KEY, base_url="https://api.perplexity.ai")
+async_llm_client = AsyncOpenAI(api_key=PERPLEXITY_API_KEY, base_url="https://api.perplexity.ai")
+
+
+def llm_request(messages, structured=False, stream=False):
+    """Параметры chat.completions.create, одинаковые для всех каналов"""
+    request = dict(
+        model=LLM_MODEL,
+        messages=messages,
+        temperature=LLM_TEMPERATURE,
+        max_tokens=LLM_MAX_TOKENS,
+        extra_body={"disable_search": True}
+    )
+    if structured:
+        request["response_format"] = {"type": "json_schema", "json_schema": {"schema": REPLY_SCHEMA}}
+    if stream:
+        request["stream"] = True
+    return request
+
+# ======================== ДИАЛОГ ========================
+
+class OrderEngine:
+    """Диалог заказа одного канала поверх его хранилища диалогов"""
+
+    def __init__(self, new_conversation, store=None, on_order=None, receipt="receipt"):
+        self.new_conversation = new_conversation    # () -> поля нового диалога канала
+        self.store = store
+        self.on_order = on_order                    # on_order(chat_id, order_data) — заказ принят, ждем чек
+        self.receipt = receipt                      # ключ RECEIPT_INSTRUCTIONS и статуса ожидания чека
+
+    def ensure(self, chat_id):
+        return self.store.ensure(str(chat_id), self.new_conversation())
+
+    def remember(self, chat_id, message):
+        """Сохраняет сообщение; вытесненные из истории сворачиваются в сводку"""
+        chat_id = str(chat_id)
+        # Сводка и добавление — одна операция: между ними история не должна меняться
+        with self.store.chat_lock(chat_id):
+            conv = self.ensure(chat_id)
+            summary = fold_overflow(conv, HISTORY_KEEP, SUMMARY_TOKEN_BUDGET)
+            if summary is not None:
+                self.store.update(chat_id, history_summary=summary)
+            self.store.append_message(chat_id, message, keep=HISTORY_KEEP)
+            # Диалоги copy-on-write: conv — снимок до добавления, возвращаем новый
+            return self.store.get(chat_id)
+
+    def remember_turn(self, chat_id, user_message, reply):
+        self.remember(chat_id, {"role": "user", "content": user_message})
+        self.remember(chat_id, {"role": "assistant", "content": reply})
+
+    def language(self, chat_id, text=None, guess=None):
+        """Язык диалога; определяется по первому сообщению и запоминается"""
+        conv = self.ensure(chat_id)
+        if conv.get("language"):
+            return conv["language"]
+        language = guess or detect_language(text)
+        self.store.update(str(chat_id), language=language)
+        return language
+
+    # ---------- шаблоны и кэш ----------
+
+    def route(self, chat_id, text):
+        """(намерение, язык, блюда) служебного сообщения или None, если нужен AI"""
+        if not LOCAL_INTENTS:
+            return None
+        routed = intent_router.classify(text)
+        if routed is None:
+            return None
+        intent, language, items = routed
+        return intent, self.language(chat_id, guess=language), items
+
+    def template_reply(self, intent, language, items):
+        """Ответ по шаблону; статус заказа каждый канал отвечает сам"""
+        if intent == INTENT_GREETING:
+            return greeting_reply(language)
+        if intent == INTENT_MENU:
+            menu_text = menu_source.render(("menu_text", language), lambda: generate_menu_text(language))
+            return menu_reply(language, menu_text)
+        if intent == INTENT_PRICE:
+            return price_reply(language, items)
+        return None
+
+    def cache_key(self, chat_id, text):
+        """Ключ кэша ответов; None — ход зависит от корзины, не кэшируем"""
+        conv = self.ensure(chat_id)
+        if conv.get("pending_order") or conv.get("waiting_for_receipt"):
+            return None
+        phase = "chat" if conv.get("messages") else "start"
+        language = conv.get("language") or detect_language(text)
+        return response_cache.key(text, phase, language, menu_source.current_version())
+
+    def cached_reply(self, chat_id, text, cache_key):
+        """Ответ из кэша (ход сразу сохраняется в истории) или None"""
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            print(f"🗃 {chat_id}: ответ из кэша")
+            self.remember_turn(chat_id, text, cached)
+        return cached
+
+    # ---------- AI ----------
+
+    def prepare(self, chat_id, user_message, structured=False):
+        """Запрос к AI: промпт, история в бюджете, новое сообщение"""
+        language = self.language(chat_id, user_message)
+        conv = self.ensure(chat_id)
+        system_prompt = get_system_prompt(language, self.receipt)
+        if structured:
+            system_prompt += STRUCTURED_INSTRUCTION
+        
+        # История в пределах бюджета токенов; старое — в сводке внутри промпта
+        context, prompt_tokens = build_messages(
+            system_prompt, conv.get("messages", []), HISTORY_TOKEN_BUDGET, conv.get("history_summary"),
+            summary_budget=SUMMARY_TOKEN_BUDGET, language=language
+        )
+        prompt_tokens += estimate_tokens(user_message)
+        
+        # Роли должны чередоваться: подряд идущие сообщения одной роли пропускаем
+        messages = context[:1]
+        last_role = None
+        for msg in context[1:]:
+            role = msg.get("role")
+            if role in ["user", "assistant"] and role != last_role:
+                messages.append(msg)
+                last_role = role
+        # Последним в истории должен быть assistant, иначе будет два user подряд
+        if len(messages) > 1 and messages[-1].get("role") == "user":
+            messages.pop()
+        
+        messages.append({"role": "user", "content": user_message})
+        return messages, prompt_tokens
+
+    def accept_order(self, chat_id, order_data, ai_reply):
+        """Проверяет заказ по схеме и меню; сохраняет его до получения чека"""
+        order_data, errors, notes = validate_order(order_data, menu_source.get())
+        if errors:
+            print(f"⚠️ {chat_id}: заказ не принят — {'; '.join(errors)}")
+            return ai_reply
+        if notes:
+            print(f"⚠️ {chat_id}: заказ исправлен — {'; '.join(notes)}")
+            language = self.ensure(chat_id).get("language") or "ru"
+            note = PRICE_CORRECTION_NOTE.get(language, PRICE_CORRECTION_NOTE["ru"])
+            ai_reply += "\n\n" + note.format(total=order_data["total_price"])
+        if not order_data["price_verified"]:
+            print(f"⚠️ {chat_id}: сумма {order_data['total_price']} не сверена с меню: {order_data['order_items']}")
+        
+        print("✅ Заказ распознан!")
+        # Запись в Airtable создается только после чека
+        self.store.update(str(chat_id), pending_order=order_data, waiting_for_receipt=True)
+        if self.on_order:
+            self.on_order(chat_id, order_data)
+        return ai_reply
+
+    def finish(self, chat_id, user_message, raw, structured=False, cache_key=None):
+        """Вынимает заказ, чистит текст, сохраняет ход диалога и кэширует ответ"""
+        print(f"🤖 AI Raw: {raw[:50]}...")
+        
+        # Заказ: из structured output или из JSON в тексте (JSON из текста убирается)
+        order_data, text = None, None
+        if structured:
+            try:
+                order_data, text = parse_structured_reply(raw)
+            except (ValueError, AttributeError):
+                print(f"⚠️ {chat_id}: ответ не по схеме, ищу JSON в тексте")
+        if text is None:
+            order_data, text = extract_order(raw)
+        
+        ai_reply = text
+        if order_data and order_data.get("order_confirmed"):
+            ai_reply = self.accept_order(chat_id, order_data, ai_reply)
+        
+        ai_reply = clean_markdown(ai_reply)
+        if order_data is None:
+            response_cache.put(cache_key, ai_reply)
+        
+        self.remember_turn(chat_id, user_message, ai_reply)
+        return ai_reply
+
+    def log_usage(self, chat_id, messages, prompt_tokens, response=None):
+        usage = getattr(response, "usage", None)
+        print(f"🧮 {chat_id}: промпт ~{prompt_tokens} токенов"
+              f" (факт: {getattr(usage, 'prompt_tokens', '?')}), история: {len(messages) - 2} сообщ.")
+
+    def respond(self, chat_id, user_message, cache_key=None):
+        """Ответ AI для каналов на потоках (WhatsApp)"""
+        structured = ORDER_STRUCTURED_OUTPUT
+        messages, prompt_tokens = self.prepare(chat_id, user_message, structured)
+        try:
+            with llm_limiter:
+                response = llm_client.chat.completions.create(**llm_request(messages, structured))
+        except Exception as e:
+            print(f"❌ Ошибка AI: {e}")
+            return ERROR_REPLY
+        self.log_usage(chat_id, messages, prompt_tokens, response)
+        return self.finish(chat_id, user_message, response.choices[0].message.content, structured, cache_key)
+
+    async def respond_async(self, chat_id, user_message, cache_key=None):
+        """Ответ AI для asyncio-каналов (Telegram)"""
+        structured = ORDER_STRUCTURED_OUTPUT
+        messages, prompt_tokens = self.prepare(chat_id, user_message, structured)
+        try:
+            async with llm_limiter:
+                response = await async_llm_client.chat.completions.create(**llm_request(messages, structured))
+        except Exception as e:
+            print(f"❌ Ошибка AI: {e}")
+            return ERROR_REPLY
+        self.log_usage(chat_id, messages, prompt_tokens, response)
+        return self.finish(chat_id, user_message, response.choices[0].message.content, structured, cache_key)
+
+    async def stream_async(self, chat_id, user_message, on_text, cache_key=None):
+        """Потоковый ответ AI: on_text(видимый_текст) вызывается по мере генерации"""
+        messages, prompt_tokens = self.prepare(chat_id, user_message)
+        try:
+            raw = ""
+            async with llm_limiter:
+                stream = await async_llm_client.chat.completions.create(**llm_request(messages, stream=True))
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        raw += delta
+                        await on_text(visible_stream_text(raw))
+        except Exception as e:
+            print(f"❌ Ошибка AI: {e}")
+            return ERROR_REPLY
+        self.log_usage(chat_id, messages, prompt_tokens)
+        return self.finish(chat_id, user_message, raw, cache_key=cache_key)
@@ -0,0 +1,221 @@
+import re
+import json
+
+# ======================== ИЗВЛЕЧЕНИЕ ЗАКАЗА ИЗ ОТВЕТА AI ========================
+#
+# JSON заказа ищется одним проходом по тексту без регулярных выражений:
+# сканер считает глубину скобок и корректно пропускает строки и escape-
+# последовательности, поэтому вложенные объекты и "}" внутри строк не
+# ломают разбор. Сканер инкрементальный — его можно кормить кусками
+# потокового ответа. Найденный заказ проверяется по схеме, а total_price
+# сверяется с ценами меню. Пересчет — только если каждая позиция разобрана
+# однозначно ("Чизбургер x2"); "2 чизбургера", "Кола 2" или "Наггетсы (6 шт)"
+# не трогают сумму AI, заказ лишь помечается price_verified=False.
+#
+# Если провайдер поддерживает structured output, ответ сразу приходит
+# JSON-объектом {"reply": ..., "order": ...} и сканировать текст не нужно.
+
+ORDER_FIELDS = {
+    "customer_name": {"type": "string"},
+    "phone": {"type": "string"},
+    "order_items": {"type": "array", "items": {"type": "string"}},
+    "total_price": {"type": "integer"},
+    "delivery_address": {"type": "string"},
+}
+
+REPLY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reply": {"type": "string"},
+        "order": {
+            "anyOf": [
+                {
+                    "type": "object",
+                    "properties": dict(ORDER_FIELDS, order_confirmed={"type": "boolean"}),
+                    "required": ["order_confirmed", "phone", "order_items", "total_price", "delivery_address"],
+                },
+                {"type": "null"},
+            ]
+        },
+    },
+    "required": ["reply", "order"],
+}
+
+STRUCTURED_INSTRUCTION = """
+ФОРМАТ ОТВЕТА: верни JSON-объект с полями
+- "reply": текст для клиента (без служебного JSON),
+- "order": данные подтвержденного заказа в описанном выше формате или null.
+"""
+
+# Позиция без лишнего текста: только название и необязательный множитель "x2" / "2x".
+# "шт" сюда не входит — в меню так записан размер порции ("Наггетсы", 6 шт)
+QUANTITY_RE = re.compile(r'\s*(?:[xх×*]\s*(\d+)|(\d+)\s*[xх×*])?\s*', re.IGNORECASE)
+PHONE_DIGITS_MIN = 10
+JSON_OUTSIDE_STRING_CHARS = set(" \t\r\n{}[]:,-+.0123456789eEtrufalsn")
+
+
+class JsonObjectScanner:
+    """Инкрементальный поиск JSON-объектов верхнего уровня в тексте"""
+
+    def __init__(self):
+        self.pos = 0            # сколько символов уже просмотрено
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.start = None
+        self.current = []       # символы текущего объекта
+
+    def _abandon(self):
+        """Кандидат оказался не JSON: вернуть его символы после "{" на повторный разбор"""
+        replay = self.current[1:]
+        self.pos = self.start + 1
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.current = []
+        return replay
+
+    def feed(self, chunk):
+        """Добавляет кусок текста; возвращает [(start, end, object)] найденных объектов"""
+        found = []
+        pending = list(chunk)
+        pending.reverse()
+        while pending:
+            ch = pending.pop()
+            index = self.pos
+            self.pos += 1
+            if self.depth == 0:
+                if ch == "{":
+                    self.depth = 1
+                    self.start = index
+                    self.current = [ch]
+                continue
+
+            self.current.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        found.append((self.start, index + 1, json.loads("".join(self.current))))
+                        self.current = []
+                    except json.JSONDecodeError:
+                        pending.extend(reversed(self._abandon()))
+            elif ch not in JSON_OUTSIDE_STRING_CHARS:
+                # Вне строк в JSON не бывает букв (кроме true/false/null) —
+                # это была обычная "{" в тексте, ищем дальше сразу за ней
+                pending.extend(reversed(self._abandon()))
+        return found
+
+
+def _strip_fence(text, start, end):
+    """Расширяет [start, end) на окружающий ```json ... ``` блок, если он есть"""
+    before = text[:start].rstrip()
+    for fence in ("```json", "```JSON", "```"):
+        if before.endswith(fence):
+            after = text[end:]
+            stripped = after.lstrip()
+            if stripped.startswith("```"):
+                return len(before) - len(fence), end + (len(after) - len(stripped)) + 3
+            break
+    return start, end
+
+
+def extract_order(text):
+    """(заказ или None, текст без служебного JSON) за один проход по тексту"""
+    found = JsonObjectScanner().feed(text)
+
+    order = None
+    span = None
+    for start, end, obj in found:
+        if isinstance(obj, dict) and "order_confirmed" in obj:
+            order, span = obj, (start, end)
+    if span is None:
+        return None, text
+    start, end = _strip_fence(text, *span)
+    return order, (text[:start] + text[end:]).strip()
+
+
+def parse_structured_reply(content):
+    """Ответ в режиме structured output -> (заказ или None, текст для клиента)"""
+    data = json.loads(content)
+    order = data.get("order")
+    return (order if isinstance(order, dict) else None), (data.get("reply") or "").strip()
+
+
+def menu_prices(menu):
+    return {item["name"].casefold(): item["price"] for items in menu.values() for item in items}
+
+
+def price_items(order_items, menu):
+    """Сумма по меню или None, если хотя бы одна позиция разобрана неоднозначно"""
+    prices = menu_prices(menu)
+    # Длинные названия первыми: "Чизбургер" не должен совпасть как "бургер"
+    names = sorted(prices, key=len, reverse=True)
+    total = 0
+    for line in order_items:
+        text = line.casefold()
+        name = next((n for n in names if n in text), None)
+        if name is None:
+            return None
+        rest = text.replace(name, " ", 1)
+        match = QUANTITY_RE.fullmatch(rest)
+        if match is None:
+            return None
+        quantity = int(match.group(1) or match.group(2) or 1)
+        total += prices[name] * quantity
+    return total
+
+
+def validate_order(order, menu):
+    """Проверяет заказ по схеме; возвращает (заказ, ошибки, замечания).
+
+    Ошибки — заказ принимать нельзя. Замечания — заказ исправлен
+    (total_price пересчитан по однозначно разобранным позициям).
+    price_verified=False — сумму AI сверить с меню не удалось.
+    """
+    errors = []
+    notes = []
+    order = dict(order)
+
+    items = order.get("order_items")
+    if isinstance(items, str):
+        items = [part.strip() for part in items.split(",")]
+    if not isinstance(items, list) or not [i for i in items if isinstance(i, str) and i.strip()]:
+        errors.append("order_items: пустой список")
+        items = []
+    order["order_items"] = [i.strip() for i in items if isinstance(i, str) and i.strip()]
+
+    phone = str(order.get("phone") or "")
+    if sum(ch.isdigit() for ch in phone) < PHONE_DIGITS_MIN:
+        errors.append(f"phone: неверный номер '{phone}'")
+
+    if not str(order.get("delivery_address") or "").strip():
+        errors.append("delivery_address: не указан")
+
+    try:
+        total_price = int(float(str(order.get("total_price", "")).replace(" ", "")))
+    except (ValueError, OverflowError):
+        # "abc", "nan" — ValueError; "inf", "1e400" — OverflowError
+        total_price = None
+
+    menu_total = price_items(order["order_items"], menu) if order["order_items"] else None
+    if menu_total is not None and menu_total != total_price:
+        notes.append(f"total_price: {total_price} -> {menu_total} по меню")
+        total_price = menu_total
+    if not total_price or total_price <= 0:
+        errors.append("total_price: не указана сумма")
+    order["total_price"] = total_price
+    order["price_verified"] = menu_total is not None and menu_total == total_price
+
+    return order, errors, notes
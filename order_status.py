@@ -0,0 +1,76 @@
+import time
+import threading
+
+# ======================== КЭШ СТАТУСОВ ЗАКАЗОВ ========================
+#
+# Локальная модель чтения для /status: record_id -> оплата и статус кухни.
+# Фоновая синхронизация обновляет все отслеживаемые заказы одним пакетным
+# запросом к Airtable (filterByFormula по списку RECORD_ID()), а /status
+# читает из кэша, если данные не старше заданного max_age. Изменения
+# статуса возвращаются синхронизации — по ним можно уведомить клиента.
+
+FINAL_STATUSES = {"Ready", "Delivered"}
+RECORDS_PER_QUERY = 50
+
+
+def status_from_fields(fields):
+    return {
+        'payment_correct': bool(fields.get('Is_Paid')),
+        'kitchen_status': fields.get('Kitchen_Status', 'Waiting')
+    }
+
+
+def record_ids_formula(record_ids):
+    """filterByFormula для выборки записей по списку id"""
+    conditions = ",".join(f"RECORD_ID()='{record_id}'" for record_id in record_ids)
+    return f"OR({conditions})"
+
+
+class OrderStatusCache:
+    """Статусы отслеживаемых заказов с отметкой времени обновления"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statuses = {}   # record_id -> (status, updated_at)
+        self.owners = {}     # record_id -> chat_id, кого уведомлять
+
+    def track(self, record_id, chat_id):
+        with self.lock:
+            self.owners[record_id] = chat_id
+
+    def untrack(self, record_id):
+        with self.lock:
+            self.owners.pop(record_id, None)
+
+    def tracked(self):
+        with self.lock:
+            return list(self.owners)
+
+    def owner(self, record_id):
+        with self.lock:
+            return self.owners.get(record_id)
+
+    def get(self, record_id, max_age):
+        """Статус из кэша или None, если его нет или он старше max_age секунд"""
+        with self.lock:
+            cached = self.statuses.get(record_id)
+        if cached is None or time.time() - cached[1] > max_age:
+            return None
+        return cached[0]
+
+    def put(self, record_id, status):
+        """Сохраняет статус; возвращает прежний (None, если его не было)"""
+        with self.lock:
+            previous = self.statuses.get(record_id)
+            self.statuses[record_id] = (status, time.time())
+        return previous[0] if previous else None
+
+    def apply(self, records):
+        """Записи Airtable -> [(record_id, прежний статус, новый статус)] для изменившихся"""
+        changes = []
+        for record in records:
+            status = status_from_fields(record.get('fields', {}))
+            previous = self.put(record['id'], status)
+            if previous != status:
+                changes.append((record['id'], previous, status))
+        return changes
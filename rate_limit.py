@@ -0,0 +1,47 @@
+import time
+import threading
+
+# ======================== ЛИМИТЫ ЗАПРОСОВ ========================
+#
+# Общий token bucket для внешних API: Airtable (запросов в секунду на
+# базу) и Telegram (сообщений в секунду на бота и на чат). Лимит одного
+# API в процессе один: каналы берут bucket по имени через shared_bucket.
+
+
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # Меньше одного токена копить нельзя: при rate < 1 (лимит, поделенный
+        # между шардами) acquire никогда бы не дождался целого токена
+        self.capacity = max(1.0, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Блокирует поток, пока не появится токен"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+shared_buckets = {}
+shared_buckets_lock = threading.Lock()
+
+
+def shared_bucket(name, rate):
+    """Один bucket на имя в процессе; rate задает тот, кто создал его первым"""
+    with shared_buckets_lock:
+        bucket = shared_buckets.get(name)
+        if bucket is None:
+            bucket = shared_buckets[name] = TokenBucket(rate)
+        return bucket
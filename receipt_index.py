@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# ======================== ИНДЕКС ЧЕКОВ ПО СОДЕРЖИМОМУ ========================
+#
+# content_hash файла (алгоритм Dropbox) -> путь в Dropbox и прямая ссылка.
+# Клиенты часто присылают тот же PDF повторно: такой чек не загружается
+# заново и не требует новых вызовов API. Для каждого чека запоминаются
+# заказы, к которым он приложен, — один чек на разных заказах помечается
+# как возможное повторное использование оплаты.
+#
+# Несколько процессов (шарды) делят один файл индекса: с file_lock каждое
+# изменение делается под межпроцессным локом поверх свежей копии с диска.
+
+
+class ReceiptIndex:
+    """Постоянный индекс загруженных чеков"""
+
+    def __init__(self, path=None, file_lock=None):
+        self.path = path
+        self.entries = {}   # content_hash -> {"path", "link", "size", "owners", "created_at"}
+        self.lock = threading.Lock()
+        self.file_lock = file_lock
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Ошибка загрузки индекса чеков: {e}")
+        return self
+
+    @contextmanager
+    def _exclusive(self):
+        """Для общего индекса: лок на файл и перечитывание изменений других процессов"""
+        if self.file_lock is None:
+            yield
+            return
+        with self.file_lock:
+            self.load()
+            yield
+
+    def get(self, content_hash):
+        with self.lock:
+            entry = self.entries.get(content_hash)
+            return dict(entry) if entry else None
+
+    def add(self, content_hash, path, link, size):
+        with self._exclusive():
+            with self.lock:
+                # Тот же чек мог загрузить другой процесс: заказы, к которым
+                # он уже приложен, сохраняем — иначе повтор оплаты не заметим
+                known = self.entries.get(content_hash) or {}
+                self.entries[content_hash] = {
+                    "path": path,
+                    "link": link,
+                    "size": size,
+                    "owners": known.get("owners", []),
+                    "created_at": known.get("created_at", time.time())
+                }
+            self.save()
+
+    def claim(self, content_hash, owner):
+        """Привязывает чек к заказу; возвращает другие заказы с этим же чеком"""
+        with self._exclusive():
+            with self.lock:
+                entry = self.entries.get(content_hash)
+                if entry is None:
+                    return []
+                others = [o for o in entry["owners"] if o != owner]
+                if owner in entry["owners"]:
+                    return others
+                entry["owners"].append(owner)
+            self.save()
+        return others
+
+    def forget(self, content_hash):
+        """Убирает запись (например, если файл удален из Dropbox)"""
+        with self._exclusive():
+            with self.lock:
+                removed = self.entries.pop(content_hash, None)
+            if removed:
+                self.save()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self):
+        """Атомарная запись на диск (чеки приходят редко, пишем сразу)"""
+        if not self.path:
+            return
+        with self.lock:
+            snapshot = json.dumps(self.entries, ensure_ascii=False)
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(snapshot)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"⚠️ Ошибка сохранения индекса чеков: {e}")
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import heapq
+import threading
+
+# ======================== ПЛАНИРОВЩИК НАПОМИНАНИЙ ========================
+#
+# Один поток и min-heap дедлайнов вместо потока со sleep на каждый заказ.
+# У каждого ключа (чата) своя последовательность напоминаний, например
+# через 15 и 45 минут после подтверждения заказа. Повторное планирование
+# того же ключа заменяет прежнюю последовательность, отмена убирает ее:
+# устаревшие записи кучи не удаляются сразу, а пропускаются по номеру
+# поколения. Дедлайны сохраняются на диск и переживают перезапуск.
+
+
+class ReminderScheduler:
+    """Постоянные отложенные напоминания на одном потоке"""
+
+    def __init__(self, path=None, on_fire=None):
+        self.path = path
+        self.on_fire = on_fire      # on_fire(key, step, payload)
+        self.entries = {}           # key -> {"started_at", "delays", "step", "generation", "payload"}
+        self.heap = []              # (due_at, generation, key)
+        self.generation = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Ошибка загрузки напоминаний: {e}")
+                entries = {}
+            with self.cond:
+                now = time.time()
+                for key, entry in entries.items():
+                    # Пропущенные за время простоя шаги не шлем пачкой — только последний
+                    while (entry["step"] + 1 < len(entry["delays"])
+                           and entry["started_at"] + entry["delays"][entry["step"] + 1] <= now):
+                        entry["step"] += 1
+                    self._push(key, entry)
+            if entries:
+                print(f"⏰ Восстановлено напоминаний: {len(entries)}")
+        return self
+
+    def start(self, on_fire=None):
+        if on_fire is not None:
+            self.on_fire = on_fire
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+        return self
+
+    def _push(self, key, entry):
+        self.generation += 1
+        entry["generation"] = self.generation
+        self.entries[key] = entry
+        due_at = entry["started_at"] + entry["delays"][entry["step"]]
+        heapq.heappush(self.heap, (due_at, self.generation, key))
+        # Устаревших записей не должно стать больше живых
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [item for item in self.heap if self._is_live(item)]
+            heapq.heapify(self.heap)
+
+    def _is_live(self, item):
+        entry = self.entries.get(item[2])
+        return entry is not None and entry["generation"] == item[1]
+
+    def schedule(self, key, delays, payload=None):
+        """Планирует напоминания через delays секунд от текущего момента (заменяет прежние)"""
+        delays = sorted(delays)
+        if not delays:
+            return self.cancel(key)
+        with self.cond:
+            self._push(key, {"started_at": time.time(), "delays": delays, "step": 0, "payload": payload})
+            self.cond.notify()
+        self.save()
+
+    def cancel(self, key):
+        """True, если у ключа были запланированные напоминания"""
+        with self.cond:
+            removed = self.entries.pop(key, None)
+        if removed:
+            self.save()
+        return removed is not None
+
+    def pending(self, key):
+        with self.cond:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _next_due(self):
+        """Ждет ближайший дедлайн; возвращает (key, step, payload)"""
+        with self.cond:
+            while True:
+                while self.heap and not self._is_live(self.heap[0]):
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                due_at, _, key = self.heap[0]
+                delay = due_at - time.time()
+                if delay > 0:
+                    self.cond.wait(timeout=delay)
+                    continue
+                heapq.heappop(self.heap)
+                entry = self.entries[key]
+                step = entry["step"]
+                if step + 1 < len(entry["delays"]):
+                    entry["step"] = step + 1
+                    self._push(key, entry)
+                else:
+                    del self.entries[key]
+                return key, step, entry.get("payload")
+
+    def _loop(self):
+        while True:
+            key, step, payload = self._next_due()
+            self.save()
+            try:
+                if self.on_fire:
+                    self.on_fire(key, step, payload)
+            except Exception as e:
+                print(f"❌ Ошибка напоминания для {key}: {e}")
+
+    def save(self):
+        """Атомарная запись дедлайнов на диск"""
+        if not self.path:
+            return
+        with self.cond:
+            snapshot = json.dumps({
+                key: {k: v for k, v in entry.items() if k != "generation"}
+                for key, entry in self.entries.items()
+            }, ensure_ascii=False)
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(snapshot)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"⚠️ Ошибка сохранения напоминаний: {e}")
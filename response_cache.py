@@ -0,0 +1,201 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from intent_router import normalize_text, FILLER_WORDS
+
+# ======================== КЭШ ОТВЕТОВ AI ========================
+#
+# Клиенты часто задают одни и те же вопросы ("какие есть пиццы", "сколько
+# ждать доставку"). Ответ AI на такой вопрос кэшируется по ключу
+# (нормализованный текст, фаза диалога, язык, версия меню). Нормализация:
+# регистр, пунктуация, ё->е и сведение казахских букв к русским (қ->к,
+# ә->а, ...), чтобы "қандай пицца бар" и "кандай пицца бар" совпадали.
+#
+# При similarity > 0 дополнительно ищется близкий вопрос по косинусной
+# близости векторов символьных триграмм — это локальный "эмбеддинг" без
+# внешних моделей. Записи вытесняются по TTL и LRU; смена версии меню
+# сбрасывает кэш целиком.
+#
+# Кэшировать можно только самостоятельные вопросы и только вне оформления
+# заказа: ответ не должен зависеть от корзины конкретного клиента. Поэтому
+# кэшируются лишь темы из белого списка (доставка, часы работы, вопросы по
+# меню), а вопросы о сумме, заказе и просьбы вида "можно 2 чизбургера" или
+# "можно без лука?" всегда уходят в модель.
+
+KAZAKH_FOLD = str.maketrans({
+    "ә": "а", "ғ": "г", "қ": "к", "ң": "н", "ө": "о",
+    "ұ": "у", "ү": "у", "һ": "х", "і": "и",
+})
+
+KAZAKH_LETTERS = set("әғқңөұүһі")
+
+QUESTION_WORDS = {
+    "что", "какие", "какой", "какая", "какое", "сколько", "где", "когда", "как", "есть", "можно",
+    "почему", "кандай", "канша", "кашан", "кайда", "калай", "бар", "ма", "ме", "ба", "бе",
+    "what", "which", "how", "when", "where", "do", "does", "is", "are", "can",
+}
+
+# Темы, ответ на которые одинаков для всех клиентов. Слова уже в виде
+# fold_text (казахские буквы сведены к русским); "*" — совпадение по префиксу
+CACHEABLE_TOPICS = {
+    "delivery": ["доставк*", "доставля*", "курьер*", "ждать", "жеткиз*", "delivery", "deliver*"],
+    "hours": ["работаете", "работает", "открыт*", "открыва*", "закрыва*", "график*", "режим*", "выходн*",
+              "жумыс*", "ашык*", "open*", "close*", "hours"],
+    "menu": ["меню", "ассортимент*", "пицц*", "бургер*", "напит*", "закуск*", "соус*", "состав*",
+             "вегетариан*", "остр*", "мазир*", "сусын*", "menu", "pizza*", "burger*", "drink*", "sauce*"],
+}
+
+# Слова о корзине и самом заказе: такой вопрос никогда не кэшируется
+CART_WORDS = [
+    "заказ*", "итог*", "сумм*", "всего", "корзин*", "чек*", "мне", "меня", "мой", "моя", "мое", "мои",
+    "моем", "хочу", "хотим", "буду", "будем", "возьм*", "добав*", "убер*", "убра*", "без", "можно",
+    "тапсырыс*", "маган", "менин", "барлыгы", "керек", "алам*", "косы*",
+    "order*", "my", "total", "cart", "want", "add", "remove", "without", "can",
+]
+
+MAX_QUESTION_CHARS = 120
+
+
+def fold_text(text):
+    """Нормализованный текст для ключа кэша"""
+    return normalize_text(text).translate(KAZAKH_FOLD)
+
+
+def guess_language(text):
+    lowered = (text or "").casefold()
+    if any(ch in KAZAKH_LETTERS for ch in lowered):
+        return "kk"
+    if any("a" <= ch <= "z" for ch in lowered) and not any("а" <= ch <= "я" for ch in lowered):
+        return "en"
+    return "ru"
+
+
+def compile_words(patterns):
+    """(точные слова, префиксы) для быстрого has_word"""
+    exact = {p for p in patterns if not p.endswith("*")}
+    prefixes = tuple(p[:-1] for p in patterns if p.endswith("*"))
+    return exact, prefixes
+
+
+def has_word(words, compiled):
+    exact, prefixes = compiled
+    return any(w in exact or (prefixes and w.startswith(prefixes)) for w in words)
+
+
+TOPIC_WORDS = {topic: compile_words(patterns) for topic, patterns in CACHEABLE_TOPICS.items()}
+CART_WORDS_COMPILED = compile_words(CART_WORDS)
+
+
+def question_topic(text):
+    """Тема из белого списка или None, если вопрос может зависеть от корзины"""
+    words = fold_text(text).split()
+    if has_word(words, CART_WORDS_COMPILED) or any(w.isdigit() for w in words):
+        return None
+    return next((topic for topic, compiled in TOPIC_WORDS.items() if has_word(words, compiled)), None)
+
+
+def is_standalone_question(text):
+    """Вопрос из белого списка тем, ответ на который не зависит от предыдущих реплик"""
+    if not text or len(text) > MAX_QUESTION_CHARS:
+        return False
+    words = fold_text(text).split()
+    meaningful = [w for w in words if w not in FILLER_WORDS]
+    if len(meaningful) < 2:
+        return False
+    if "?" not in text and not any(w in QUESTION_WORDS for w in words):
+        return False
+    return question_topic(text) is not None
+
+
+def trigram_vector(text):
+    padded = f"  {text} "
+    vector = {}
+    for i in range(len(padded) - 2):
+        gram = padded[i:i + 3]
+        vector[gram] = vector.get(gram, 0) + 1
+    norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+    return {gram: v / norm for gram, v in vector.items()}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(gram, 0.0) for gram, v in a.items())
+
+
+class ResponseCache:
+    """TTL + LRU кэш ответов с опциональным поиском похожих вопросов"""
+
+    def __init__(self, capacity=1000, ttl=3600, similarity=0.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries = OrderedDict()   # key -> (reply, stored_at, vector)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def key(self, text, phase, language, version):
+        """Ключ кэша или None, если этот ход кэшировать нельзя"""
+        if phase is None or not is_standalone_question(text):
+            return None
+        return (phase, language or guess_language(text), version, fold_text(text))
+
+    def get(self, key):
+        if key is None:
+            return None
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+
+            reply = self._similar(key, now) if self.similarity > 0 else None
+            if reply is None:
+                self.misses += 1
+            else:
+                self.similar_hits += 1
+            return reply
+
+    def _similar(self, key, now):
+        vector = trigram_vector(key[3])
+        best, best_score = None, self.similarity
+        for other, (reply, stored_at, other_vector) in self.entries.items():
+            if other[:3] != key[:3] or now - stored_at > self.ttl:
+                continue
+            score = cosine(vector, other_vector)
+            if score >= best_score:
+                best, best_score = other, score
+        if best is None:
+            return None
+        self.entries.move_to_end(best)
+        return self.entries[best][0]
+
+    def put(self, key, reply):
+        if key is None or not reply:
+            return
+        vector = trigram_vector(key[3]) if self.similarity > 0 else None
+        with self.lock:
+            self.entries[key] = (reply, time.time(), vector)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self, *_):
+        """Сброс (подписывается на смену версии меню)"""
+        with self.lock:
+            self.entries.clear()
+
+    def format_metrics(self):
+        with self.lock:
+            total = self.hits + self.similar_hits + self.misses
+            rate = (self.hits + self.similar_hits) / total * 100 if total else 0.0
+            return (f"🗃 Кэш ответов: {len(self.entries)} записей, попаданий {self.hits}"
+                    f" (+{self.similar_hits} похожих), промахов {self.misses}, {rate:.0f}%")
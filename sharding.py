@@ -0,0 +1,259 @@
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import zlib
+import hashlib
+import threading
+import subprocess
+
+import http_client
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# ======================== ШАРДИРОВАНИЕ ПО ЧАТАМ ========================
+#
+# Несколько процессов бота на одной машине. Диспетчер принимает сообщения
+# WhatsApp (опрос или вебхук) и пересылает каждое в процесс-воркер,
+# которому принадлежит чат: shard = crc32(chat_id) % N. Воркер держит
+# только свой срез состояния (диалоги, дедупликация, напоминания — в
+# файлах с суффиксом ".shardK") и принимает пачки на локальном вебхуке.
+#
+# Общие фоновые задачи (синхронизация оплаченных заказов, outbox кухни)
+# выполняет один воркер — лидер, державший файловый лок. Лок снимается
+# ОС при падении процесса, и лидерство подхватывает следующий воркер.
+#
+# Если воркер не принял пачку, route() возвращает False: при опросе курсор
+# не сдвигается, вебхук отвечает шлюзу 503 — и сообщения приходят снова.
+# Уже принятые воркерами дубли отсеиваются по id сообщения.
+
+FORWARD_ENDPOINT = "shard.forward"
+HEALTH_ENDPOINT = "shard.health"
+
+
+def shard_for(chat_id, shards):
+    """Номер шарда чата; crc32, а не hash(): он одинаков во всех процессах"""
+    return zlib.crc32(str(chat_id).encode("utf-8")) % shards
+
+
+def shard_path(path, shard):
+    """conversations.json -> conversations.shard2.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+
+def existing_shards(path):
+    """Номера шардов, для которых уже есть файлы path (любые расширения: .json, .db, журнал)"""
+    root = os.path.splitext(path)[0]
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.shard(\d+)(\.|$)")
+    found = set()
+    for name in os.listdir(os.path.dirname(root) or "."):
+        match = pattern.match(name)
+        if match:
+            found.add(int(match.group(1)))
+    return found
+
+
+class FileLock:
+    """Межпроцессный лок на файле (flock / msvcrt); снимается при смерти процесса"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.thread_lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        if not self.thread_lock.acquire(blocking=blocking):
+            return False
+        try:
+            self.file = open(self.path, "a+")
+            if fcntl is not None:
+                flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                fcntl.flock(self.file.fileno(), flags)
+            else:
+                self.file.seek(0)
+                mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+                msvcrt.locking(self.file.fileno(), mode, 1)
+            return True
+        except OSError:
+            self.file.close()
+            self.file = None
+            self.thread_lock.release()
+            return False
+
+    def release(self):
+        if self.file is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+            self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class LeaderElection:
+    """Лидер — процесс, захвативший лок; остальные периодически пробуют снова"""
+
+    def __init__(self, path):
+        self.lock = FileLock(path)
+        self.leader = False
+
+    def is_leader(self):
+        if not self.leader and self.lock.acquire(blocking=False):
+            self.leader = True
+            print(f"👑 Процесс {os.getpid()} стал лидером фоновых задач")
+        return self.leader
+
+
+class ActivitySignal:
+    """Межпроцессный сигнал "что-то произошло" через mtime файла"""
+
+    def __init__(self, path):
+        self.path = path
+        self.seen = self.mtime()
+
+    def mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return 0.0
+
+    def touch(self):
+        try:
+            with open(self.path, "a"):
+                pass
+            os.utime(self.path, None)
+        except OSError as e:
+            print(f"⚠️ Не удалось отметить активность: {e}")
+
+    def wait(self, timeout, poll=0.5):
+        """True, если сигнал пришел раньше, чем прошло timeout секунд"""
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.mtime()
+            if current != self.seen:
+                self.seen = current
+                return True
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            time.sleep(min(poll, left))
+
+
+class ShardRouter:
+    """Диспетчер: раскладывает сообщения по шардам и пересылает воркерам"""
+
+    def __init__(self, shards, base_port, path, secret, host="127.0.0.1"):
+        self.shards = shards
+        self.urls = [f"http://{host}:{base_port + shard}{path}" for shard in range(shards)]
+        self.secret = secret
+
+    def wait_ready(self, timeout=30.0, poll=0.5):
+        """Ждет, пока вебхуки всех воркеров начнут отвечать; True — все готовы"""
+        deadline = time.monotonic() + timeout
+        waiting = set(range(self.shards))
+        while waiting:
+            for shard in sorted(waiting):
+                try:
+                    r = http_client.get(self.urls[shard], endpoint=HEALTH_ENDPOINT, retries=0, timeout=2)
+                    if r.status_code == 200:
+                        waiting.discard(shard)
+                except Exception:
+                    pass
+            if not waiting:
+                break
+            if time.monotonic() >= deadline:
+                print(f"⚠️ Воркеры не готовы за {timeout:.0f} сек: шарды {sorted(waiting)}")
+                return False
+            time.sleep(poll)
+        print(f"✅ Воркеры готовы: {self.shards}")
+        return True
+
+    def route(self, messages):
+        """Пачка сообщений -> по одному запросу на каждый затронутый шард.
+
+        False, если хоть один шард не принял свою часть — пачку нужно повторить.
+        """
+        batches = {}
+        for msg in messages:
+            chat_id = msg.get("chat_id")
+            if not chat_id:
+                continue
+            batches.setdefault(shard_for(chat_id, self.shards), []).append(msg)
+        accepted = True
+        for shard, batch in batches.items():
+            accepted = self.forward(shard, batch) and accepted
+        return accepted
+
+    def forward(self, shard, messages):
+        body = json.dumps({"messages": messages}, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers["X-Webhook-Signature"] = hmac.new(self.secret.encode(), body, hashlib.sha256).hexdigest()
+        try:
+            # Повтор безопасен: воркер отсеивает дубли по id сообщения
+            r = http_client.post(self.urls[shard], endpoint=FORWARD_ENDPOINT, data=body,
+                                 headers=headers, idempotent=True, timeout=10)
+            if r.status_code != 200:
+                print(f"❌ Шард {shard} не принял {len(messages)} сообщ.: {r.status_code}")
+                return False
+        except Exception as e:
+            print(f"❌ Шард {shard} недоступен: {e}")
+            return False
+        return True
+
+
+class WorkerProcesses:
+    """Запуск и перезапуск процессов-воркеров (тот же скрипт с SHARD_INDEX)"""
+
+    def __init__(self, script, shards):
+        self.script = os.path.abspath(script)
+        self.shards = shards
+        self.processes = [None] * shards
+
+    def _spawn(self, shard):
+        env = dict(os.environ, SHARD_INDEX=str(shard), SHARD_COUNT=str(self.shards))
+        self.processes[shard] = subprocess.Popen([sys.executable, self.script], env=env)
+        print(f"🧩 Воркер шарда {shard} запущен (pid {self.processes[shard].pid})")
+
+    def start(self):
+        for shard in range(self.shards):
+            self._spawn(shard)
+        return self
+
+    def check(self):
+        """Перезапускает упавшие воркеры"""
+        for shard, process in enumerate(self.processes):
+            if process is not None and process.poll() is not None:
+                print(f"⚠️ Воркер шарда {shard} завершился (код {process.returncode}), перезапуск")
+                self._spawn(shard)
+
+    def stop(self):
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+from rate_limit import TokenBucket
+
+# ======================== TELEGRAM: РАССЫЛКА НА КУХНЮ ========================
+#
+# Сообщения всем поварам уходят параллельно через ограниченный пул.
+# Лимиты Telegram соблюдаются двумя token bucket'ами: общий на бота
+# (~30 сообщений/сек) и отдельный на каждый чат (~1 сообщение/сек).
+# Фото чека загружается по URL только один раз — дальше оно отправляется
+# по file_id, который Telegram вернул в ответ на первую загрузку.
+
+PHOTO_CACHE_SIZE = 256
+
+
+class TelegramSender:
+    """Отправка в Telegram с лимитами и параллельной рассылкой"""
+
+    def __init__(self, token, max_workers=8, global_rate=25.0, chat_rate=1.0):
+        self.api_url = f"https://api.telegram.org/bot{token}"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="telegram")
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.photo_file_ids = OrderedDict()
+        self.photo_locks = {}
+        self.lock = threading.Lock()
+
+    def _acquire(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        bucket.acquire()
+        self.global_bucket.acquire()
+
+    def call(self, method, chat_id, data):
+        """Вызов метода Bot API для чата; возвращает result или None"""
+        self._acquire(chat_id)
+        try:
+            r = http_client.post(
+                f"{self.api_url}/{method}", endpoint=f"telegram.{method}",
+                json=dict(data, chat_id=chat_id), timeout=10
+            )
+        except Exception as e:
+            print(f"❌ Ошибка Telegram {method} ({chat_id}): {e}")
+            return None
+        if r.status_code != 200:
+            print(f"❌ Ошибка Telegram {method} ({chat_id}): {r.status_code} - {r.text}")
+            return None
+        return r.json().get("result") or {}
+
+    def send_message(self, chat_id, text, parse_mode="HTML"):
+        return self.call("sendMessage", chat_id, {"text": text, "parse_mode": parse_mode}) is not None
+
+    def send_photo(self, chat_id, photo_url, caption):
+        """Первая загрузка — по URL, следующие — по закэшированному file_id"""
+        file_id = self._cached_file_id(photo_url)
+        if file_id is None:
+            with self.lock:
+                photo_lock = self.photo_locks.setdefault(photo_url, threading.Lock())
+            # Остальные получатели ждут, пока первый загрузит фото
+            with photo_lock:
+                file_id = self._cached_file_id(photo_url)
+                if file_id is None:
+                    result = self.call("sendPhoto", chat_id, {"photo": photo_url, "caption": caption})
+                    sizes = (result or {}).get("photo") or []
+                    if sizes:
+                        self._remember_file_id(photo_url, sizes[-1]["file_id"])
+                    else:
+                        # file_id не получен: лок больше не нужен, иначе словарь растет на каждом сбойном URL
+                        with self.lock:
+                            if self.photo_locks.get(photo_url) is photo_lock:
+                                del self.photo_locks[photo_url]
+                    return result is not None
+        return self.call("sendPhoto", chat_id, {"photo": file_id, "caption": caption}) is not None
+
+    def _cached_file_id(self, photo_url):
+        with self.lock:
+            file_id = self.photo_file_ids.get(photo_url)
+            if file_id is not None:
+                self.photo_file_ids.move_to_end(photo_url)
+            return file_id
+
+    def _remember_file_id(self, photo_url, file_id):
+        with self.lock:
+            self.photo_file_ids[photo_url] = file_id
+            self.photo_file_ids.move_to_end(photo_url)
+            while len(self.photo_file_ids) > PHOTO_CACHE_SIZE:
+                old_url, _ = self.photo_file_ids.popitem(last=False)
+                self.photo_locks.pop(old_url, None)
+
+    def broadcast(self, chat_ids, text, photo_url=None, caption=None):
+        """Рассылает сообщение (и фото) всем чатам параллельно.
+
+        Возвращает {chat_id: {"message": bool, "photo": bool | None}}.
+        Фото отправляется только тем, кому дошло сообщение.
+        """
+        def deliver(chat_id):
+            result = {"message": self.send_message(chat_id, text), "photo": None}
+            if result["message"] and photo_url:
+                result["photo"] = self.send_photo(chat_id, photo_url, caption)
+            return result
+
+        futures = {chat_id: self.executor.submit(deliver, chat_id) for chat_id in chat_ids}
+        results = {}
+        for chat_id, future in futures.items():
+            try:
+                results[chat_id] = future.result()
+            except Exception as e:
+                print(f"❌ Ошибка рассылки в {chat_id}: {e}")
+                results[chat_id] = {"message": False, "photo": None}
+        return results
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# order_engine создает клиентов AI при импорте — ключ нужен только для этого
+os.environ.setdefault("PERPLEXITY_API_KEY", "test")
@@ -0,0 +1,149 @@
+import pytest
+import requests
+
+import http_client
+from airtable_client import AirtableWriter
+
+
+class CountingBucket:
+    def __init__(self):
+        self.taken = 0
+
+    def acquire(self):
+        self.taken += 1
+
+
+def make_writer():
+    writer = AirtableWriter("base", "Orders", "key", CountingBucket(), window=0)
+    writer.thread = object()  # без фонового потока: пачки забираем вручную
+    return writer
+
+
+def test_retry_does_not_overwrite_newer_update():
+    writer = make_writer()
+    first = writer.update("rec1", {"Kitchen_Status": "Cooking", "Note": "x"})
+    batch = writer._take_batch()
+    second = writer.update("rec1", {"Kitchen_Status": "Ready"})
+
+    writer._retry(batch)  # первая правка получила 503 и уходит на повтор
+
+    assert len(writer.items) == 1
+    item = writer.items[0]
+    assert item["fields"] == {"Kitchen_Status": "Ready", "Note": "x"}
+    assert item["futures"] == [first, second]
+
+
+def test_retry_of_other_records_keeps_order():
+    writer = make_writer()
+    writer.update("rec1", {"A": 1})
+    batch = writer._take_batch()
+    writer.update("rec2", {"B": 2})
+
+    writer._retry(batch)
+
+    assert [item["record_id"] for item in writer.items] == ["rec1", "rec2"]
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    def request(self, method, url, **kwargs):
+        return FakeResponse(self.statuses.pop(0))
+
+
+def test_token_taken_for_every_attempt(monkeypatch):
+    monkeypatch.setattr(http_client, "session_for", lambda url: FakeSession([429, 503, 200]))
+    monkeypatch.setattr(http_client, "retry_delay", lambda attempt, retry_after=None: 0)
+    bucket = CountingBucket()
+
+    r = http_client.patch("https://api.airtable.com/v0/base/Orders", json={}, before_attempt=bucket.acquire)
+
+    assert r.status_code == 200
+    assert bucket.taken == 3
+
+
+class StatusResponse(FakeResponse):
+    text = ""
+
+    def json(self):
+        return {"records": [{"id": "recNew"}]}
+
+
+def send_with(monkeypatch, writer, outcome):
+    """Одна отправка пачки, где http_client отвечает статусом или бросает исключение"""
+    def fake(url, **kwargs):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return StatusResponse(outcome)
+
+    monkeypatch.setattr(http_client, "post", fake)
+    monkeypatch.setattr(http_client, "patch", fake)
+    batch = writer._take_batch()
+    writer._send(batch)
+    return batch
+
+
+@pytest.mark.parametrize("outcome", [
+    requests.ReadTimeout("read timed out"),
+    500,
+    502,
+    504,
+])
+def test_create_not_resent_when_it_may_have_landed(monkeypatch, outcome):
+    writer = make_writer()
+    future = writer.create({"Is_Paid": False})
+
+    send_with(monkeypatch, writer, outcome)
+
+    assert future.result(timeout=0) is None
+    assert writer.items == []
+
+
+@pytest.mark.parametrize("outcome", [
+    requests.ConnectTimeout("connect timed out"),
+    429,
+    503,
+])
+def test_create_retried_when_not_executed(monkeypatch, outcome):
+    writer = make_writer()
+    future = writer.create({"Is_Paid": False})
+
+    send_with(monkeypatch, writer, outcome)
+    assert not future.done()
+    assert len(writer.items) == 1
+
+    writer.items[0]["not_before"] = 0.0
+    send_with(monkeypatch, writer, 200)
+    assert future.result(timeout=0) == "recNew"
+
+
+def test_update_retried_on_server_error(monkeypatch):
+    writer = make_writer()
+    future = writer.update("rec1", {"Kitchen_Status": "Cooking"})
+
+    send_with(monkeypatch, writer, 500)
+
+    assert not future.done()
+    assert len(writer.items) == 1
+
+
+def test_cancelled_create_is_never_sent(monkeypatch):
+    writer = make_writer()
+    future = writer.create({"Is_Paid": False})
+    assert future.cancel()
+
+    assert writer._take_batch() == []
+    # Уже отправленный create отменить нельзя — вызывающий код дождется ответа
+    sent = writer.create({"Is_Paid": False})
+    batch = writer._take_batch()
+    assert len(batch) == 1 and not sent.cancel()
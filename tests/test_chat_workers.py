@@ -0,0 +1,57 @@
+import time
+import threading
+
+from chat_workers import ChatWorkerPool
+
+
+def wait_idle(pool, timeout=5):
+    deadline = time.monotonic() + timeout
+    while pool.metrics()["active_chats"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.shutdown(wait=True)
+
+
+def test_interleaved_chats_keep_order_and_run_concurrently():
+    pool = ChatWorkerPool(max_workers=4, name="test")
+    # Первые задачи двух чатов пройдут барьер, только если выполняются одновременно
+    barrier = threading.Barrier(2, timeout=2)
+    lock = threading.Lock()
+    done = {"a": [], "b": []}
+    running = {"a": 0, "b": 0}
+    overlaps = []
+
+    def job(chat, i):
+        with lock:
+            running[chat] += 1
+            overlaps.append(running[chat])
+        if i == 0:
+            barrier.wait()
+        time.sleep(0.005)
+        with lock:
+            running[chat] -= 1
+            done[chat].append(i)
+
+    for i in range(20):
+        pool.submit("a", job, "a", i)
+        pool.submit("b", job, "b", i)
+    wait_idle(pool)
+
+    assert done == {"a": list(range(20)), "b": list(range(20))}
+    assert max(overlaps) == 1       # у чата не больше одной задачи в работе
+    assert not barrier.broken
+    assert pool.metrics()["processed"] == 40
+
+
+def test_failed_job_does_not_stop_chat_queue():
+    pool = ChatWorkerPool(max_workers=2, name="test")
+    done = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    pool.submit("a", fail)
+    pool.submit("a", done.append, 1)
+    wait_idle(pool)
+
+    assert done == [1]
+    assert pool.metrics()["failed"] == 1
@@ -0,0 +1,71 @@
+from context_window import (
+    build_messages, fold_overflow, message_tokens, summarize_messages, SUMMARY_LABELS
+)
+
+
+def history(count):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"сообщение номер {i}"}
+        for i in range(count)
+    ]
+
+
+def test_budget_keeps_newest_messages():
+    messages = history(10)
+    budget = sum(message_tokens(m) for m in messages[-3:])
+
+    prompt, _ = build_messages("PROMPT", messages, budget)
+
+    assert prompt[1:] == messages[-3:]
+
+
+def test_messages_outside_budget_are_summarized():
+    messages = history(10)
+    budget = sum(message_tokens(m) for m in messages[-3:])
+
+    prompt, _ = build_messages("PROMPT", messages, budget, summary="- Клиент: самое начало")
+    system = prompt[0]["content"]
+
+    assert system.startswith("PROMPT")
+    assert "самое начало" in system
+    for i in range(7):
+        assert f"сообщение номер {i}" in system
+    for i in range(7, 10):
+        assert f"сообщение номер {i}" not in system
+
+
+def test_summary_budget_drops_oldest_lines():
+    messages = history(30)
+    prompt, _ = build_messages("PROMPT", messages, budget=1, summary_budget=20)
+    system = prompt[0]["content"]
+
+    assert "сообщение номер 28" in system
+    assert "сообщение номер 0\n" not in system
+
+
+def test_no_summary_when_everything_fits():
+    prompt, _ = build_messages("PROMPT", history(4), budget=10_000)
+    assert prompt[0]["content"] == "PROMPT"
+
+
+def test_summary_is_localized():
+    messages = history(6)
+    for language in ("kk", "en"):
+        prompt, _ = build_messages("PROMPT", messages, budget=1, language=language)
+        labels = SUMMARY_LABELS[language]
+        assert labels["header"] in prompt[0]["content"]
+        assert f"- {labels['user']}:" in prompt[0]["content"]
+    assert summarize_messages(messages[:1], "en") == ["- Customer: сообщение номер 0"]
+
+
+def test_fold_overflow_summarizes_trimmed_messages():
+    conv = {"messages": history(4), "language": "en", "history_summary": "- Customer: earlier"}
+
+    summary = fold_overflow(conv, keep=3, summary_budget=1000)
+
+    assert summary.splitlines() == [
+        "- Customer: earlier",
+        "- Customer: сообщение номер 0",
+        "- Seller: сообщение номер 1",
+    ]
+    assert fold_overflow({"messages": history(1)}, keep=3, summary_budget=1000) is None
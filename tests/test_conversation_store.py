@@ -0,0 +1,179 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from conversation_store import JournalStore, SqliteStore, JOURNAL_SUFFIX, ROTATED_SUFFIX
+
+
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_journal_replay_restores_unsaved_changes(tmp_path):
+    path = str(tmp_path / "conversations.json")
+    store = JournalStore(path).load()
+    store.ensure("1", {"messages": []})
+    store.append_message("1", {"role": "user", "content": "привет"})
+    store.update("1", language="ru")
+    store.flush()
+    # Падение без close(): снимка нет, только журнал
+
+    restored = JournalStore(path).load()
+    conv = restored.get("1")
+    assert conv["messages"] == [{"role": "user", "content": "привет"}]
+    assert conv["language"] == "ru"
+
+
+def test_load_does_not_touch_files(tmp_path):
+    path = str(tmp_path / "conversations.json")
+    store = JournalStore(path).load()
+    store.ensure("1", {"messages": []})
+    store.append_message("1", {"role": "user", "content": "a"})
+    store.flush()
+    journal = read_bytes(path + JOURNAL_SUFFIX)
+    snapshot_existed = os.path.exists(path)
+
+    JournalStore(path).load()
+
+    assert read_bytes(path + JOURNAL_SUFFIX) == journal
+    assert os.path.exists(path) == snapshot_existed
+
+
+def test_first_flush_compacts_replayed_journal(tmp_path):
+    path = str(tmp_path / "conversations.json")
+    store = JournalStore(path).load()
+    store.ensure("1", {"messages": []})
+    store.append_message("1", {"role": "user", "content": "a"})
+    store.flush()
+
+    restored = JournalStore(path).load()
+    restored.flush()
+
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f)["1"]["messages"] == [{"role": "user", "content": "a"}]
+    assert os.path.getsize(path + JOURNAL_SUFFIX) == 0
+
+
+def test_replay_of_rotated_journal_does_not_duplicate(tmp_path):
+    path = str(tmp_path / "conversations.json")
+    store = JournalStore(path).load()
+    store.ensure("1", {"messages": []})
+    store.append_message("1", {"role": "user", "content": "a"})
+    store.compact()
+    store.append_message("1", {"role": "assistant", "content": "b"})
+    store.flush()
+    with open(path + JOURNAL_SUFFIX, encoding='utf-8') as f:
+        applied = f.read()
+    store.compact()
+    # Сбой после записи снимка, но до удаления ".old": его записи уже в снимке
+    with open(path + JOURNAL_SUFFIX + ROTATED_SUFFIX, 'w', encoding='utf-8') as f:
+        f.write(applied)
+
+    restored = JournalStore(path).load()
+    assert [m["content"] for m in restored.get("1")["messages"]] == ["a", "b"]
+
+
+def test_automatic_compaction_keeps_all_records(tmp_path):
+    path = str(tmp_path / "conversations.json")
+    store = JournalStore(path, compact_every=3).load()
+    store.ensure("1", {"messages": []})
+    for i in range(10):
+        store.append_message("1", {"role": "user", "content": str(i)}, keep=5)
+    store.flush()
+
+    restored = JournalStore(path).load()
+    assert [m["content"] for m in restored.get("1")["messages"]] == ["5", "6", "7", "8", "9"]
+
+
+def test_copy_on_write_keeps_old_snapshot(tmp_path):
+    store = JournalStore(str(tmp_path / "conversations.json")).load()
+    before = store.ensure("1", {"messages": []})
+    store.append_message("1", {"role": "user", "content": "a"})
+
+    assert before["messages"] == []
+    assert len(store.get("1")["messages"]) == 1
+
+
+def test_sqlite_import_reads_legacy_file_only(tmp_path):
+    legacy = str(tmp_path / "conversations.json")
+    write_json(legacy, {"1": {"messages": [{"role": "user", "content": "a"}], "pending_order": None}})
+    original = read_bytes(legacy)
+
+    store = SqliteStore(str(tmp_path / "conversations.db")).load(import_from=legacy)
+
+    assert store.get("1")["messages"] == [{"role": "user", "content": "a"}]
+    assert read_bytes(legacy) == original
+    assert not os.path.exists(legacy + JOURNAL_SUFFIX)
+
+
+def test_sqlite_failed_append_rolls_back(tmp_path):
+    store = SqliteStore(str(tmp_path / "conversations.db"))
+    store.ensure("1", {"messages": []})
+
+    with pytest.raises(TypeError):
+        store.append_message("1", {"content": object()})  # не сериализуется в JSON
+    assert not store.db.in_transaction
+
+    store.append_message("1", {"role": "user", "content": "a"}, keep=10)
+    store.cache.clear()
+    assert store.get("1")["messages"] == [{"role": "user", "content": "a"}]
+
+
+def test_sqlite_rollback_on_database_error(tmp_path):
+    store = SqliteStore(str(tmp_path / "conversations.db"))
+    store.ensure("1", {"messages": []})
+    store.db.execute("CREATE TRIGGER fail AFTER INSERT ON messages BEGIN SELECT RAISE(ABORT, 'boom'); END")
+
+    with pytest.raises(sqlite3.DatabaseError):
+        store.append_message("1", {"role": "user", "content": "a"})
+    assert not store.db.in_transaction
+
+    store.db.execute("DROP TRIGGER fail")
+    store.append_message("1", {"role": "user", "content": "b"})
+    assert [m["content"] for m in store.get("1")["messages"]] == ["b"]
+
+
+@pytest.mark.parametrize("make_store", [
+    lambda tmp_path: JournalStore(str(tmp_path / "conversations.json")).load(),
+    lambda tmp_path: SqliteStore(str(tmp_path / "conversations.db")),
+])
+def test_open_orders_skip_closed_and_unplaced(tmp_path, make_store):
+    store = make_store(tmp_path)
+    store.ensure("1", {"messages": [], "airtable_record_id": "rec1"})
+    store.ensure("2", {"messages": [], "airtable_record_id": "rec2"})
+    store.ensure("3", {"messages": [], "airtable_record_id": None})
+    store.update("2", order_closed=True)
+    store.ensure("4", {"messages": []})
+    store.update("4", airtable_record_id="rec4", order_closed=False)
+
+    assert sorted(store.open_orders()) == [("1", "rec1"), ("4", "rec4")]
+    store.close()
+
+
+def test_sqlite_open_orders_migrates_old_schema(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE conversations (
+            chat_id TEXT PRIMARY KEY, data TEXT NOT NULL,
+            waiting_for_receipt INTEGER NOT NULL DEFAULT 0, order_placed INTEGER NOT NULL DEFAULT 0,
+            has_pending_order INTEGER NOT NULL DEFAULT 0, airtable_record_id TEXT, last_interaction REAL
+        );
+        INSERT INTO conversations (chat_id, data, airtable_record_id) VALUES ('1', '{}', 'rec1'), ('2', '{}', NULL);
+    """)
+    db.close()
+
+    store = SqliteStore(path)
+
+    assert store.open_orders() == [("1", "rec1")]
+    store.update("1", order_closed=True)
+    assert store.open_orders() == []
+    store.close()
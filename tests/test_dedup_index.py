@@ -0,0 +1,69 @@
+import json
+
+from dedup_index import RecentIdIndex
+
+
+def test_duplicates_are_rejected(tmp_path):
+    index = RecentIdIndex(str(tmp_path / "ids.json"))
+
+    assert index.add_if_new("m1")
+    assert not index.add_if_new("m1")
+    assert index.add_if_new("m2")
+    assert "m1" in index and len(index) == 2
+
+
+def test_add_does_not_write_file_on_ingest(tmp_path):
+    path = tmp_path / "ids.json"
+    index = RecentIdIndex(str(path))
+
+    for i in range(100):
+        index.add_if_new(f"m{i}")
+
+    assert not path.exists()
+    index.flush()
+    assert len(json.loads(path.read_text())) == 100
+
+
+def test_ttl_evicts_oldest_and_duplicate_refreshes_time(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("dedup_index.time.time", lambda: clock[0])
+    index = RecentIdIndex(ttl=100)
+
+    index.add_if_new("old")
+    clock[0] = 1050
+    index.add_if_new("mid")
+    clock[0] = 1090
+    assert not index.add_if_new("old")  # повтор: время обновилось, запись ушла в конец
+
+    clock[0] = 1160
+    index.add_if_new("new")
+
+    # "mid" (1050) старше ttl, "old" обновлен в 1090 — остается
+    assert list(index.ids) == ["old", "new"]
+
+
+def test_capacity_keeps_most_recent(tmp_path):
+    index = RecentIdIndex(capacity=3)
+    for msg_id in ("a", "b", "c", "d"):
+        index.add_if_new(msg_id)
+    index.add_if_new("b")
+    index.add_if_new("e")
+
+    assert list(index.ids) == ["d", "b", "e"]
+
+
+def test_reload_restores_window_and_drops_expired(tmp_path, monkeypatch):
+    path = str(tmp_path / "ids.json")
+    clock = [1000.0]
+    monkeypatch.setattr("dedup_index.time.time", lambda: clock[0])
+    index = RecentIdIndex(path, ttl=100)
+    index.add_if_new("expired")
+    clock[0] = 1080
+    index.add_if_new("fresh")
+    index.save()
+
+    clock[0] = 1150
+    reloaded = RecentIdIndex(path, ttl=100).load()
+
+    assert list(reloaded.ids) == ["fresh"]
+    assert not reloaded.add_if_new("fresh")
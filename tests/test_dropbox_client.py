@@ -0,0 +1,82 @@
+import io
+import json
+import hashlib
+
+import pytest
+
+import dropbox_client
+
+
+def reference_hash(data, block_size):
+    blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+    return hashlib.sha256(b"".join(hashlib.sha256(b).digest() for b in blocks)).hexdigest()
+
+
+@pytest.mark.parametrize("size", [0, 1, 7, 8, 9, 16, 17, 40])
+@pytest.mark.parametrize("piece", [1, 3, 8, 64])
+def test_content_hash_across_block_boundaries(monkeypatch, size, piece):
+    monkeypatch.setattr(dropbox_client, "HASH_BLOCK_SIZE", 8)
+    data = bytes(range(size))
+    hasher = dropbox_client.ContentHasher()
+    for i in range(0, size, piece):
+        hasher.update(data[i:i + piece])
+
+    assert hasher.hexdigest() == reference_hash(data, 8)
+
+
+def test_content_hash_of_full_dropbox_block():
+    data = b"x" * (dropbox_client.HASH_BLOCK_SIZE + 1)
+    hasher = dropbox_client.ContentHasher()
+    hasher.update(data)
+
+    assert hasher.hexdigest() == reference_hash(data, dropbox_client.HASH_BLOCK_SIZE)
+
+
+class FakeStream:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), 5):
+            yield self.data[i:i + 5]
+
+
+def test_spool_download_returns_file_hash_and_size():
+    data = b"receipt pdf content"
+    spool, content_hash, size = dropbox_client.spool_download(FakeStream(data))
+
+    with spool:
+        assert spool.read() == data
+    assert size == len(data)
+    assert content_hash == reference_hash(data, dropbox_client.HASH_BLOCK_SIZE)
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    recorded = []
+
+    def fake_call(token, method, arg, data, endpoint):
+        recorded.append((method, json.loads(json.dumps(arg)), data))   # cursor меняется на месте
+        return {"session_id": "s1"} if method == "upload_session/start" else {"path_display": "/r.pdf"}
+
+    monkeypatch.setattr(dropbox_client, "_content_call", fake_call)
+    return recorded
+
+
+@pytest.mark.parametrize("data", [b"", b"abc", b"abcd"])
+def test_file_up_to_one_chunk_is_a_single_upload(calls, data):
+    chunks = dropbox_client.file_chunks(io.BytesIO(data), 4)
+    dropbox_client.upload_chunks("token", chunks, "/r.pdf")
+
+    assert [(method, body) for method, _, body in calls] == [("upload", data)]
+
+
+def test_large_file_goes_through_session_with_offsets(calls):
+    chunks = dropbox_client.file_chunks(io.BytesIO(b"abcdefghij"), 4)
+    dropbox_client.upload_chunks("token", chunks, "/r.pdf")
+
+    assert [method for method, _, _ in calls] == [
+        "upload_session/start", "upload_session/append_v2", "upload_session/append_v2", "upload_session/finish"
+    ]
+    assert [body for _, _, body in calls] == [b"abcd", b"efgh", b"ij", b""]
+    assert [arg["cursor"]["offset"] for _, arg, _ in calls[1:]] == [4, 8, 10]
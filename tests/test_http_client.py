@@ -0,0 +1,142 @@
+import asyncio
+
+import httpx
+import pytest
+import requests
+
+import http_client
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Отдает заранее заданные ответы/исключения и запоминает таймауты"""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.calls.append(timeout)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def session(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(http_client.time, "sleep", sleeps.append)
+
+    def install(*results):
+        fake = FakeSession(results)
+        fake.sleeps = sleeps
+        monkeypatch.setattr(http_client, "session_for", lambda url: fake)
+        return fake
+
+    return install
+
+
+def test_post_is_not_retried_on_read_timeout(session):
+    fake = session(requests.ReadTimeout("read"), FakeResponse(200))
+
+    with pytest.raises(requests.ReadTimeout):
+        http_client.request("POST", "https://api.test/x")
+    assert len(fake.calls) == 1
+
+
+def test_post_is_retried_when_connection_was_not_made(session):
+    fake = session(requests.ConnectTimeout("connect"), FakeResponse(201))
+
+    assert http_client.request("POST", "https://api.test/x").status_code == 201
+    assert len(fake.calls) == 2
+
+
+@pytest.mark.parametrize("method, status, calls", [
+    ("POST", 500, 1),
+    ("POST", 503, 2),
+    ("GET", 500, 2),
+])
+def test_status_retry_depends_on_idempotency(session, method, status, calls):
+    fake = session(FakeResponse(status), FakeResponse(200))
+
+    response = http_client.request(method, "https://api.test/x")
+
+    assert len(fake.calls) == calls
+    assert response.status_code == (status if calls == 1 else 200)
+
+
+def test_retry_after_is_honored(session):
+    fake = session(FakeResponse(429, {"Retry-After": "7"}), FakeResponse(200))
+
+    http_client.request("GET", "https://api.test/x")
+
+    assert fake.sleeps == [7.0]
+
+
+def test_endpoint_timeout_overrides_caller_timeout(session, monkeypatch):
+    monkeypatch.setitem(http_client.ENDPOINT_TIMEOUTS, "dropbox.upload", 60.0)
+    fake = session(FakeResponse(200), FakeResponse(200))
+
+    http_client.request("POST", "https://api.test/x", endpoint="dropbox.upload", timeout=5)
+    http_client.request("POST", "https://api.test/x", endpoint="other", timeout=5)
+
+    assert fake.calls == [60.0, 5]
+
+
+def test_before_attempt_runs_for_every_attempt(session):
+    session(FakeResponse(503), FakeResponse(200))
+    taken = []
+
+    http_client.request("GET", "https://api.test/x", before_attempt=lambda: taken.append(1))
+
+    assert len(taken) == 2
+
+
+class FakeAsyncClient:
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_async_rules_match_sync(monkeypatch):
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(asyncio, "sleep", no_sleep)
+    taken = []
+
+    async def scenario():
+        monkeypatch.setattr(http_client, "async_client", FakeAsyncClient([httpx.ReadTimeout("read")]))
+        with pytest.raises(httpx.ReadTimeout):
+            await http_client.async_request("POST", "https://api.test/x")
+
+        monkeypatch.setattr(http_client, "async_client", FakeAsyncClient([FakeResponse(500)]))
+        assert (await http_client.async_request("POST", "https://api.test/x")).status_code == 500
+
+        client = FakeAsyncClient([FakeResponse(503), FakeResponse(200)])
+        monkeypatch.setattr(http_client, "async_client", client)
+        response = await http_client.async_request(
+            "POST", "https://api.test/x", before_attempt=lambda: taken.append(1)
+        )
+        assert response.status_code == 200 and client.calls == 2
+
+    asyncio.run(scenario())
+
+    # Токен берется перед каждой попыткой, включая повтор
+    assert len(taken) == 2
@@ -0,0 +1,65 @@
+import pytest
+
+from intent_router import IntentRouter
+from menu_source import MenuSource
+
+MENU = {
+    "burgers": [{"name": "Чизбургер", "price": 1800}, {"name": "Классический бургер", "price": 1500}],
+    "drinks": [{"name": "Кола", "price": 500}],
+}
+
+
+@pytest.fixture(scope="module")
+def router():
+    return IntentRouter(MenuSource(MENU))
+
+
+@pytest.mark.parametrize("text, intent, language", [
+    ("привет", "greeting", "ru"),
+    ("Привет!", "greeting", "ru"),
+    ("Здравствуйте", "greeting", "ru"),
+    ("Добрый день, всем", "greeting", "ru"),
+    ("Сәлеметсіз бе", "greeting", "kk"),
+    ("сәлем", "greeting", "kk"),
+    ("Hello", "greeting", "en"),
+    ("good morning", "greeting", "en"),
+    ("привет, покажи меню", "menu", "ru"),
+    ("мәзір", "menu", "kk"),
+    ("what do you have?", "menu", "en"),
+    ("где мой заказ?", "status", "ru"),
+    ("тапсырысым қайда", "status", "kk"),
+    ("where is my order", "status", "en"),
+])
+def test_routed(router, text, intent, language):
+    result = router.classify(text)
+
+    assert result is not None
+    assert result[:2] == (intent, language)
+    assert result[2] == []
+
+
+@pytest.mark.parametrize("text, language, items", [
+    ("сколько стоит чизбургер?", "ru", [("Чизбургер", 1800)]),
+    ("цена кола и чизбургер", "ru", [("Кола", 500), ("Чизбургер", 1800)]),
+    ("how much is Кола", "en", [("Кола", 500)]),
+])
+def test_price(router, text, language, items):
+    assert router.classify(text) == ("price", language, items)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "Привет! Хочу бургер",
+    "привет, хочу два чизбургера",
+    "можно без лука?",
+    "можно чизбургер",
+    "чизбургер",
+    "сколько стоит?",
+    "сколько будет стоить?",
+    "цена колы",
+    "hi, I want a cola",
+    "сәлем, маған чизбургер",
+    "привет " * 13,
+])
+def test_not_routed(router, text):
+    assert router.classify(text) is None
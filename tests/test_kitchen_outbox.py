@@ -0,0 +1,55 @@
+from kitchen_outbox import KitchenOutbox, STATE_PENDING, STATE_FAILED
+
+
+def test_enqueue_is_idempotent(tmp_path):
+    outbox = KitchenOutbox(str(tmp_path / "outbox.db"))
+
+    assert outbox.enqueue("rec1", {"order_id": 1})
+    assert not outbox.enqueue("rec1", {"order_id": 1})
+    assert [(record_id, state) for record_id, state, _ in outbox.due()] == [("rec1", STATE_PENDING)]
+
+
+def test_next_due_follows_retry_schedule(tmp_path):
+    outbox = KitchenOutbox(str(tmp_path / "outbox.db"), retry_base=30)
+    assert outbox.next_due_in() is None
+
+    outbox.enqueue("rec1", {})
+    assert outbox.next_due_in() == 0.0
+
+    outbox.schedule_retry("rec1", "send failed")
+    assert 20 < outbox.next_due_in() <= 36
+    assert outbox.due() == []
+
+
+def test_exhausted_attempts_leave_queue(tmp_path):
+    outbox = KitchenOutbox(str(tmp_path / "outbox.db"), max_attempts=2)
+    outbox.enqueue("rec1", {})
+    outbox.schedule_retry("rec1", "a")
+    outbox.schedule_retry("rec1", "b")
+
+    assert outbox.state("rec1") == STATE_FAILED
+    assert outbox.next_due_in() is None
+
+
+def test_schedule_retry_reports_exhaustion(tmp_path):
+    outbox = KitchenOutbox(str(tmp_path / "outbox.db"), max_attempts=2)
+    outbox.enqueue("rec1", {})
+
+    assert outbox.schedule_retry("rec1", "a") is False
+    assert outbox.schedule_retry("rec1", "b") is True
+    assert outbox.schedule_retry("missing", "c") is False
+
+
+def test_purge_keeps_failed_records_as_tombstones(tmp_path):
+    outbox = KitchenOutbox(str(tmp_path / "outbox.db"), max_attempts=1, retention=0)
+    outbox.enqueue("failed", {})
+    outbox.schedule_retry("failed", "kitchen unreachable")
+    outbox.enqueue("done", {})
+    outbox.mark_sent("done")
+    outbox.mark_done("done")
+
+    assert outbox.purge() == 1
+    # Заказ failed так и висит в Airtable как Waiting — повторная синхронизация не должна его отправить
+    assert not outbox.enqueue("failed", {})
+    assert outbox.state("failed") == STATE_FAILED
+    assert outbox.due() == []
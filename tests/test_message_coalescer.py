@@ -0,0 +1,95 @@
+import asyncio
+
+from message_coalescer import MessageCoalescer
+
+
+class Recorder:
+    """handler, который записывает ходы и может подождать перед commit()"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.started = []
+        self.finished = []
+
+    async def __call__(self, chat_id, text, update, turn):
+        self.started.append((chat_id, text, update))
+        await asyncio.sleep(self.delay)
+        turn.commit()
+        self.finished.append((chat_id, text))
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_burst_is_merged_into_one_turn():
+    async def scenario():
+        handler = Recorder()
+        coalescer = MessageCoalescer(handler, quiet=0.05, max_wait=1.0)
+        coalescer.submit(1, "привет", "u1")
+        coalescer.submit(1, "хочу бургер", "u2")
+        coalescer.submit(2, "меню", "u3")
+        await asyncio.sleep(0.15)
+        return handler, coalescer
+
+    handler, coalescer = run(scenario())
+
+    assert sorted(handler.started) == [(1, "привет\nхочу бургер", "u2"), (2, "меню", "u3")]
+    assert (coalescer.messages, coalescer.turns) == (3, 2)
+    assert coalescer.chats == {}
+
+
+def test_max_wait_flushes_during_steady_stream():
+    async def scenario():
+        handler = Recorder()
+        coalescer = MessageCoalescer(handler, quiet=0.05, max_wait=0.1)
+        for i in range(6):
+            coalescer.submit(1, str(i), None)
+            await asyncio.sleep(0.03)
+        await asyncio.sleep(0.1)
+        return handler
+
+    handler = run(scenario())
+
+    assert len(handler.started) >= 2
+    assert "\n".join(text for _, text, _ in handler.started) == "0\n1\n2\n3\n4\n5"
+
+
+def test_new_message_supersedes_running_generation():
+    async def scenario():
+        handler = Recorder(delay=0.1)
+        coalescer = MessageCoalescer(handler, quiet=0.02, max_wait=1.0)
+        coalescer.submit(1, "бургер", None)
+        await asyncio.sleep(0.05)   # генерация уже идет
+        coalescer.submit(1, "и колу", None)
+        await asyncio.sleep(0.2)
+        return handler, coalescer
+
+    handler, coalescer = run(scenario())
+
+    assert [text for _, text in handler.finished] == ["бургер\nи колу"]
+    assert coalescer.superseded == 1
+
+
+def test_committed_turn_is_not_cancelled():
+    async def scenario():
+        order = []
+
+        async def handler(chat_id, text, update, turn):
+            turn.commit()
+            order.append(("start", text))
+            await asyncio.sleep(0.05)
+            order.append(("end", text))
+
+        coalescer = MessageCoalescer(handler, quiet=0.01, max_wait=1.0)
+        coalescer.submit(1, "первое", None)
+        await asyncio.sleep(0.03)
+        coalescer.submit(1, "второе", None)
+        await asyncio.sleep(0.15)
+        return order, coalescer
+
+    order, coalescer = run(scenario())
+
+    # Второй ход ждет завершения первого, а не отменяет его
+    assert order == [("start", "первое"), ("end", "первое"), ("start", "второе"), ("end", "второе")]
+    assert coalescer.superseded == 0
@@ -0,0 +1,131 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conversation_store import JournalStore
+from order_engine import (
+    HISTORY_KEEP, ORDER_STATUS_TEXTS, RECEIPT_INSTRUCTIONS, LlmLimiter, OrderEngine, build_system_prompt,
+    order_status_reply, paid_status_reply
+)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    store = JournalStore(str(tmp_path / "conversations.json")).load()
+    yield OrderEngine(lambda: {"messages": [], "language": None}, store)
+    store.close()
+
+
+def test_remember_returns_conversation_after_append(engine):
+    conv = engine.remember(1, {"role": "user", "content": "привет"})
+
+    assert conv["messages"] == [{"role": "user", "content": "привет"}]
+    assert conv is engine.store.get("1")
+
+
+def test_remember_turn_keeps_history_window(engine):
+    for i in range(HISTORY_KEEP):
+        engine.remember_turn(1, f"вопрос {i}", f"ответ {i}")
+
+    conv = engine.store.get("1")
+    assert len(conv["messages"]) == HISTORY_KEEP
+    assert conv["messages"][-1] == {"role": "assistant", "content": f"ответ {HISTORY_KEEP - 1}"}
+    assert conv.get("history_summary")
+
+
+@pytest.mark.parametrize("language", ["ru", "kk", "en"])
+def test_system_prompt_asks_for_channel_receipt_format(language):
+    assert RECEIPT_INSTRUCTIONS["receipt_pdf"][language] in build_system_prompt(language, "receipt_pdf")
+    assert RECEIPT_INSTRUCTIONS["receipt"][language] in build_system_prompt(language, "receipt")
+
+
+def test_engine_prompt_uses_its_receipt_instruction(tmp_path):
+    store = JournalStore(str(tmp_path / "conversations.json")).load()
+    pdf_engine = OrderEngine(lambda: {"messages": [], "language": "ru"}, store, receipt="receipt_pdf")
+
+    messages, _ = pdf_engine.prepare(1, "хочу бургер")
+
+    assert RECEIPT_INSTRUCTIONS["receipt_pdf"]["ru"] in messages[0]["content"]
+    assert RECEIPT_INSTRUCTIONS["receipt"]["ru"] not in messages[0]["content"]
+    store.close()
+
+
+def test_llm_limiter_shares_slots_without_blocking_the_executor():
+    limiter = LlmLimiter(2)
+    active = []
+    peak = []
+
+    async def call(i):
+        async with limiter:
+            active.append(i)
+            peak.append(len(active))
+            await asyncio.sleep(0.02)
+            active.remove(i)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+        limiter.semaphore.acquire()     # одно место занято синхронным каналом
+        tasks = [asyncio.ensure_future(call(i)) for i in range(6)]
+        await asyncio.sleep(0.01)
+        # Ожидающие не занимают пул потоков по умолчанию
+        assert await asyncio.wait_for(loop.run_in_executor(None, lambda: "free"), 1) == "free"
+        tasks[-1].cancel()
+        limiter.semaphore.release()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+    assert max(peak) <= 2
+    assert len(peak) == 5
+    # Все места вернулись: и общее, и очередь корутин
+    assert [limiter.semaphore.acquire(blocking=False) for _ in range(3)] == [True, True, False]
+
+
+def test_llm_limiter_keeps_fifo_and_returns_slot_of_cancelled_waiter():
+    limiter = LlmLimiter(1)
+    order = []
+
+    async def call(i):
+        async with limiter:
+            order.append(i)
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        limiter.semaphore.acquire()     # место занято синхронным каналом
+        tasks = []
+        for i in range(4):
+            tasks.append(asyncio.ensure_future(call(i)))
+            await asyncio.sleep(0.01)
+        tasks[0].cancel()               # ждал общее место в потоке пула
+        await asyncio.sleep(0.01)
+        limiter.semaphore.release()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+    assert order == [1, 2, 3]
+    assert limiter.semaphore.acquire(blocking=False)
+
+
+def test_status_texts_cover_every_language():
+    keys = set(ORDER_STATUS_TEXTS["ru"])
+    assert set(ORDER_STATUS_TEXTS) == {"ru", "kk", "en"}
+    assert all(set(texts) == keys for texts in ORDER_STATUS_TEXTS.values())
+
+
+@pytest.mark.parametrize("paid, kitchen_status, key", [
+    (False, "Cooking", "unpaid"),
+    (True, "Cooking", "Cooking"),
+    (True, "Ready", "Ready"),
+    (True, "New", "other"),
+    (True, None, "other"),
+])
+def test_paid_status_reply(paid, kitchen_status, key):
+    for language in ("ru", "kk", "en"):
+        assert paid_status_reply(language, paid, kitchen_status) == ORDER_STATUS_TEXTS[language][key]
+
+
+def test_unknown_language_falls_back_to_russian():
+    assert order_status_reply("de", "none") == ORDER_STATUS_TEXTS["ru"]["none"]
@@ -0,0 +1,93 @@
+import pytest
+
+from order_extractor import extract_order, price_items, validate_order
+
+MENU = {
+    "burgers": [{"name": "Чизбургер", "price": 1800}, {"name": "Классический бургер", "price": 1500}],
+    "drinks": [{"name": "Кола", "price": 500}],
+    "snacks": [{"name": "Наггетсы", "price": 1200}],
+}
+
+
+def make_order(items, total):
+    return {
+        "order_confirmed": True,
+        "phone": "+7 777 123 4567",
+        "order_items": items,
+        "total_price": total,
+        "delivery_address": "Абая 1",
+    }
+
+
+@pytest.mark.parametrize("items, total", [
+    (["2 чизбургера"], 3600),
+    (["Чизбургер - 2"], 3600),
+    (["Кола 2"], 1000),
+    (["Наггетсы (6 шт)"], 1200),
+    (["Чизбургер", "Кола 2"], 2800),
+])
+def test_ambiguous_items_keep_ai_total(items, total):
+    order, errors, notes = validate_order(make_order(items, total), MENU)
+
+    assert errors == []
+    assert notes == []
+    assert order["total_price"] == total
+    assert order["price_verified"] is False
+
+
+@pytest.mark.parametrize("items, expected", [
+    (["Чизбургер"], 1800),
+    (["Чизбургер x2", "Кола"], 4100),
+    (["2x Кола", "Наггетсы ×3"], 4600),
+    (["Классический бургер"], 1500),
+])
+def test_unambiguous_items_are_priced(items, expected):
+    assert price_items(items, MENU) == expected
+
+
+def test_unambiguous_mismatch_is_corrected():
+    order, errors, notes = validate_order(make_order(["Чизбургер x2"], 1800), MENU)
+
+    assert errors == []
+    assert notes == ["total_price: 1800 -> 3600 по меню"]
+    assert order["total_price"] == 3600
+    assert order["price_verified"] is True
+
+
+def test_matching_total_is_verified():
+    order, errors, notes = validate_order(make_order("Чизбургер, Кола", 2300), MENU)
+
+    assert (errors, notes) == ([], [])
+    assert order["order_items"] == ["Чизбургер", "Кола"]
+    assert order["price_verified"] is True
+
+
+def test_missing_fields_are_errors():
+    order, errors, _ = validate_order({"order_items": [], "phone": "123", "total_price": "abc"}, MENU)
+
+    assert len(errors) == 4
+
+
+@pytest.mark.parametrize("total", ["inf", "-inf", "1e400", float("inf"), "nan"])
+def test_non_finite_total_is_rejected(total):
+    order, errors, _ = validate_order(make_order(["2 чизбургера"], total), MENU)
+
+    assert errors == ["total_price: не указана сумма"]
+    assert order["total_price"] is None
+
+
+def test_non_finite_total_is_replaced_by_menu_price():
+    order, errors, notes = validate_order(make_order(["Чизбургер"], "1e400"), MENU)
+
+    assert errors == []
+    assert order["total_price"] == 1800
+    assert notes == ["total_price: None -> 1800 по меню"]
+
+
+def test_extract_order_strips_fenced_json():
+    text = 'Заказ принят!\n```json\n{"order_confirmed": true, "note": "a}b"}\n```'
+
+    order, rest = extract_order(text)
+
+    assert order == {"order_confirmed": True, "note": "a}b"}
+    assert rest == "Заказ принят!"
@@ -0,0 +1,39 @@
+import time
+import threading
+
+from rate_limit import TokenBucket, shared_bucket
+
+
+def acquire_in_thread(bucket, timeout):
+    done = threading.Event()
+    threading.Thread(target=lambda: (bucket.acquire(), done.set()), daemon=True).start()
+    return done.wait(timeout)
+
+
+def test_rate_below_one_still_gives_tokens():
+    bucket = TokenBucket(5 / 6)
+
+    assert bucket.capacity == 1.0
+    assert acquire_in_thread(bucket, timeout=1)
+    started = time.monotonic()
+    assert acquire_in_thread(bucket, timeout=3)
+    # Следующий токен — примерно через 1 / rate = 1.2 сек
+    assert time.monotonic() - started >= 1.0
+
+
+def test_burst_up_to_capacity_then_waits():
+    bucket = TokenBucket(20, capacity=3)
+
+    started = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+
+    assert 0.03 <= time.monotonic() - started < 0.5
+
+
+def test_shared_bucket_is_one_per_name():
+    first = shared_bucket("test-api", 5)
+
+    assert shared_bucket("test-api", 50) is first
+    assert first.rate == 5
+    assert shared_bucket("other-api", 5) is not first
@@ -0,0 +1,37 @@
+from receipt_index import ReceiptIndex
+from sharding import FileLock
+
+
+def test_same_receipt_on_two_orders_is_reported(tmp_path):
+    index = ReceiptIndex(str(tmp_path / "receipts.json"))
+    index.add("hash1", "/receipts/a.pdf", "https://dl/a.pdf", 100)
+
+    assert index.claim("hash1", "rec1") == []
+    assert index.claim("hash1", "rec1") == []     # повтор того же заказа — не подозрительно
+    assert index.claim("hash1", "rec2") == ["rec1"]
+    assert index.claim("unknown", "rec3") == []
+
+
+def test_add_keeps_orders_already_claimed(tmp_path):
+    index = ReceiptIndex(str(tmp_path / "receipts.json"))
+    index.add("hash1", "/receipts/a.pdf", "https://dl/a.pdf", 100)
+    index.claim("hash1", "rec1")
+
+    # Другой процесс загрузил тот же чек еще раз
+    index.add("hash1", "/receipts/a (1).pdf", "https://dl/a1.pdf", 100)
+
+    assert index.get("hash1")["link"] == "https://dl/a1.pdf"
+    assert index.claim("hash1", "rec2") == ["rec1"]
+
+
+def test_shared_index_sees_claims_of_other_processes(tmp_path):
+    path = str(tmp_path / "receipts.json")
+    lock_path = path + ".lock"
+    first = ReceiptIndex(path, file_lock=FileLock(lock_path)).load()
+    second = ReceiptIndex(path, file_lock=FileLock(lock_path)).load()
+
+    first.add("hash1", "/receipts/a.pdf", "https://dl/a.pdf", 100)
+    first.claim("hash1", "rec1")
+
+    assert second.claim("hash1", "rec2") == ["rec1"]
+    assert ReceiptIndex(path).load().get("hash1")["owners"] == ["rec1", "rec2"]
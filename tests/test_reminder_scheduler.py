@@ -0,0 +1,77 @@
+import json
+import time
+import threading
+
+from reminder_scheduler import ReminderScheduler
+
+
+def test_reschedule_replaces_previous_sequence():
+    scheduler = ReminderScheduler()
+    scheduler.schedule("chat1", [3600], payload="old")
+    scheduler.schedule("chat1", [0, 3600], payload="new")
+
+    # Старая запись кучи (через час) устарела по поколению, первой идет новая
+    assert scheduler._next_due() == ("chat1", 0, "new")
+    assert scheduler.entries["chat1"]["step"] == 1
+    assert [item for item in scheduler.heap if scheduler._is_live(item)] == [
+        (scheduler.entries["chat1"]["started_at"] + 3600, scheduler.entries["chat1"]["generation"], "chat1")
+    ]
+
+
+def test_cancelled_key_never_fires():
+    fired = []
+    done = threading.Event()
+    scheduler = ReminderScheduler().start(lambda key, step, payload: (fired.append(key), done.set()))
+
+    scheduler.schedule("cancelled", [0.05])
+    assert scheduler.cancel("cancelled")
+    assert not scheduler.cancel("cancelled")
+    scheduler.schedule("kept", [0.1])
+
+    assert done.wait(2)
+    time.sleep(0.05)
+    assert fired == ["kept"]
+    assert len(scheduler) == 0
+
+
+def test_stale_heap_entries_are_compacted():
+    scheduler = ReminderScheduler()
+    for _ in range(500):
+        scheduler.schedule("chat1", [3600])
+
+    assert len(scheduler) == 1
+    assert len(scheduler.heap) <= 2 * len(scheduler.entries) + 64
+
+
+def test_reload_collapses_missed_steps(tmp_path):
+    path = tmp_path / "reminders.json"
+    now = time.time()
+    path.write_text(json.dumps({
+        # Оба шага пропущены — отправится только последний, один раз
+        "missed": {"started_at": now - 100, "delays": [10, 50], "step": 0, "payload": None},
+        # Первый шаг пропущен, второй еще впереди
+        "partial": {"started_at": now - 100, "delays": [10, 3600], "step": 0, "payload": None},
+    }))
+
+    scheduler = ReminderScheduler(str(path)).load()
+
+    assert scheduler.entries["missed"]["step"] == 1
+    assert scheduler.entries["partial"]["step"] == 0
+    fired = {scheduler._next_due()[:2] for _ in range(2)}
+    assert fired == {("missed", 1), ("partial", 0)}
+    assert "missed" not in scheduler.entries
+    assert scheduler.entries["partial"]["step"] == 1
+
+
+def test_pending_reminders_survive_restart(tmp_path):
+    path = str(tmp_path / "reminders.json")
+    scheduler = ReminderScheduler(path)
+    scheduler.schedule("chat1", [600, 1800], payload={"record": "rec1"})
+    scheduler.schedule("chat2", [600])
+    scheduler.cancel("chat2")
+
+    reloaded = ReminderScheduler(path).load()
+
+    assert list(reloaded.entries) == ["chat1"]
+    assert reloaded.entries["chat1"]["payload"] == {"record": "rec1"}
+    assert reloaded.entries["chat1"]["delays"] == [600, 1800]
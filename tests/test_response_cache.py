@@ -0,0 +1,59 @@
+import pytest
+
+from response_cache import ResponseCache, fold_text, is_standalone_question, question_topic
+
+
+@pytest.mark.parametrize("text, topic", [
+    ("сколько ждать доставку?", "delivery"),
+    ("сколько стоит доставка?", "delivery"),
+    ("how long is delivery?", "delivery"),
+    ("до скольки вы работаете?", "hours"),
+    ("во сколько открываетесь?", "hours"),
+    ("какие есть пиццы?", "menu"),
+    ("қандай пицца бар?", "menu"),
+    ("what pizzas do you have?", "menu"),
+])
+def test_cart_independent_questions_are_cached(text, topic):
+    assert is_standalone_question(text)
+    assert question_topic(text) == topic
+
+
+@pytest.mark.parametrize("text", [
+    "сколько будет стоить?",
+    "а что у меня в заказе?",
+    "можно 2 чизбургера",
+    "можно 2 бургера?",
+    "итого сколько?",
+    "можно без лука?",
+    "когда привезут?",
+    "какая сумма заказа?",
+    "добавьте колу к бургеру?",
+    "what is my order total?",
+    "тапсырысым қанша болады?",
+    "меню",
+])
+def test_cart_questions_are_not_cached(text):
+    assert not is_standalone_question(text)
+    assert ResponseCache().key(text, "chat", "ru", "v1") is None
+
+
+def test_key_folds_kazakh_letters():
+    cache = ResponseCache()
+    key = cache.key("Қандай пицца бар?", "start", "kk", "v1")
+
+    assert key == ("start", "kk", "v1", fold_text("кандай пицца бар"))
+    assert cache.key("Қандай пицца бар?", None, "kk", "v1") is None
+
+
+def test_put_get_and_clear():
+    cache = ResponseCache(capacity=1)
+    first = cache.key("какие есть пиццы?", "start", "ru", "v1")
+    second = cache.key("сколько ждать доставку?", "start", "ru", "v1")
+
+    cache.put(first, "Маргарита, Пепперони")
+    assert cache.get(first) == "Маргарита, Пепперони"
+
+    cache.put(second, "30-40 минут")
+    assert cache.get(first) is None  # вытеснен по LRU
+    cache.clear()
+    assert cache.get(second) is None
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import signal
+import socket
+import random
+import subprocess
+
+import pytest
+
+from sharding import existing_shards, shard_path
+
+BOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+
+
+def test_existing_shards_matches_every_backend_file(tmp_path):
+    base = str(tmp_path / "conversations.json")
+    for name in ("conversations.shard0.json", "conversations.shard0.json.journal", "conversations.shard1.db",
+                 "conversations.json", "conversations_old.shard7.json", "processed_messages.shard3.json"):
+        (tmp_path / name).write_text("{}")
+
+    assert existing_shards(base) == {0, 1}
+    assert existing_shards(shard_path(base, 5)) == set()
+
+
+def free_port_pair():
+    for _ in range(50):
+        base = random.randint(20000, 40000)
+        sockets = []
+        try:
+            for port in (base, base + 1):
+                s = socket.socket()
+                sockets.append(s)
+                s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for s in sockets:
+                s.close()
+    pytest.skip("нет свободных портов")
+
+
+def start_dispatcher(tmp_path, **env):
+    env = dict(os.environ, SHARD_COUNT="2", SHARD_BASE_PORT=str(free_port_pair()),
+               WHATSAPP_API_URL="http://127.0.0.1:1", POLL_INTERVAL="60", PYTHONUNBUFFERED="1",
+               PERPLEXITY_API_KEY="test", **env)
+    env.pop("SHARD_INDEX", None)
+    return subprocess.Popen([sys.executable, BOT], cwd=tmp_path, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+
+
+def test_dispatcher_refuses_mismatched_shard_files(tmp_path):
+    for shard in range(3):
+        (tmp_path / f"conversations.shard{shard}.json").write_text("{}")
+
+    process = start_dispatcher(tmp_path)
+    output, _ = process.communicate(timeout=60)
+
+    assert process.returncode != 0
+    assert "SHARD_COUNT=2" in output
+    assert "запущен (pid" not in output
+    # Диспетчер не открывает outbox кухни и индексы — это дело воркеров
+    assert not (tmp_path / "kitchen_outbox.db").exists()
+    assert not (tmp_path / "receipt_index.json").exists()
+
+
+def test_sigterm_stops_worker_processes(tmp_path):
+    process = start_dispatcher(tmp_path)
+    pids = []
+    deadline = time.monotonic() + 60
+    try:
+        for line in process.stdout:
+            if "запущен (pid" in line:
+                pids.append(int(line.rsplit("pid", 1)[1].strip(" )\n")))
+            if "Воркеры готовы" in line or time.monotonic() > deadline:
+                break
+        assert len(pids) == 2
+
+        process.send_signal(signal.SIGTERM)
+        process.communicate(timeout=30)
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+    for pid in pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
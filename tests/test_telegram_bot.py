@@ -0,0 +1,84 @@
+import os
+import sys
+import asyncio
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def a(tmp_path_factory):
+    # a.py хранит диалоги в текущем каталоге — импортируем его во временном
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("telegram"))
+    try:
+        sys.modules.pop("a", None)
+        module = importlib.import_module("a")
+        module.load_conversations()
+        yield module
+        module.conversations.close()
+    finally:
+        os.chdir(cwd)
+
+
+def fake_update(user_id, first_name, language_code):
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, first_name=first_name, language_code=language_code),
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+    return update, replies
+
+
+@pytest.mark.parametrize("user_id, language_code, greeting", [
+    (101, "en", "Hello, Alex!"),
+    (102, "kk", "Сәлем, Alex!"),
+    (103, None, "Привет, Alex!"),
+])
+def test_start_greets_new_user_by_name_in_their_language(a, user_id, language_code, greeting):
+    update, replies = fake_update(user_id, "Alex", language_code)
+
+    asyncio.run(a.start_command(update, None))
+
+    assert len(replies) == 1 and replies[0].startswith(greeting)
+    conv = a.conversations.get(str(user_id))
+    assert conv["user_name"] == "Alex"
+    assert conv["language"] == (language_code or "ru")
+
+
+def test_startup_tracks_only_open_orders(a, monkeypatch):
+    a.conversations.ensure("201", dict(a.new_conversation(), airtable_record_id="recOpen"))
+    a.conversations.ensure("202", dict(a.new_conversation(), airtable_record_id="recDone", order_closed=True))
+    monkeypatch.setattr(a.conversations, "items", lambda: pytest.fail("полный проход по диалогам"))
+    statuses = a.OrderStatusCache()
+    monkeypatch.setattr(a, "order_statuses", statuses)
+
+    a.track_open_orders()
+
+    assert statuses.tracked() == ["recOpen"]
+
+
+def test_airtable_calls_take_the_shared_bucket(a, monkeypatch):
+    from rate_limit import shared_bucket
+    hooks = []
+
+    async def fake_request(method, url, before_attempt=None, **kwargs):
+        hooks.append(before_attempt)
+        return SimpleNamespace(status_code=200, json=lambda: {"id": "rec1", "fields": {}, "records": []})
+
+    monkeypatch.setattr(a.http_client, "async_request", fake_request)
+
+    async def scenario():
+        await a.create_airtable_record({"order_items": ["Бургер"], "total_price": 1000})
+        await a.get_order_status("rec1")
+        await a.fetch_order_records(["rec1"])
+
+    asyncio.run(scenario())
+
+    # Тот же bucket, что у WhatsApp-бота в main.py
+    assert hooks == [shared_bucket("airtable", a.AIRTABLE_RATE_LIMIT).acquire] * 3
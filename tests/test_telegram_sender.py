@@ -0,0 +1,34 @@
+from telegram_sender import TelegramSender
+
+
+def make_sender(results):
+    sender = TelegramSender("token", global_rate=1000, chat_rate=1000)
+    calls = []
+
+    def call(method, chat_id, data):
+        calls.append((method, chat_id, data["photo"]))
+        return results.pop(0)
+
+    sender.call = call
+    return sender, calls
+
+
+def test_failed_upload_drops_photo_lock():
+    sender, calls = make_sender([None, {}])
+
+    assert sender.send_photo(1, "https://x/a.jpg", "чек") is False
+    assert sender.send_photo(2, "https://x/b.jpg", "чек") is True  # ответ без photo
+
+    assert sender.photo_locks == {}
+    assert sender.photo_file_ids == {}
+    assert [photo for _, _, photo in calls] == ["https://x/a.jpg", "https://x/b.jpg"]
+
+
+def test_uploaded_photo_is_resent_by_file_id():
+    sender, calls = make_sender([{"photo": [{"file_id": "small"}, {"file_id": "big"}]}, {}])
+
+    assert sender.send_photo(1, "https://x/a.jpg", "чек") is True
+    assert sender.send_photo(2, "https://x/a.jpg", "чек") is True
+
+    assert [photo for _, _, photo in calls] == ["https://x/a.jpg", "big"]
+    assert list(sender.photo_locks) == ["https://x/a.jpg"]
@@ -0,0 +1,203 @@
+import hmac
+import json
+import os
+import sys
+import hashlib
+import threading
+import importlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+import requests
+
+import http_client
+from sharding import ShardRouter, shard_for
+from webhook_server import start_webhook_server, verify_signature
+
+# ======================== ФЕЙКОВЫЙ ШЛЮЗ WHATSAPP ========================
+
+
+class FakeGateway:
+    """messages/list как у шлюза: time_from, offset/count, sort asc|desc"""
+
+    def __init__(self):
+        self.messages = []
+        self.requests = 0
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path != "/messages/list":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                gateway.requests += 1
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                time_from = int(params.get("time_from", 0))
+                offset = int(params.get("offset", 0))
+                count = int(params.get("count", 20))
+                found = [m for m in gateway.messages if m["timestamp"] >= time_from]
+                found.sort(key=lambda m: m["timestamp"], reverse=params.get("sort", "desc") != "asc")
+                body = json.dumps({"messages": found[offset:offset + count]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add(self, count, start):
+        for i in range(count):
+            ts = start + i
+            self.messages.append({"id": f"m{ts}", "chat_id": "7701@s.whatsapp.net", "timestamp": ts,
+                                  "type": "text", "text": {"body": str(ts)}})
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    # bot.py хранит состояние в текущем каталоге — импортируем его во временном
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    os.environ.setdefault("PERPLEXITY_API_KEY", "test")
+    try:
+        sys.modules.pop("bot", None)
+        yield importlib.import_module("bot")
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def gateway(bot, monkeypatch):
+    gateway = FakeGateway()
+    monkeypatch.setattr(bot, "WHATSAPP_API_URL", gateway.url)
+    monkeypatch.setitem(bot.poll_cursor, "time_from", 1000)
+    yield gateway
+    gateway.server.shutdown()
+
+
+def poll_all(bot, rounds=10):
+    received = []
+    for _ in range(rounds):
+        bot.poll_messages(received.extend)
+    return received
+
+
+def test_poll_fetches_only_new_messages(bot, gateway):
+    gateway.add(5, start=1000)
+    first = poll_all(bot, rounds=1)
+    gateway.add(3, start=2000)
+    second = poll_all(bot, rounds=1)
+
+    assert [m["timestamp"] for m in first] == list(range(1000, 1005))
+    # Сообщение на самом курсоре приходит повторно — его отсеет дедупликация по id
+    assert [m["timestamp"] for m in second] == [1004, 2000, 2001, 2002]
+
+
+def test_poll_backlog_beyond_page_cap_is_not_lost(bot, gateway, monkeypatch):
+    monkeypatch.setattr(bot, "POLL_PAGE_SIZE", 3)
+    monkeypatch.setattr(bot, "POLL_MAX_PAGES", 2)
+    gateway.add(20, start=1000)
+
+    received = {m["id"] for m in poll_all(bot)}
+
+    assert received == {m["id"] for m in gateway.messages}
+
+
+def test_poll_keeps_cursor_when_delivery_fails(bot, gateway):
+    gateway.add(3, start=1000)
+
+    rejected = []
+    bot.poll_messages(lambda messages: rejected.extend(messages) or False)
+    assert bot.poll_cursor["time_from"] == 1000
+    retried = poll_all(bot, rounds=1)
+
+    assert [m["id"] for m in rejected] == [m["id"] for m in retried] == [m["id"] for m in gateway.messages]
+    assert bot.poll_cursor["time_from"] == 1002
+
+
+def test_shard_router_propagates_failed_forward(bot, monkeypatch):
+    monkeypatch.setattr(http_client, "BACKOFF_BASE", 0)
+    secret = "s3cret"
+    received = []
+    healthy = start_webhook_server("127.0.0.1", 0, "/webhook", secret, received.append)
+    broken = start_webhook_server("127.0.0.1", 0, "/webhook", secret, lambda payload: False)
+    router = ShardRouter(2, 0, "/webhook", secret)
+    router.urls = [f"http://127.0.0.1:{server.server_address[1]}/webhook" for server in (healthy, broken)]
+    by_shard = {}
+    for i in range(20):
+        by_shard.setdefault(shard_for(f"77{i}", 2), f"77{i}")
+
+    try:
+        assert router.wait_ready(timeout=5)
+        assert router.route([{"id": "a", "chat_id": by_shard[0]}]) is True
+        assert router.route([{"id": "b", "chat_id": by_shard[0]}, {"id": "c", "chat_id": by_shard[1]}]) is False
+        broken.shutdown()
+        broken.server_close()
+        assert router.wait_ready(timeout=0.3, poll=0.1) is False
+    finally:
+        healthy.shutdown()
+        broken.server_close()
+
+    # Здоровый шард свою часть получил; повтор пачки он отсеет по id
+    assert [m["id"] for payload in received for m in payload["messages"]] == ["a", "b"]
+
+
+@pytest.mark.parametrize("on_payload, status", [
+    (lambda payload: None, 200),
+    (lambda payload: False, 503),
+    (lambda payload: 1 / 0, 500),
+])
+def test_webhook_status_reflects_processing(on_payload, status):
+    secret = "s3cret"
+    server = start_webhook_server("127.0.0.1", 0, "/webhook", secret, on_payload)
+    url = f"http://127.0.0.1:{server.server_address[1]}/webhook"
+    body = b'{"messages": [{"id": "x"}]}'
+    signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+    try:
+        r = requests.post(url, data=body, headers={"X-Webhook-Signature": signature}, timeout=5)
+    finally:
+        server.shutdown()
+
+    # Не-200 — шлюз повторит доставку, а не потеряет сообщения
+    assert r.status_code == status
+
+
+def test_webhook_requires_secret():
+    assert not verify_signature("", b"{}", {})
+    with pytest.raises(ValueError):
+        start_webhook_server("127.0.0.1", 0, "/webhook", "", lambda payload: None)
+
+
+def test_webhook_checks_signature_and_payload_shape(bot):
+    secret = "s3cret"
+    received = []
+    server = start_webhook_server("127.0.0.1", 0, "/webhook", secret, received.append)
+    url = f"http://127.0.0.1:{server.server_address[1]}/webhook"
+
+    def post(body, signed=True):
+        headers = {"Content-Type": "application/json"}
+        if signed:
+            headers["X-Webhook-Signature"] = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return requests.post(url, data=body, headers=headers, timeout=5).status_code
+
+    try:
+        assert post(b'{"messages": []}', signed=False) == 401
+        assert post(b'[1, 2]') == 400
+        assert post(b'{"messages": [{"id": "x"}]}') == 200
+    finally:
+        server.shutdown()
+    assert received == [{"messages": [{"id": "x"}]}]
+
+    # Тело нестандартной формы не роняет обработчик
+    assert bot.webhook_messages({"messages": "oops"}) == []
+    assert bot.webhook_messages([1]) == []
+    bot.handle_webhook({"messages": None})
@@ -0,0 +1,87 @@
+import hmac
+import json
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ======================== WEBHOOK ПРИЕМНИК ========================
+#
+# Встроенный HTTP-сервер для входящих вебхуков шлюза WhatsApp.
+# Подпись проверяется одним из двух способов:
+#   X-Webhook-Signature: hex(HMAC-SHA256(secret, тело запроса))
+#   X-Webhook-Token: secret  (если шлюз умеет только статичные заголовки)
+# Тело сразу передается в on_payload, ответ 200 уходит без ожидания AI.
+# Если on_payload вернул False (например, диспетчер не смог переслать
+# пачку воркеру), шлюзу уходит 503, а если упал с исключением — 500:
+# в обоих случаях шлюз повторит доставку, дубли отсеются по id сообщения.
+# Без секрета сервер не запускается: иначе это открытая точка для всех.
+
+
+def verify_signature(secret, body, headers):
+    """Проверяет подпись вебхука; без секрета не пропускает ничего"""
+    if not secret:
+        return False
+    signature = headers.get("X-Webhook-Signature", "")
+    if signature:
+        if signature.startswith("sha256="):
+            signature = signature[len("sha256="):]
+        expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+    token = headers.get("X-Webhook-Token", "")
+    return bool(token) and hmac.compare_digest(token, secret)
+
+
+def start_webhook_server(host, port, path, secret, on_payload):
+    """Запускает сервер в фоновом потоке и возвращает его"""
+    if not secret:
+        raise ValueError("вебхук без секрета не запускается: задайте WEBHOOK_SECRET")
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split("?")[0] != path:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+
+            if not verify_signature(secret, body, self.headers):
+                print("⚠️ Вебхук с неверной подписью отклонен")
+                self.send_response(401)
+                self.end_headers()
+                return
+
+            try:
+                payload = json.loads(body or b"{}")
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                payload = None
+            if not isinstance(payload, dict):
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            try:
+                status = 200 if on_payload(payload) is not False else 503
+            except Exception as e:
+                print(f"❌ Ошибка обработки вебхука: {e}")
+                status = 500
+
+            self.send_response(status)
+            self.end_headers()
+
+        def do_GET(self):
+            # Проверка доступности для балансировщика/шлюза
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"🌐 Вебхук слушает http://{host}:{port}{path}")
+    return server